@@ -0,0 +1,162 @@
+# Utilities
+import struct
+import json
+import hashlib
+import itertools
+
+# Wire format for the command socket (port 8557)
+#
+#   Every request and reply is a single ZMQ frame:  HEADER + body
+#
+#   HEADER is struct '<4sBBHI':  magic b'PRMZ', protocol version, command code, flags (unused,
+#       must be 0), and a request ID chosen by the client. Replies echo the command code and
+#       request ID, which is how a client that pipelines requests matches replies to them
+#       (replies may come back out of order - e.g., a LoadModel finishes after a later
+#       QueryVersion has already been answered).
+#
+#   body is a UTF-8 JSON object. For requests it holds the command's fields (e.g., "MazeConfig"
+#       for LoadModel); for replies it always has a "Status" string (e.g., "ModelLoaded") plus any
+#       other fields the reply carries. JSON (unlike pickle) can't execute anything when decoded.
+#
+#   LoadModel and PreloadModel may send just "MazeHash" (see maze_digest()) instead of the whole
+#       "MazeConfig". If the renderer hasn't seen that maze, the status is "ModelNotCached" and
+#       the client should send it again with the "MazeConfig" included.
+#
+#   The renderer serves this over a ROUTER socket, so any number of DEALER (or REQ) clients can
+#   talk to it at the same time. CommandClient below is a simple DEALER-based client.
+
+PROTOCOL_MAGIC = b'PRMZ'
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('<4sBBHI')
+
+# Command codes are part of the protocol - only ever add to this list!
+COMMANDS = {
+    'QueryVersion': 1,
+    'LoadModel': 2,
+    'UpdateDataServer': 3,
+    'Exit': 4,
+    'QueryModelStatus': 5,
+    'PreloadModel': 6,
+    'ActivateModel': 7,
+    'EvictModel': 8,
+    'QueryTextures': 9,
+    'Error': 255, # (only in replies - to messages whose command couldn't be read)
+}
+COMMAND_NAMES = {code: name for name, code in COMMANDS.items()}
+
+# Fields which commands need (name -> (types, required)). A request that gets them wrong gets a
+#   "ProtocolError" reply, rather than failing when the renderer acts on it.
+MODEL_ID_TYPES = (str, int, float) # (must be hashable - models are kept in a dict by ModelID)
+REQUEST_FIELDS = {
+    'LoadModel': {'MazeHash': (str, False)},
+    'QueryModelStatus': {'ModelID': (MODEL_ID_TYPES, False)},
+    'PreloadModel': {'ModelID': (MODEL_ID_TYPES, True), 'MazeHash': (str, False)},
+    'ActivateModel': {'ModelID': (MODEL_ID_TYPES, True), 'AtFrame': (int, False)},
+    'EvictModel': {'ModelID': (MODEL_ID_TYPES, True)},
+}
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def encode_message(request_id, command, body):
+    if command not in COMMANDS:
+        raise ProtocolError('Unknown command {}'.format(command))
+    header = HEADER.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, COMMANDS[command], 0, request_id)
+    return header + json.dumps(body, separators=(',', ':')).encode('utf-8')
+
+
+def decode_message(frame):
+    # Returns (request_id, command name, body dictionary). Raises ProtocolError if frame isn't valid.
+    if len(frame) < HEADER.size:
+        raise ProtocolError('Message too short ({} bytes)'.format(len(frame)))
+    magic, protocol_version, code, flags, request_id = HEADER.unpack_from(frame)
+    if magic != PROTOCOL_MAGIC:
+        raise ProtocolError('Not a PyRenderMaze command message')
+    if protocol_version != PROTOCOL_VERSION:
+        raise ProtocolError('Unsupported protocol version {}'.format(protocol_version))
+    if code not in COMMAND_NAMES:
+        raise ProtocolError('Unknown command code {}'.format(code))
+    try:
+        body = json.loads(bytes(frame[HEADER.size:]).decode('utf-8')) if len(frame) > HEADER.size else {}
+    except ValueError as e:
+        raise ProtocolError('Malformed message body ({})'.format(e))
+    if not isinstance(body, dict):
+        raise ProtocolError('Message body must be an object')
+    return request_id, COMMAND_NAMES[code], body
+
+
+def encode_request(request_id, command, **fields):
+    return encode_message(request_id, command, fields)
+
+
+def encode_reply(request_id, command, status, **fields):
+    fields['Status'] = status
+    return encode_message(request_id, command, fields)
+
+
+def check_request(command, body):
+    # Raises ProtocolError if a request is missing a field it needs, or a field has the wrong type
+    if command == 'Error':
+        raise ProtocolError('Error is not a request')
+    for name, (types, required) in REQUEST_FIELDS.get(command, {}).items():
+        if name not in body:
+            if required:
+                raise ProtocolError('{} needs a {} field'.format(command, name))
+        elif not isinstance(body[name], types) or isinstance(body[name], bool):
+            raise ProtocolError('{} field {} has the wrong type ({})'.format(command, name, type(body[name]).__name__))
+
+
+def peek_request_id(frame):
+    # Best effort request ID from a frame that failed to decode (so the error reply can be matched)
+    try:
+        return HEADER.unpack_from(frame)[4]
+    except struct.error:
+        return 0
+
+
+def error_reply(frame, error):
+    # "ProtocolError" reply to a request that couldn't be decoded (or checked). It echoes the
+    #   request's command and ID if they can be read, otherwise the command is "Error".
+    try:
+        code = HEADER.unpack_from(frame)[2]
+    except struct.error:
+        code = None
+    return encode_reply(peek_request_id(frame), COMMAND_NAMES.get(code, 'Error'), 'ProtocolError', Error=str(error))
+
+
+def maze_digest(maze_config):
+    # Content hash of a maze config (independent of key order / formatting of the YAML)
+    canonical = json.dumps(maze_config, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class CommandClient:
+    """ CommandClient: DEALER client for the renderer's command socket
+
+        send() returns the request ID of the message, and recv() returns
+        (request_id, command, reply body) for whichever reply arrives next.
+    """
+    def __init__(self, context, address):
+        import zmq # (only clients need this here)
+        self.socket = context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(address)
+        self.request_ids = itertools.count(1)
+
+    def send(self, command, **fields):
+        request_id = next(self.request_ids) & 0xFFFFFFFF
+        # The empty delimiter frame makes our messages look like REQ messages to the server
+        self.socket.send_multipart([b'', encode_request(request_id, command, **fields)])
+        return request_id
+
+    def recv(self, flags=0):
+        frames = self.socket.recv_multipart(flags)
+        return decode_message(frames[-1])
+
+    def poll(self, timeout):
+        return self.socket.poll(timeout)
+
+    def close(self):
+        self.socket.close()
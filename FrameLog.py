@@ -0,0 +1,176 @@
+# Utilities
+import os
+import sys
+import csv
+import glob
+import mmap
+import queue
+import struct
+import argparse
+import threading
+
+import numpy as np
+
+# Binary per-frame log (replaces the CSV sync log, which wrote text on the render thread).
+#
+#   Each file is HEADER followed by fixed-size FRAME_LOG_DTYPE records. The file is allocated
+#   up front (records_per_file records) and memory-mapped; the record count in the header is
+#   updated after every write, so a reader only sees complete records even if the renderer
+#   dies. When a file is full, logging continues in the next one (name_0000.framelog,
+#   name_0001.framelog, ...). Closed files are truncated to the records they hold.
+#
+#   posY is the position in the stream sample the frame used, and drawn_posY is where the
+#   cameras were placed (they differ when a PositionPredictor extrapolates). Logs written
+#   before drawn_posY was added are read with drawn_posY = posY.
+FRAME_LOG_MAGIC = b'PRMFLOG2'
+HEADER = struct.Struct('<8sII') # magic, record size, number of records
+FRAME_LOG_DTYPE = np.dtype([('frame', '<u4'), ('timestamp', '<u4'), ('posY', '<f8'), ('drawn_posY', '<f8'),
+                            ('sync_state', '<u4'), ('frame_time', '<f8')]) # (packed, 36 bytes)
+FRAME_LOG_V1_MAGIC = b'PRMFLOG1'
+FRAME_LOG_V1_DTYPE = np.dtype([('frame', '<u4'), ('timestamp', '<u4'), ('posY', '<f8'),
+                               ('sync_state', '<u4'), ('frame_time', '<f8')])
+
+
+class FrameLogger:
+    """ FrameLogger: append frame records from the render thread without touching the disk
+
+        log() only stores the record in the current chunk (a preallocated NumPy array). Full
+        chunks are handed to a writer thread through a queue, and come back through another
+        one to be reused, so the render thread never waits on a lock held by disk I/O. (If the
+        writer falls behind, new chunks are allocated rather than blocking.)
+    """
+    def __init__(self, base_filename, records_per_file=216000, chunk_records=60, n_chunks=8):
+        self.base_filename = base_filename
+        self.records_per_file = records_per_file
+        self.chunk_records = chunk_records
+        self.free_chunks = queue.SimpleQueue()
+        self.full_chunks = queue.SimpleQueue()
+        for _ in range(n_chunks - 1):
+            self.free_chunks.put(np.zeros(chunk_records, dtype=FRAME_LOG_DTYPE))
+        self.chunk = np.zeros(chunk_records, dtype=FRAME_LOG_DTYPE)
+        self.n = 0
+
+        # Writer thread state
+        self.file_index = 0
+        self.file = None
+        self.map = None
+        self.file_records = 0
+        self.filenames = []
+        self.writer = threading.Thread(target=self.write_chunks, name='FrameLogWriter', daemon=True)
+        self.writer.start()
+
+    def log(self, frame, timestamp, posY, drawn_posY, sync_state, frame_time):
+        self.chunk[self.n] = (frame, timestamp, posY, drawn_posY, sync_state, frame_time)
+        self.n += 1
+        if self.n == self.chunk_records:
+            self.hand_off()
+
+    def hand_off(self):
+        self.full_chunks.put((self.chunk, self.n))
+        try:
+            self.chunk = self.free_chunks.get_nowait()
+        except queue.Empty:
+            self.chunk = np.zeros(self.chunk_records, dtype=FRAME_LOG_DTYPE)
+        self.n = 0
+
+    def close(self):
+        # Write out whatever has been logged and wait for the writer to finish
+        if self.n:
+            self.hand_off()
+        self.full_chunks.put(None)
+        self.writer.join()
+
+    # ---- Writer thread ----
+    def write_chunks(self):
+        while True:
+            item = self.full_chunks.get()
+            if item is None:
+                break
+            chunk, n = item
+            self.write(chunk[:n])
+            self.free_chunks.put(chunk)
+        self.close_file()
+
+    def open_next_file(self):
+        self.close_file()
+        filename = '{}_{:04d}.framelog'.format(self.base_filename, self.file_index)
+        self.file_index += 1
+        self.file = open(filename, 'w+b')
+        size = HEADER.size + self.records_per_file * FRAME_LOG_DTYPE.itemsize
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(self.file.fileno(), 0, size) # really allocate it, so writes don't have to
+        else:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.file_records = 0
+        HEADER.pack_into(self.map, 0, FRAME_LOG_MAGIC, FRAME_LOG_DTYPE.itemsize, 0)
+        self.filenames.append(filename)
+
+    def write(self, records):
+        while len(records):
+            if self.map is None or self.file_records == self.records_per_file:
+                self.open_next_file()
+            n = min(len(records), self.records_per_file - self.file_records)
+            offset = HEADER.size + self.file_records * FRAME_LOG_DTYPE.itemsize
+            self.map[offset:offset + n * FRAME_LOG_DTYPE.itemsize] = records[:n].tobytes()
+            self.file_records += n
+            HEADER.pack_into(self.map, 0, FRAME_LOG_MAGIC, FRAME_LOG_DTYPE.itemsize, self.file_records)
+            records = records[n:]
+
+    def close_file(self):
+        if self.map is None:
+            return
+        self.map.flush()
+        self.map.close()
+        self.file.truncate(HEADER.size + self.file_records * FRAME_LOG_DTYPE.itemsize)
+        self.file.close()
+        self.map = None
+        self.file = None
+
+
+def read_frame_log(filename):
+    # Returns the records in one .framelog file as a FRAME_LOG_DTYPE structured array
+    with open(filename, 'rb') as f:
+        magic, record_size, n_records = HEADER.unpack(f.read(HEADER.size))
+        if magic == FRAME_LOG_MAGIC and record_size == FRAME_LOG_DTYPE.itemsize:
+            return np.fromfile(f, dtype=FRAME_LOG_DTYPE, count=n_records)
+        if magic == FRAME_LOG_V1_MAGIC and record_size == FRAME_LOG_V1_DTYPE.itemsize:
+            old = np.fromfile(f, dtype=FRAME_LOG_V1_DTYPE, count=n_records)
+            records = np.zeros(len(old), dtype=FRAME_LOG_DTYPE)
+            for name in FRAME_LOG_V1_DTYPE.names:
+                records[name] = old[name]
+            records['drawn_posY'] = old['posY']
+            return records
+        raise ValueError('{} is not a frame log'.format(filename))
+
+
+def load_frame_log(path):
+    # A .framelog file, or the base name of a rotated log (all of its files, in order)
+    filenames = [path] if path.endswith('.framelog') else sorted(glob.glob(glob.escape(path) + '_[0-9]*.framelog'))
+    if not filenames:
+        raise FileNotFoundError('No frame log files for {}'.format(path))
+    return np.concatenate([read_frame_log(f) for f in filenames])
+
+
+def export_csv(records, out):
+    writer = csv.writer(out)
+    writer.writerow(FRAME_LOG_DTYPE.names)
+    for record in records:
+        writer.writerow(record.tolist())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Read PyRenderMaze frame logs (optionally converting them to CSV)')
+    parser.add_argument('path', help='a .framelog file, or the base name of a rotated log (e.g., ExperimentLog2021-06-01_1200)')
+    parser.add_argument('--csv', default=None, help='write the records to this CSV file ("-" for stdout)')
+    args = parser.parse_args()
+
+    records = load_frame_log(args.path)
+    if args.csv == '-':
+        export_csv(records, sys.stdout)
+    elif args.csv:
+        with open(args.csv, 'w', newline='') as out:
+            export_csv(records, out)
+    else:
+        print('{} frames ({} to {}), {:.1f} s'.format(len(records), records['frame'][0], records['frame'][-1],
+                                                       records['frame_time'][-1] - records['frame_time'][0]))
@@ -0,0 +1,550 @@
+# Core imports
+from panda3d.core import NodePath, GeomNode, ModelNode, RenderState, TextureStage, TransparencyAttrib
+import math
+import json
+
+# Local code
+from ParametricShapes import makeCylinder, makePlane, cylinderDivisions
+from TextureManager import load_texture
+from ProceduralTextures import is_procedural
+from TextureAtlas import atlas_candidate, plan_placement, apply_atlas, is_atlas_name
+
+# NOTE: Nothing in this file touches the live scene graph (render) or ShowBase globals. Mazes
+#   are built into a detached NodePath, which means that building can happen in a background
+#   thread while the current maze keeps being drawn. The caller attaches the result to render.
+
+BACKGROUND_TEXTURE = "textures/whitenoise.png" # texture for the room wall cylinder
+
+# Cylinders are tessellated finely enough that their outlines are within this angle (radians,
+#   as seen by the mouse) of a true circle. This is about a pixel on the default display; the
+#   renderer works it out for the actual display with display_tessellation_error().
+DEFAULT_TESSELLATION_ERROR = 1 / 300
+MIN_VIEW_DISTANCE = 1 # (the camera can get right up to features on the track)
+
+
+class MazeModel:
+    """ MazeModel: a built (but not necessarily displayed) maze.
+
+        root is a detached NodePath holding all of the maze geometry. The global track
+        parameters are kept alongside so the renderer can pick them up when it swaps the
+        model in. feature_nodes holds the (unflattened, detached) node built for each of the
+        TrackFeatures, and prepared_nodes the copies of them that were put into the merge
+        groups (see assemble_maze()), which lets update_maze() reuse them. For mazes loaded
+        from the .bam cache these start out empty, and are built as update_maze() needs them.
+        nodes_touched is the number of feature nodes that update_maze() had to rebuild,
+        retexture or remove (None if the maze was built from scratch). pager is the MazePager
+        for paged mazes (None otherwise); it has to be told where the camera is.
+    """
+    def __init__(self, config, root, track_length, wall_height, wall_distance, feature_nodes=None, prepared_nodes=None):
+        self.config = config
+        self.root = root
+        self.track_length = track_length
+        self.wall_height = wall_height
+        self.wall_distance = wall_distance
+        self.feature_nodes = feature_nodes if feature_nodes is not None else {}
+        self.prepared_nodes = prepared_nodes if prepared_nodes is not None else {}
+        self.nodes_touched = None
+        self.pager = None
+
+    @property
+    def has_features(self):
+        return bool(self.config.get('TrackFeatures', None))
+
+    @property
+    def optimization_stats(self):
+        # (GeomNodes, Geoms) before and after optimize_maze(), or None if it wasn't optimized.
+        #   Stored as a tag so that it survives being cached as a .bam file.
+        if not self.root.hasTag('OptimizationStats'):
+            return None
+        counts = [int(c) for c in self.root.getTag('OptimizationStats').split()]
+        return tuple(counts[:2]), tuple(counts[2:])
+
+    @property
+    def atlas_stats(self):
+        # What texture atlasing did when the maze was assembled (None if it wasn't tried), as a dict:
+        #   "DrawCalls" is the number of distinct textures bound by the atlasable features, before and after
+        if not self.root.hasTag('AtlasStats'):
+            return None
+        return json.loads(self.root.getTag('AtlasStats'))
+
+    @property
+    def memory_bytes(self):
+        # Approximate size of the vertex and index data held by this model. Geometry shared
+        #   between the root and the feature nodes is counted more than once (instanced nodes only
+        #   once), and textures (which are shared between models through the TexturePool)
+        #   aren't counted at all.
+        total = 0
+        geom_nodes = set()
+        for node in [self.root] + list(self.feature_nodes.values()) + list(self.prepared_nodes.values()):
+            geom_nodes.update(path.node() for path in node.findAllMatches('**/+GeomNode'))
+            if node.node().isGeomNode():
+                geom_nodes.add(node.node())
+        for geom_node in geom_nodes:
+            for geom in geom_node.getGeoms():
+                vdata = geom.getVertexData()
+                total += sum(vdata.getArray(i).getDataSizeBytes() for i in range(vdata.getNumArrays()))
+                for i in range(geom.getNumPrimitives()):
+                    primitive = geom.getPrimitive(i)
+                    if primitive.isIndexed(): # (single strips are stored without an index)
+                        total += primitive.getDataSizeBytes()
+        return total
+
+
+def merge_groups(root):
+    # {group key: (NodePath, [feature names])} for the merge groups of an optimized maze (see assemble_maze())
+    groups = {}
+    if not root.isEmpty():
+        for path in root.findAllMatches('**/=MergeGroup'):
+            groups.setdefault(path.getTag('MergeGroup'), (path, json.loads(path.getTag('Features'))))
+    return groups
+
+
+def root_record(root, tag):
+    # A JSON value recorded in a tag on the root of an optimized maze (empty if there isn't one)
+    if root.isEmpty() or not root.hasTag(tag):
+        return {}
+    return json.loads(root.getTag(tag))
+
+
+def track_parameters(trackConfig):
+    # Global track dimensions (with defaults) - (trackLength, wallHeight, wallDistance)
+    return (trackConfig.get('TrackLength', 240),
+            trackConfig.get('WallHeight', 20),
+            trackConfig.get('WallDistance', 24)) # Ideally this is equal to the screen distances on the sides
+
+
+def maze_texture_files(trackConfig):
+    # Every texture file that building trackConfig will load (procedural textures aren't files)
+    textures = []
+    if trackConfig.get('EnableBackgroundTexture', True):
+        textures.append(BACKGROUND_TEXTURE)
+    for feature in (trackConfig.get('TrackFeatures', None) or {}).values():
+        if 'Texture' in feature and not is_procedural(feature['Texture']):
+            textures.append(feature['Texture'])
+    return textures
+
+
+def display_tessellation_error(display_config):
+    # The angle subtended by TessellationErrorPixels (default 1) pixels at the center of the view
+    #   with the finest pixels, for a display config (see main.py for the defaults)
+    n_views = display_config.get('NViews', 1)
+    window_width = display_config.get('WindowSize', (640, 480))[0]
+    regions = display_config.get('DisplayRegions', [[0, 1, 0, 1]] * n_views)
+    sizes = display_config.get('MonitorSizes', [[51, 29]] * n_views)
+    distances = display_config.get('MonitorDistances', [24] * n_views)
+    pixels_per_radian = max(window_width * (region[1] - region[0]) / size[0] * distance
+                            for region, size, distance in zip(regions, sizes, distances))
+    return display_config.get('TessellationErrorPixels', 1) / pixels_per_radian
+
+
+def cylinder_divisions(feature, radius, distance, tessellation_error):
+    # The feature's Divisions if it has them, otherwise enough for a cylinder which the mouse
+    #   gets within distance of (the camera is always on the track, at x = 0)
+    if 'Divisions' in feature:
+        return feature['Divisions']
+    return cylinderDivisions(radius, max(distance, MIN_VIEW_DISTANCE), tessellation_error)
+
+
+def make_feature_geom_node(featureName, feature, wallDistance, wallHeight, trackVPos=0,
+                           tessellation_error=DEFAULT_TESSELLATION_ERROR):
+    # Build the GeomNode for one entry of TrackFeatures.
+    color = feature.get('Color', [0.5, 0.5, 0.5])
+    texScale = feature.get('TextureScaling', 1.0)
+    snode = GeomNode(featureName)
+    alpha = feature.get('Alpha', 1.0)
+
+    if feature.get('Type') == 'Wall':
+        length = feature['Bounds'][1] - feature['Bounds'][0]
+        center = (feature['Bounds'][1] + feature['Bounds'][0])/2
+        x_offset = feature.get('XOffset', 0)
+
+        if feature.get('XLocation', 'Both').lower() in ['right', 'both']:
+            right = makePlane(wallDistance + x_offset, center, trackVPos + wallHeight/2,
+                                        length, wallHeight, facing="Left", color=color, alpha=alpha,
+                                        texHScaling=length/wallHeight*texScale, texVScaling=texScale)
+            snode.addGeom(right)
+        if feature.get('XLocation', 'Both').lower() in ['left', 'both']:
+            left = makePlane(-wallDistance - x_offset, center, trackVPos + wallHeight/2,
+                                        length, wallHeight, facing="Right", color=color, alpha=alpha,
+                                        texHScaling=length/wallHeight*texScale, texVScaling=texScale)
+            snode.addGeom(left)
+
+    elif feature.get('Type') == 'Plane':
+        width = feature.get('Width')
+        height = feature.get('Height')
+        plane = makePlane(feature.get('XPos', 0), feature.get('YPos', 0), feature.get('ZPos', 0),
+                                        width, feature.get('Height'), facing=feature.get('Facing'),
+                                        color=color, alpha=alpha,
+                                        texHScaling=width/height*texScale, texVScaling=texScale)
+        snode.addGeom(plane)
+
+    elif feature.get('Type') == 'WallCylinder':
+        h = feature.get('Height',wallHeight*3)
+        r = feature.get('Radius',5)
+        divisions = cylinder_divisions(feature, r, wallDistance - r, tessellation_error)
+
+        if feature.get('XLocation', 'Both').lower() in ['left', 'both']:
+            cylinder = makeCylinder(-wallDistance, feature.get('YPos'),
+                                                trackVPos, r, h, num_divisions=divisions, color=color, texHScaling=texScale,
+                                                texVScaling=texScale * (math.pi * 2 * r) / h, alpha=alpha)
+            snode.addGeom(cylinder)
+
+        if feature.get('XLocation', 'Both').lower() in ['right', 'both']:
+            cylinder = makeCylinder(wallDistance, feature.get('YPos'),
+                                                trackVPos, r, h, num_divisions=divisions, color=color, texHScaling=texScale,
+                                                texVScaling=texScale * (math.pi * 2 * r) / h, alpha=alpha)
+            snode.addGeom(cylinder)
+
+    elif feature.get('Type') == 'Cylinder':
+        h = feature.get('Height',wallHeight*3)
+        r = feature.get('Radius',5)
+        if (feature.get('Facing') or 'outward').lower() == 'inward':
+            distance = r - abs(feature.get('XPos')) # (seen from inside)
+        else:
+            distance = abs(feature.get('XPos')) - r
+        cylinder = makeCylinder(feature.get('XPos'), feature.get('YPos'),
+                                            feature.get('ZPos', trackVPos), r, h,
+                                            num_divisions=cylinder_divisions(feature, r, distance, tessellation_error),
+                                            facing=feature.get('Facing','outward'),
+                                            color=color, texHScaling=texScale,
+                                            texVScaling=texScale * (math.pi * 2 * r) / h,
+                                            alpha=alpha)
+        snode.addGeom(cylinder)
+
+    return snode
+
+
+def apply_feature_state(node, feature):
+    # Render state (transparency and texture) for a feature's NodePath
+    if feature.get('Alpha', 1.0) < 1.0:
+        node.setTransparency(TransparencyAttrib.MAlpha)
+
+    if 'Texture' in feature:
+        tex = load_texture(feature['Texture'])
+        node.setTexture(tex)
+        if 'RotateTexture' in feature:
+            node.setTexRotate(TextureStage.getDefault(), feature['RotateTexture'])
+
+
+def build_feature_node(featureName, feature, wallDistance, wallHeight, trackVPos=0,
+                       tessellation_error=DEFAULT_TESSELLATION_ERROR):
+    # A detached NodePath with the geometry and render state for one of the TrackFeatures
+    node = NodePath(make_feature_geom_node(featureName, feature, wallDistance, wallHeight, trackVPos,
+                                           tessellation_error))
+    apply_feature_state(node, feature)
+    return node
+
+
+REPEAT_AXES = {'x': 0, 'y': 1, 'z': 2}
+
+def repeat_feature(node, feature):
+    # For a feature with a Repeat, a detached NodePath holding Count instances of node, spaced
+    #   Spacing apart along Axis (the geometry is shared, not copied). Otherwise just node.
+    repeat = feature.get('Repeat', None)
+    if not repeat:
+        return node
+    axis = REPEAT_AXES[repeat.get('Axis', 'Y').lower()]
+    repeats = NodePath(node.getName() + '_repeats')
+    for i in range(repeat.get('Count', 1)):
+        offset = [0, 0, 0]
+        offset[axis] = i * repeat.get('Spacing', 0)
+        placement = repeats.attachNewNode('{}_{}'.format(node.getName(), i))
+        placement.setPos(*offset)
+        node.instanceTo(placement)
+    return repeats
+
+
+def count_geoms(root):
+    # (number of GeomNodes, number of Geoms) under root. Each Geom is at least one draw call.
+    geom_nodes = root.findAllMatches('**/+GeomNode')
+    if root.node().isGeomNode():
+        geom_nodes.addPath(root)
+    return geom_nodes.getNumPaths(), sum(p.node().getNumGeoms() for p in geom_nodes)
+
+
+def optimize_maze(root):
+    """ optimize_maze(): reduce the number of draw calls needed to render a built maze
+
+        Each feature is built as its own GeomNode (with its own texture, transparency, etc.),
+        and repeated features are instances of one node. Draw calls, rather than
+        vertices, are what limit our frame rate on the Pi, so we bake transforms, texture
+        matrices and colors into the vertices and merge everything that shares a render
+        state into a single Geom. Returns ((GeomNodes, Geoms) before, (GeomNodes, Geoms) after).
+    """
+    before = count_geoms(root)
+    root.flattenStrong()
+    after = count_geoms(root)
+    root.setTag('OptimizationStats', '{} {} {} {}'.format(*before, *after))
+    return before, after
+
+
+def build_maze(trackConfig, trackVPos=0, roomSize=750, optimize=True, tessellation_error=DEFAULT_TESSELLATION_ERROR):
+    """ build_maze(): build the geometry for a maze described by a (YAML-derived) dictionary
+
+        Returns a MazeModel whose root is not attached to anything. See maze_schema.yaml for
+        the format of trackConfig. If there are no TrackFeatures, default gray walls are drawn.
+        Unless optimize is False, the result is flattened with optimize_maze(). If the maze
+        has a Paging section, features are instead built as they are needed (see MazePaging).
+        Cylinders are tessellated to within tessellation_error (see cylinderDivisions()).
+    """
+    trackFeatures = trackConfig.get('TrackFeatures', None) or {}
+    if trackConfig.get('Paging', None) and trackFeatures:
+        from MazePaging import build_paged_maze # (MazePaging builds on this module)
+        return build_paged_maze(trackConfig, trackVPos, roomSize, optimize, tessellation_error)
+    _, wallHeight, wallDistance = track_parameters(trackConfig)
+
+    feature_nodes = {featureName: build_feature_node(featureName, feature, wallDistance, wallHeight, trackVPos,
+                                                     tessellation_error)
+                        for featureName, feature in trackFeatures.items()}
+
+    return assemble_maze(trackConfig, feature_nodes, trackVPos, roomSize, optimize, tessellation_error)
+
+
+# Changing any of these means every feature has to be rebuilt
+GLOBAL_MAZE_KEYS = ('TrackLength', 'WallHeight', 'WallDistance', 'EnableBackgroundTexture', 'Paging')
+# Feature fields which only affect where a feature goes, or its texture (not its geometry)
+PLACEMENT_KEYS = ('DuplicateForward',)
+TEXTURE_KEYS = ('Texture', 'RotateTexture')
+
+def update_maze(model, trackConfig, trackVPos=0, roomSize=750, optimize=True, tessellation_error=DEFAULT_TESSELLATION_ERROR):
+    """ update_maze(): build a maze by modifying a previously built one
+
+        Features are matched by name. Unchanged features (and ones which were only moved in
+        or out of the forward duplicate) are reused, features whose texture changed are
+        retextured, and everything else that is new or different is rebuilt. Only the merge
+        groups (see assemble_maze()) with a changed feature in them are flattened again; the
+        rest, and the room, are shared with model. This works for mazes loaded from the .bam
+        cache too (the feature nodes a rebuilt group needs are built then). Returns a new
+        MazeModel (model is not modified), or None if a full rebuild is needed (the global
+        track dimensions changed, or the maze is paged).
+    """
+    if model is None or model.pager or trackConfig.get('Paging', None):
+        return None
+    if any(model.config.get(key) != trackConfig.get(key) for key in GLOBAL_MAZE_KEYS):
+        return None
+
+    _, wallHeight, wallDistance = track_parameters(trackConfig)
+    old_features = model.config.get('TrackFeatures', None) or {}
+    trackFeatures = trackConfig.get('TrackFeatures', None) or {}
+
+    nodes_touched = len(set(old_features) - set(trackFeatures)) # removed features
+    feature_nodes = {}
+    unchanged = set()
+    for featureName, feature in trackFeatures.items():
+        old_feature = old_features.get(featureName, None)
+        old_node = model.feature_nodes.get(featureName, None) # (None if it hasn't been built since a cache load)
+        if old_feature is None:
+            changed_keys = None
+        else:
+            changed_keys = {k for k in set(feature) | set(old_feature) if feature.get(k) != old_feature.get(k)}
+
+        if changed_keys is not None and changed_keys <= set(PLACEMENT_KEYS):
+            if not changed_keys:
+                unchanged.add(featureName)
+            if old_node is not None:
+                feature_nodes[featureName] = old_node
+            continue
+
+        nodes_touched += 1
+        if changed_keys is not None and changed_keys <= set(PLACEMENT_KEYS + TEXTURE_KEYS) and old_node is not None:
+            # Share the geometry, but give the copy a fresh render state
+            node = NodePath(old_node.node().makeCopy())
+            node.node().setState(RenderState.makeEmpty())
+            apply_feature_state(node, feature)
+            feature_nodes[featureName] = node
+        else:
+            feature_nodes[featureName] = build_feature_node(featureName, feature, wallDistance, wallHeight, trackVPos,
+                                                            tessellation_error)
+
+    new_model = assemble_maze(trackConfig, feature_nodes, trackVPos, roomSize, optimize, tessellation_error,
+                              previous=model, unchanged=unchanged)
+    new_model.nodes_touched = nodes_touched
+    return new_model
+
+
+def add_room(trackConfig, root, roomSize=750, tessellation_error=DEFAULT_TESSELLATION_ERROR):
+    if trackConfig.get('EnableBackgroundTexture', True):
+        # In order to provide motion cues, we define a large cylinder to hold a background
+        # texture. The goal is that the wall of this cylinder is far enough from the mouse,
+        # and the texture it carries is complex enough that they get a dynamic motion cue
+        # but not a precise a spatial cue.
+        trackLength = track_parameters(trackConfig)[0]
+        divisions = cylinderDivisions(roomSize, max(roomSize - trackLength/2, MIN_VIEW_DISTANCE), tessellation_error)
+        room_wall_cylinder = makeCylinder(0, trackLength/2, -5*roomSize/2, roomSize, 10*roomSize,
+                                          num_divisions=divisions, facing="inward", texHScaling=12, texVScaling=12, color=[1.0, 1.0, 1.0])
+        snode = GeomNode('room_walls')
+        snode.addGeom(room_wall_cylinder)
+        room_walls = root.attachNewNode(snode)
+        room_walls.setTexture(load_texture(BACKGROUND_TEXTURE))
+        # walls_node.setTwoSided(True)
+
+
+def texture_key(tex):
+    # What identifies a texture in a merge group key (atlases and procedural textures have no file)
+    if tex is None:
+        return None
+    return tex.getName() if is_atlas_name(tex.getName()) else tex.getFilename().toOsSpecific()
+
+
+def merge_group_key(feature, node):
+    # Features with the same key end up with the same render state once they're flattened (the
+    #   texture transform and colors are baked into the vertices), so they can be merged
+    return json.dumps([feature.get('DuplicateForward', True), texture_key(node.getTexture()),
+                       feature.get('Alpha', 1.0) < 1.0])
+
+
+def assemble_maze(trackConfig, feature_nodes, trackVPos=0, roomSize=750, optimize=True,
+                  tessellation_error=DEFAULT_TESSELLATION_ERROR, previous=None, unchanged=()):
+    """ assemble_maze(): put the room, the features, and the forward duplicate of the track together under a new root
+
+        feature_nodes are copied (so the originals stay reusable). Any that are missing are
+        built here. When the maze is optimized, the features' textures are packed into atlases
+        (see TextureAtlas.py), and features which can then share a render state are put into a
+        "merge group" (a ModelNode), which is flattened into as few Geoms as possible. Groups
+        are recorded in tags (which survive the .bam cache), so that when previous (the
+        MazeModel this is an update of) has a group with the same features, none of which
+        changed (the ones in unchanged), it is simply shared rather than built again.
+    """
+    trackLength, wallHeight, wallDistance = track_parameters(trackConfig)
+    trackFeatures = trackConfig.get('TrackFeatures', None)
+
+    def feature_node(featureName):
+        if featureName not in feature_nodes:
+            feature_nodes[featureName] = build_feature_node(featureName, trackFeatures[featureName], wallDistance,
+                                                            wallHeight, trackVPos, tessellation_error)
+        return feature_nodes[featureName]
+
+    # (A new NodePath, since the renderer may remove the previous maze while this one is being built)
+    previous_root = NodePath(previous.root) if previous else NodePath()
+
+    maze_geometry_root = NodePath(GeomNode("maze_root_node"))
+    old_room = previous_root.find('room_walls') if not previous_root.isEmpty() else NodePath()
+    if not old_room.isEmpty():
+        old_room.copyTo(maze_geometry_root) # (the room only depends on the global track parameters)
+    else:
+        add_room(trackConfig, maze_geometry_root, roomSize, tessellation_error)
+
+    # trackLength, trackWidth, wallDistance all could be parametric, but I think most likely these wouldn't need to change often
+    # (A ModelNode, so that flattening keeps it as a separate node which the forward copy can instance)
+    track_parent = maze_geometry_root.attachNewNode(ModelNode('MazeParent'))
+    track_parent.node().setPreserveTransform(ModelNode.PTLocal)
+
+    prepared_nodes = {}
+    if trackFeatures and optimize:
+        old_groups = merge_groups(previous_root)
+        old_keys = {name: key for key, (_, names) in old_groups.items() for name in names}
+        old_atlas_textures = root_record(previous_root, 'AtlasTextures')
+        reusable = {name for name in unchanged if name in old_keys and name in old_atlas_textures}
+
+        # Which features' textures can go into an atlas (as found when they were last built, if
+        #   they haven't changed), and how the atlases are laid out
+        atlas_textures = {}
+        candidates = {}
+        for featureName in trackFeatures:
+            if featureName in reusable:
+                atlas_textures[featureName] = old_atlas_textures[featureName]
+            else:
+                prepared_nodes[featureName] = feature_node(featureName).copyTo(NodePath())
+                candidates[featureName] = atlas_candidate(prepared_nodes[featureName])
+                atlas_textures[featureName] = candidates[featureName][0] if candidates[featureName] else None
+        textures = {name for name in atlas_textures.values() if name}
+        placement = plan_placement(textures) if trackConfig.get('TextureAtlas', True) else {}
+        # (a feature whose texture moved to a different atlas has to be done again)
+        old_placement = root_record(previous_root, 'AtlasPlacement')
+        for featureName in [name for name in reusable if placement.get(atlas_textures[name]) != old_placement.get(atlas_textures[name])]:
+            reusable.discard(featureName)
+            prepared_nodes[featureName] = feature_node(featureName).copyTo(NodePath())
+            candidates[featureName] = atlas_candidate(prepared_nodes[featureName])
+
+        for featureName, candidate in candidates.items():
+            if candidate is not None and candidate[0] in placement:
+                apply_atlas(prepared_nodes[featureName], candidate, placement[candidate[0]])
+
+        def prepared_node(featureName):
+            # The feature's node as it goes into its merge group: a copy, on its atlas if it has one
+            if featureName not in prepared_nodes:
+                if featureName in previous.prepared_nodes:
+                    prepared_nodes[featureName] = previous.prepared_nodes[featureName]
+                else: # (a maze from the cache)
+                    node = feature_node(featureName).copyTo(NodePath())
+                    candidate = atlas_candidate(node)
+                    if candidate is not None and candidate[0] in placement:
+                        apply_atlas(node, candidate, placement[candidate[0]])
+                    prepared_nodes[featureName] = node
+            return prepared_nodes[featureName]
+
+        groups = {} # key -> [feature names], in TrackFeatures order
+        for featureName, feature in trackFeatures.items():
+            key = old_keys[featureName] if featureName in reusable else merge_group_key(feature, prepared_nodes[featureName])
+            groups.setdefault(key, []).append(featureName)
+
+        before = after = count_geoms(maze_geometry_root)
+        for key, names in groups.items():
+            parent = track_parent if json.loads(key)[0] else maze_geometry_root
+            old_group = old_groups.get(key, None)
+            if old_group and old_group[1] == names and all(name in reusable for name in names):
+                group = old_group[0].copyTo(parent) # (shares the flattened Geoms)
+                prepared_nodes.update({name: previous.prepared_nodes[name] for name in names if name in previous.prepared_nodes})
+            else:
+                group = parent.attachNewNode(ModelNode('MergeGroup'))
+                for name in names:
+                    if trackFeatures[name].get('Repeat', None):
+                        repeat_feature(prepared_node(name).copyTo(NodePath()), trackFeatures[name]).reparentTo(group)
+                    else:
+                        prepared_node(name).copyTo(group)
+                group.setTag('MergeGroup', key)
+                group.setTag('Features', json.dumps(names))
+                group.setTag('Unflattened', '{} {}'.format(*count_geoms(group)))
+                group.flattenStrong()
+            unflattened = [int(c) for c in group.getTag('Unflattened').split()]
+            before = (before[0] + unflattened[0], before[1] + unflattened[1])
+            after = tuple(a + b for a, b in zip(after, count_geoms(group)))
+
+        maze_geometry_root.setTag('OptimizationStats', '{} {} {} {}'.format(*before, *after))
+        maze_geometry_root.setTag('AtlasTextures', json.dumps(atlas_textures))
+        maze_geometry_root.setTag('AtlasPlacement', json.dumps(placement))
+        if trackConfig.get('TextureAtlas', True):
+            bound = [json.loads(key)[1] for key, names in groups.items() for _ in names if json.loads(key)[1]]
+            maze_geometry_root.setTag('AtlasStats', json.dumps({
+                'Textures': len(textures), 'Atlases': len(set(placement.values())),
+                'Features': sum(1 for name in bound if is_atlas_name(name)),
+                'Fallback': sum(1 for name in bound if not is_atlas_name(name)),
+                'DrawCalls': [len(textures), len({placement.get(name, name) for name in textures})]}))
+
+    elif trackFeatures:
+        for featureName, feature in trackFeatures.items():
+            parent = track_parent if feature.get('DuplicateForward', True) else maze_geometry_root
+            if feature.get('Repeat', None):
+                # Copied once (so the original stays reusable by update_maze()), then instanced
+                repeat_feature(feature_node(featureName).copyTo(NodePath()), feature).reparentTo(parent)
+            else:
+                feature_node(featureName).copyTo(parent)
+
+        # BIG TODO - add in sgments of default color featureless wall between the labeled sections.
+        #          - we can do this in the YAML file, but it seems cleaner to have it done automatically.
+        #          - need a function to (1) check that bounds never overlap, and (2) find residual
+        #            segment boundaries
+
+    else:
+        # Default walls - light gray. Height could be parametric. These will fill any unspecified gaps
+        snode = GeomNode('default_walls')
+        right = makePlane(wallDistance, trackLength/2, trackVPos + wallHeight/2,
+                                        trackLength, wallHeight, facing="left", color=[0.5, 0.5, 0.5],
+                                        texHScaling=trackLength/wallHeight)
+        snode.addGeom(right)
+        left = makePlane(-wallDistance, trackLength/2, trackVPos + wallHeight/2,
+                                        trackLength, wallHeight, facing="right", color=[0.5, 0.5, 0.5],
+                                        texHScaling=trackLength/wallHeight)
+        snode.addGeom(left)
+        track_parent.attachNewNode(snode)
+        if optimize:
+            optimize_maze(maze_geometry_root)
+
+    # Make a copy of the walls and floor at the end of the maze. This makes it look like it goes on further.
+    #   It's an instance of the track, so the geometry isn't duplicated.
+    node = GeomNode('track_copy')
+    maze_geometry_copy_parent = maze_geometry_root.attachNewNode(node)
+    track_parent.instanceTo(maze_geometry_copy_parent)
+    maze_geometry_copy_parent.setPos(0, trackLength, 0)
+
+    return MazeModel(trackConfig, maze_geometry_root, trackLength, wallHeight, wallDistance, feature_nodes, prepared_nodes)
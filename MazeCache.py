@@ -0,0 +1,194 @@
+# Core imports
+from panda3d.core import NodePath, Texture, Filename, Loader, LoaderOptions
+
+# Utilities
+import os
+import json
+import hashlib
+import threading
+import argparse
+import yaml
+
+# Local code
+from MazeBuilder import (MazeModel, DEFAULT_TESSELLATION_ERROR, build_maze, track_parameters, maze_texture_files,
+                         display_tessellation_error)
+from TextureManager import load_texture
+from TextureAtlas import atlas_texture, is_atlas_name
+
+# Bump this whenever MazeBuilder/ParametricShapes change what gets built for a given config.
+#   It is part of the cache key, so old .bam files just stop being used (and age out).
+CACHE_FORMAT_VERSION = 8
+
+
+class MazeCache:
+    """ MazeCache: on-disk cache of built mazes, stored as Panda3D .bam files
+
+        Files are content addressed - the name is a hash of the maze config (canonicalized),
+        the builder parameters, and the contents of every texture file the maze uses. Editing
+        a maze or a texture therefore results in a new entry rather than a stale one. The
+        total size of the cache directory is bounded, with least-recently-used entries
+        evicted first (we touch a file's mtime whenever it is loaded).
+    """
+    def __init__(self, directory='maze_cache', max_size_mb=256):
+        self.directory = directory
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        os.makedirs(self.directory, exist_ok=True)
+        self.texture_digests = {} # (path, mtime, size) -> sha256, so that textures are only read once
+        self.lock = threading.Lock()
+
+    def texture_digest(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return 'missing'
+        key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+        if key not in self.texture_digests:
+            with open(path, 'rb') as f:
+                self.texture_digests[key] = hashlib.sha256(f.read()).hexdigest()
+        return self.texture_digests[key]
+
+    def key(self, maze_config, trackVPos=0, roomSize=750, optimize=True, tessellation_error=DEFAULT_TESSELLATION_ERROR):
+        description = {
+            'Version': CACHE_FORMAT_VERSION,
+            'MazeConfig': maze_config,
+            'TrackVPos': trackVPos,
+            'RoomSize': roomSize,
+            'Optimize': optimize,
+            'TessellationError': tessellation_error,
+            'Textures': {t: self.texture_digest(t) for t in maze_texture_files(maze_config)},
+        }
+        canonical = json.dumps(description, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.directory, key + '.bam')
+
+    def load(self, key):
+        # Returns a NodePath for a cached maze, or None on a miss.
+        path = self.filename(key)
+        if not os.path.exists(path):
+            return None
+        options = LoaderOptions(LoaderOptions.LF_no_cache | LoaderOptions.LF_report_errors)
+        node = Loader.getGlobalPtr().loadSync(Filename.fromOsSpecific(os.path.abspath(path)), options)
+        if node is None:
+            print('Failed to read cached maze {}'.format(path))
+            return None
+        try:
+            os.utime(path) # mark as recently used
+        except OSError:
+            pass # (another renderer process evicted it meanwhile - we have it already)
+        root = NodePath(node)
+        # Swap the placeholders written by store() for the real (shared) textures. Texture
+        #   atlases are named after what's in them, so they can be put back together.
+        for placeholder in root.findAllTextures():
+            name = placeholder.getName()
+            root.replaceTexture(placeholder, atlas_texture(name)[0] if is_atlas_name(name) else load_texture(name))
+        return root
+
+    def store(self, key, root):
+        path = self.filename(key)
+        tmp_path = path + '.{}.tmp'.format(os.getpid()) # (other renderer processes may be writing it too)
+        # Textures are written as empty placeholders named after the image file. Otherwise
+        #   reading the .bam would decode its own private copy of every image, rather than using
+        #   the ones already loaded by the TextureManager.
+        root = root.copyTo(NodePath())
+        for tex in root.findAllTextures():
+            placeholder = Texture(tex.getName() if is_atlas_name(tex.getName()) else tex.getFilename().toOsSpecific())
+            placeholder.setup2dTexture(1, 1, Texture.T_unsigned_byte, Texture.F_luminance)
+            placeholder.setRamImage(b'\0') # (a texture with no image or filename isn't written at all)
+            root.replaceTexture(tex, placeholder)
+        try:
+            if not root.writeBamFile(Filename.fromOsSpecific(os.path.abspath(tmp_path))):
+                raise OSError('could not write {}'.format(tmp_path))
+            os.replace(tmp_path, path) # atomic, so a reader never sees a partial file
+        except OSError as e:
+            print('Failed to write cached maze {} ({})'.format(path, e))
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+        self.evict()
+        return True
+
+    def evict(self):
+        # Drop least recently used entries until we fit in the size budget. Other renderer
+        #   processes may share the directory (and be evicting too), so entries which have
+        #   disappeared meanwhile are just skipped.
+        with self.lock:
+            entries = []
+            try:
+                names = os.listdir(self.directory)
+            except OSError as e:
+                print('Failed to read maze cache directory {} ({})'.format(self.directory, e))
+                return
+            for name in names:
+                if name.endswith('.bam'):
+                    try:
+                        st = os.stat(os.path.join(self.directory, name))
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, name))
+            entries.sort()
+            total = sum(e[1] for e in entries)
+            while entries and total > self.max_bytes:
+                _, size, name = entries.pop(0)
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+                total -= size
+
+    def load_model(self, maze_config, trackVPos=0, roomSize=750, optimize=True, tessellation_error=DEFAULT_TESSELLATION_ERROR):
+        # Returns a MazeModel from the cache, or None on a miss.
+        root = self.load(self.key(maze_config, trackVPos, roomSize, optimize, tessellation_error))
+        if root is None:
+            return None
+        return MazeModel(maze_config, root, *track_parameters(maze_config))
+
+    def store_model(self, model, trackVPos=0, roomSize=750, optimize=True, tessellation_error=DEFAULT_TESSELLATION_ERROR):
+        if model.pager:
+            return False # paged mazes are built as they're displayed - there's nothing to store
+        return self.store(self.key(model.config, trackVPos, roomSize, optimize, tessellation_error), model.root)
+
+    def load_or_build(self, maze_config, trackVPos=0, roomSize=750, optimize=True, tessellation_error=DEFAULT_TESSELLATION_ERROR):
+        # Returns (MazeModel, was_cached). Raises if the maze can't be built.
+        model = self.load_model(maze_config, trackVPos, roomSize, optimize, tessellation_error)
+        if model is not None:
+            return model, True
+        model = build_maze(maze_config, trackVPos, roomSize, optimize, tessellation_error)
+        self.store_model(model, trackVPos, roomSize, optimize, tessellation_error)
+        return model, False
+
+
+def compile_mazes(paths, cache, tessellation_error=DEFAULT_TESSELLATION_ERROR):
+    # Pre-bake every maze YAML in paths (files or directories) into the cache
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(('.yaml', '.yml')))
+        else:
+            files = [path]
+        for filename in files:
+            with open(filename, 'r') as stream:
+                maze_config = yaml.safe_load(stream)
+            try:
+                _, was_cached = cache.load_or_build(maze_config, tessellation_error=tessellation_error)
+                print('{}: {}'.format(filename, 'already cached' if was_cached else 'compiled'))
+            except Exception as e:
+                print('{}: failed ({})'.format(filename, e))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pre-compile maze YAML files into the PyRenderMaze .bam cache')
+    parser.add_argument('paths', nargs='+', help='maze YAML files or directories of them (e.g., example-mazes/)')
+    parser.add_argument('--cache-dir', default='maze_cache', help='cache directory (must match the renderer)')
+    parser.add_argument('--max-size-mb', type=float, default=256, help='size limit for the cache directory')
+    parser.add_argument('--display-config', default=None,
+                        help='display config of the renderer (cylinders are tessellated for its display)')
+    args = parser.parse_args()
+
+    tessellation_error = DEFAULT_TESSELLATION_ERROR
+    if args.display_config:
+        with open(args.display_config, 'r') as stream:
+            tessellation_error = display_tessellation_error(yaml.safe_load(stream))
+    compile_mazes(args.paths, MazeCache(args.cache_dir, args.max_size_mb), tessellation_error)
@@ -0,0 +1,178 @@
+# Core imports
+from panda3d.core import NodePath, GeomNode
+
+# Utilities
+import math
+
+# Local code
+from MazeBuilder import MazeModel, DEFAULT_TESSELLATION_ERROR, track_parameters, build_feature_node, repeat_feature, add_room
+
+# Paged mazes, for very long tracks. Rather than building the whole track (plus a copy of it
+#   at +TrackLength so it seems to continue), features are bucketed into chunks along Y, and
+#   only the features in chunks within LookBehind/LookAhead of the camera are attached to the
+#   maze. Features are built when their chunk comes within PrefetchChunks of the window and
+#   released once it is left behind. Given an executor (the renderer's model loader), the pager
+#   builds features there, and a feature which isn't built yet when its chunk comes into view
+#   is attached once it is - the render thread only attaches and removes instances. Wrap-around is handled by attaching instances of the
+#   features from the start (or end) of the track under a "lap" node shifted by +/-TrackLength,
+#   so there is never a second copy of the geometry.
+#
+#   Paging:
+#       ChunkLength: 50 # length of a chunk along Y (default TrackLength / 10)
+#       LookAhead: 200 # features this far in front of the camera are attached (default 2 * ChunkLength)
+#       LookBehind: 50 # and this far behind (default ChunkLength)
+#       PrefetchChunks: 1 # build features this many chunks ahead of the window (default 1)
+
+
+def feature_extent(feature):
+    # (y_min, y_max) covered by a feature (including its repeats), or None if we can't tell (it's then in every chunk)
+    kind = feature.get('Type')
+    if kind == 'Wall':
+        extent = min(feature['Bounds']), max(feature['Bounds'])
+    elif kind == 'Plane':
+        facing = (feature.get('Facing') or '').lower()
+        half = {'left': feature.get('Width', 0), 'right': feature.get('Width', 0), 'up': feature.get('Height', 0)}.get(facing, 0) / 2
+        extent = feature.get('YPos', 0) - half, feature.get('YPos', 0) + half
+    elif kind in ('Cylinder', 'WallCylinder'):
+        extent = feature.get('YPos', 0) - feature.get('Radius', 5), feature.get('YPos', 0) + feature.get('Radius', 5)
+    else:
+        return None
+    repeat = feature.get('Repeat', None)
+    if repeat and repeat.get('Axis', 'Y').lower() == 'y':
+        span = (repeat.get('Count', 1) - 1) * repeat.get('Spacing', 0)
+        extent = min(extent[0], extent[0] + span), max(extent[1], extent[1] + span)
+    return extent
+
+
+class MazePager:
+    """ MazePager: keeps only the features near the camera attached to a maze
+
+        update(posY) is called every frame (on the render thread) with the camera position. It
+        only does any work when the camera moves into a new chunk, or a feature it's waiting for
+        has been built. Without an executor, features are built in update() itself.
+    """
+    def __init__(self, trackConfig, root, trackVPos=0, optimize=True, tessellation_error=DEFAULT_TESSELLATION_ERROR,
+                 executor=None):
+        self.trackLength, self.wallHeight, self.wallDistance = track_parameters(trackConfig)
+        paging = trackConfig['Paging'] if isinstance(trackConfig['Paging'], dict) else {}
+        self.chunk_length = paging.get('ChunkLength', self.trackLength / 10)
+        self.look_ahead = paging.get('LookAhead', 2 * self.chunk_length)
+        self.look_behind = paging.get('LookBehind', self.chunk_length)
+        self.prefetch_chunks = paging.get('PrefetchChunks', 1)
+        self.n_chunks = max(1, int(math.ceil(self.trackLength / self.chunk_length)))
+        self.trackVPos = trackVPos
+        self.optimize = optimize
+        self.tessellation_error = tessellation_error
+
+        # Spatial index: chunk -> names of the features which overlap it
+        self.features = trackConfig['TrackFeatures']
+        self.chunks = [[] for _ in range(self.n_chunks)]
+        for featureName, feature in self.features.items():
+            extent = feature_extent(feature)
+            if extent is None:
+                first, last = 0, self.n_chunks - 1
+            else:
+                first = max(0, int(extent[0] // self.chunk_length))
+                last = min(self.n_chunks - 1, int(extent[1] // self.chunk_length))
+            for chunk in range(first, last + 1):
+                self.chunks[chunk].append(featureName)
+
+        self.root = root
+        self.laps = {} # lap number -> NodePath at lap * trackLength
+        self.nodes = {} # featureName -> built (detached) node
+        self.building = {} # featureName -> future, for features being built by the executor
+        self.executor = executor
+        self.attached = {} # (featureName, lap) -> instance under the lap node
+        self.wanted = set() # {(featureName, lap)} in the window (attached, or waiting to be built)
+        self.window = None
+
+    def lap_node(self, lap):
+        if lap not in self.laps:
+            self.laps[lap] = self.root.attachNewNode(GeomNode('lap{}'.format(lap)))
+            self.laps[lap].setPos(0, lap * self.trackLength, 0)
+        return self.laps[lap]
+
+    def build_feature(self, featureName):
+        # (runs on the executor's thread, if there is one - the node isn't attached to anything)
+        node = build_feature_node(featureName, self.features[featureName], self.wallDistance,
+                                  self.wallHeight, self.trackVPos, self.tessellation_error)
+        node = repeat_feature(node, self.features[featureName])
+        if self.optimize:
+            node.flattenStrong()
+        return node
+
+    def request_feature(self, featureName):
+        if featureName in self.nodes or featureName in self.building:
+            return
+        if self.executor is None:
+            self.nodes[featureName] = self.build_feature(featureName)
+        else:
+            self.building[featureName] = self.executor.submit(self.build_feature, featureName)
+
+    def collect_built_features(self):
+        # Returns True if any features finished building since the last call
+        done = [name for name, future in self.building.items() if future.done()]
+        for featureName in done:
+            try:
+                self.nodes[featureName] = self.building.pop(featureName).result()
+            except Exception as e:
+                print('Paged feature {} could not be built ({})'.format(featureName, e))
+                self.nodes[featureName] = NodePath(GeomNode(featureName)) # (don't keep trying)
+        return bool(done)
+
+    def features_in(self, first_chunk, last_chunk):
+        # {(featureName, lap)} for chunks first_chunk..last_chunk (which may be beyond the track)
+        features = set()
+        for chunk in range(first_chunk, last_chunk + 1):
+            lap, chunk = divmod(chunk, self.n_chunks)
+            for featureName in self.chunks[chunk]:
+                if lap == 0 or self.features[featureName].get('DuplicateForward', True):
+                    features.add((featureName, lap))
+        return features
+
+    def update(self, posY):
+        # Returns True if anything was paged in or out
+        first = int(math.floor((posY - self.look_behind) / self.chunk_length))
+        last = int(math.floor((posY + self.look_ahead) / self.chunk_length))
+        built = self.collect_built_features() if self.building else False
+        if self.window == (first, last):
+            if not built or len(self.attached) == len(self.wanted):
+                return False
+        else:
+            self.window = (first, last)
+            self.wanted = self.features_in(first, last)
+
+            # Start building the features we're about to need, and let go of the ones we've left behind
+            needed = {name for name, _ in self.wanted | self.features_in(last + 1, last + self.prefetch_chunks)}
+            for featureName in needed:
+                self.request_feature(featureName)
+            for featureName in set(self.nodes) - needed:
+                del self.nodes[featureName]
+            for featureName in set(self.building) - needed:
+                self.building.pop(featureName).cancel() # (if it's already being built, the result is dropped)
+
+        for key in set(self.attached) - self.wanted:
+            self.attached.pop(key).removeNode() # (only removes this instance)
+        for featureName, lap in self.wanted - set(self.attached):
+            if featureName in self.nodes: # (otherwise it's attached once it has been built)
+                self.attached[(featureName, lap)] = self.nodes[featureName].instanceTo(self.lap_node(lap))
+        for lap in [lap for lap, node in self.laps.items() if node.getNumChildren() == 0]:
+            self.laps.pop(lap).removeNode()
+        return True
+
+
+def build_paged_maze(trackConfig, trackVPos=0, roomSize=750, optimize=True, tessellation_error=DEFAULT_TESSELLATION_ERROR):
+    """ build_paged_maze(): like MazeBuilder.build_maze(), but the features are paged in by a MazePager
+
+        Only the room and the features at the start of the track are built here; the rest
+        appear as the pager is updated with the camera position (the renderer does this
+        every frame).
+    """
+    trackLength, wallHeight, wallDistance = track_parameters(trackConfig)
+    maze_geometry_root = NodePath(GeomNode("maze_root_node"))
+    add_room(trackConfig, maze_geometry_root, roomSize, tessellation_error)
+    model = MazeModel(trackConfig, maze_geometry_root, trackLength, wallHeight, wallDistance)
+    model.pager = MazePager(trackConfig, maze_geometry_root.attachNewNode(GeomNode('MazeParent')), trackVPos, optimize,
+                            tessellation_error)
+    model.pager.update(0) # build the start of the track now, rather than when the maze is first shown
+    return model
@@ -0,0 +1,357 @@
+# Utilities
+import time
+import itertools
+import threading
+import multiprocessing
+
+import zmq
+
+# Local code
+from CommandProtocol import ProtocolError, CommandClient, decode_message, check_request, encode_reply, error_reply
+
+# Multi-process rendering: each view (or group of views) is drawn by its own renderer process,
+#   with its own window, so that the cull/draw traversals for the views run on different cores.
+#   Enabled with ViewProcesses in display_config.yaml:
+#
+#       ViewProcesses: true # one process per view
+#       ViewProcesses: [[0], [1, 2]] # or groups of views (indices into ViewAngles, etc.)
+#
+#   The supervisor (ViewSupervisor, started by main.py) owns the command socket (CommandPort)
+#   and passes commands on to the view processes, which each run a normal App on an internal
+#   port (CommandPort + 1, + 2, ...). Each view process's window covers its views' part of
+#   WindowSize, at the same place on the screen.
+#
+#   Only the first view process (the leader) reads the position stream. Every frame, right
+#   before the cameras are set, all of the view processes meet at a barrier, and the leader's
+#   position, timestamp and frame number are handed to the others through shared memory (see
+#   FrameBarrier), so every view draws the same position on the same numbered frame. To
+#   switch mazes on the same frame everywhere, LoadModel is done as a PreloadModel in every
+#   view process, followed by an ActivateModel scheduled ViewActivationFrames (default 4)
+#   frames ahead. (Unlike a single renderer, a maze which fails to build leaves the previous
+#   maze on screen.)
+#
+#   If a view process doesn't reach the barrier within ViewBarrierTimeoutMS, the barrier
+#   breaks and each process carries on by itself (the leader still publishes its frame, so
+#   replies waiting for a frame go out). Every ViewResyncSeconds (default 10) while it's
+#   broken, the supervisor resets the barrier and the view processes meet there again on
+#   their next frame. (A view process which is still stuck makes the others wait for the
+#   timeout again.)
+
+STARTUP_TIMEOUT = 120 # s - for every view process to open its window and build its first maze
+FRAME_RECORD_SIZE = 5 # (frame, timestamp, stream_posY, posY, receive_time) - see FrameBarrier
+RESYNC_EPOCH = 2 * FRAME_RECORD_SIZE # (index in shared_frames, after the two frame records)
+SHARED_FRAMES_SIZE = RESYNC_EPOCH + 1
+PER_VIEW_KEYS = {
+    # display_config keys with one entry per view, and their defaults (as in App)
+    'ViewAngles': 0,
+    'DisplayRegions': [0, 1, 0, 1],
+    'MonitorSizes': [51, 29],
+    'MonitorDistances': 24,
+    'MonitorOffsets': [0, 0],
+}
+
+
+def view_groups(display_config):
+    # [[view indices] for each view process] from ViewProcesses (None if it isn't set)
+    groups = display_config.get('ViewProcesses', None)
+    if not groups:
+        return None
+    if groups is True:
+        return [[n] for n in range(display_config.get('NViews', 1))]
+    return [list(group) for group in groups]
+
+
+def view_process_configs(display_config, groups):
+    # The display config for each view process: just its views, in a window covering their
+    #   display regions (which are re-expressed relative to that window)
+    n_views = display_config.get('NViews', 1)
+    per_view = {key: display_config.get(key, [default] * n_views) for key, default in PER_VIEW_KEYS.items()}
+    window_width, window_height = display_config.get('WindowSize', (640, 480))
+    origin_x, origin_y = display_config.get('WindowOrigin', (0, 0))
+    command_port = display_config.get('CommandPort', 8557)
+
+    configs = []
+    for index, views in enumerate(groups):
+        regions = [per_view['DisplayRegions'][v] for v in views]
+        left, right = min(r[0] for r in regions), max(r[1] for r in regions)
+        bottom, top = min(r[2] for r in regions), max(r[3] for r in regions)
+        config = dict(display_config)
+        config.pop('ViewProcesses')
+        config.update({key: [values[v] for v in views] for key, values in per_view.items()})
+        config['NViews'] = len(views)
+        config['DisplayRegions'] = [[(r[0] - left) / (right - left), (r[1] - left) / (right - left),
+                                     (r[2] - bottom) / (top - bottom), (r[3] - bottom) / (top - bottom)] for r in regions]
+        config['WindowSize'] = [round(window_width * (right - left)), round(window_height * (top - bottom))]
+        config['WindowOrigin'] = [origin_x + round(window_width * left), origin_y + round(window_height * (1 - top))]
+        config['CommandAddress'] = 'tcp://127.0.0.1:{}'.format(command_port + 1 + index)
+        if index > 0: # (only the leader reports on the position stream, and draws and logs the sync squares)
+            config['TelemetryAddress'] = None
+            config['LatchReportFrames'] = 0
+            config['FrameSynchronization'] = False
+        configs.append(config)
+    return configs
+
+
+class FrameBarrier:
+    """ FrameBarrier: keeps the view processes on the same frame, drawing the same position
+
+        exchange() is called by every view process once per frame. The leader's (frame,
+        timestamp, stream_posY, posY, receive_time) is written to shared memory before it waits, and every
+        process returns it once all of them have arrived. The record is double buffered (by
+        frame parity), so the leader can't overwrite it before the others have read it. If a
+        process doesn't arrive within timeout seconds (e.g., it died), the barrier is broken and
+        each process carries on with its own values (the leader still writes its record) until
+        the supervisor resets the barrier, which it announces by bumping the epoch in shared
+        memory. Every process then starts over from the first slot.
+    """
+    def __init__(self, barrier, shared_frames, leader, timeout=1.0):
+        self.barrier = barrier
+        self.shared_frames = shared_frames # multiprocessing.RawArray('d', SHARED_FRAMES_SIZE)
+        self.leader = leader
+        self.timeout = timeout
+        self.n = 0
+        self.epoch = 0
+        self.broken = False
+
+    def exchange(self, frame, timestamp, stream_posY, posY, receive_time):
+        epoch = int(self.shared_frames[RESYNC_EPOCH])
+        if epoch != self.epoch: # (the barrier has been reset, even if we didn't notice it was broken)
+            self.epoch, self.n = epoch, 0
+            if self.broken:
+                print('Resynchronizing with the other view processes')
+            self.broken = False
+        slot = FRAME_RECORD_SIZE * (self.n % 2)
+        if self.leader:
+            self.shared_frames[slot:slot + FRAME_RECORD_SIZE] = [frame, timestamp, stream_posY, posY, receive_time]
+        if self.broken:
+            return frame, timestamp, stream_posY, posY, receive_time
+        try:
+            self.barrier.wait(self.timeout)
+        except threading.BrokenBarrierError:
+            print('View processes are no longer synchronized (one stopped responding)')
+            self.broken = True
+            return frame, timestamp, stream_posY, posY, receive_time
+        self.n += 1
+        frame, timestamp, stream_posY, posY, receive_time = self.shared_frames[slot:slot + FRAME_RECORD_SIZE]
+        return int(frame), int(timestamp), stream_posY, posY, receive_time
+
+
+def latest_frame(shared_frames):
+    return int(max(shared_frames[0], shared_frames[FRAME_RECORD_SIZE]))
+
+
+def run_view_process(display_config, barrier, shared_frames, leader, headless=False):
+    # Entry point for a view process (spawned by ViewSupervisor)
+    import main
+    if headless:
+        main.configure_headless()
+    main.configure_window(display_config, fullscreen=False)
+    app = main.App(display_config=display_config)
+    app.frame_barrier = FrameBarrier(barrier, shared_frames, leader, display_config.get('ViewBarrierTimeoutMS', 1000) / 1000)
+    barrier.wait(STARTUP_TIMEOUT) # start drawing together
+    app.run()
+
+
+def merge_replies(replies):
+    # One reply for the controller: the first view process's if they all agree on the status,
+    #   otherwise the first one that disagrees (with everybody's status in "ViewStatuses")
+    statuses = [reply['Status'] for reply in replies]
+    for reply in replies:
+        if reply['Status'] != statuses[0]:
+            return dict(reply, ViewStatuses=statuses)
+    return replies[0]
+
+
+class ViewSupervisor:
+    """ ViewSupervisor: starts the view processes and relays commands to them
+
+        run() serves the command socket until Exit (or until a view process stops, in which
+        case the others are stopped too). It returns the exit status for the program.
+    """
+    def __init__(self, display_config, headless=False):
+        self.groups = view_groups(display_config)
+        self.configs = view_process_configs(display_config, self.groups)
+        self.activation_frames = display_config.get('ViewActivationFrames', 4)
+        self.resync_interval = display_config.get('ViewResyncSeconds', 10)
+        self.resync_time = None # when to reset the barrier, once it's broken
+
+        mp_context = multiprocessing.get_context('spawn') # (Panda3D state can't be forked)
+        self.barrier = mp_context.Barrier(len(self.groups)) # (must outlive the view processes' startup)
+        self.shared_frames = mp_context.RawArray('d', SHARED_FRAMES_SIZE)
+        self.processes = [mp_context.Process(target=run_view_process, name='View{}'.format(index),
+                                             args=(config, self.barrier, self.shared_frames, index == 0, headless))
+                            for index, config in enumerate(self.configs)]
+        for process in self.processes:
+            process.start()
+
+        self.context = zmq.Context.instance()
+        self.command_socket = self.context.socket(zmq.ROUTER)
+        self.command_socket.bind("tcp://*:%s" % display_config.get('CommandPort', 8557))
+        self.clients = [CommandClient(self.context, config['CommandAddress']) for config in self.configs]
+
+        self.pending = {} # (view process, request ID) -> fan out (see fan_out())
+        self.load_ids = itertools.count(1)
+        self.loads_in_progress = 0
+        self.loaded_model_id = None
+        self.model_status = 'ModelLoaded'
+        self.model_status_fields = {}
+        self.exiting = False
+        self.frame_waits = [] # (frame, function) - called once the view processes reach frame
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self.command_socket, zmq.POLLIN)
+        for client in self.clients:
+            poller.register(client.socket, zmq.POLLIN)
+        exit_status = 0
+        while True:
+            events = dict(poller.poll(5 if self.frame_waits else 100))
+            if self.command_socket in events:
+                while True:
+                    try:
+                        frames = self.command_socket.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    self.handle_command(frames[:-1], frames[-1])
+            for index, client in enumerate(self.clients):
+                if client.socket in events:
+                    while True:
+                        try:
+                            request_id, _, body = client.recv(zmq.NOBLOCK)
+                        except zmq.Again:
+                            break
+                        self.handle_reply(index, request_id, body)
+            if self.barrier.broken:
+                self.resync_views()
+            if self.frame_waits:
+                frame = latest_frame(self.shared_frames)
+                for wait in [w for w in self.frame_waits if w[0] <= frame]:
+                    self.frame_waits.remove(wait)
+                    wait[1]()
+            if self.exiting and not any(process.is_alive() for process in self.processes):
+                break
+            if not self.exiting and not all(process.is_alive() for process in self.processes):
+                print('A view process stopped - shutting down')
+                exit_status = 1
+                break
+        self.shutdown()
+        return exit_status
+
+    def resync_views(self):
+        # Reset the (broken) frame barrier every resync_interval seconds, so the view processes
+        #   meet there again (see FrameBarrier)
+        now = time.monotonic()
+        if self.resync_time is None:
+            self.resync_time = now + self.resync_interval
+        elif now >= self.resync_time:
+            self.barrier.reset()
+            self.shared_frames[RESYNC_EPOCH] += 1
+            self.resync_time = None
+
+    def shutdown(self):
+        for process in self.processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        for client in self.clients:
+            client.close()
+        self.command_socket.close(linger=1000) # (so the reply to Exit gets out)
+
+    def fan_out(self, command, fields, on_done, processes=None):
+        # Send a command to the view processes (all of them by default). Once they have all
+        #   replied, on_done() is called with the replies (in view process order).
+        processes = list(range(len(self.clients))) if processes is None else processes
+        fanout = {'processes': processes, 'replies': {}, 'on_done': on_done}
+        for index in processes:
+            request_id = self.clients[index].send(command, **fields)
+            self.pending[(index, request_id)] = fanout
+
+    def handle_reply(self, index, request_id, body):
+        fanout = self.pending.pop((index, request_id), None)
+        if fanout is None:
+            return
+        fanout['replies'][index] = body
+        if len(fanout['replies']) == len(fanout['processes']):
+            fanout['on_done']([fanout['replies'][i] for i in fanout['processes']])
+
+    def send_reply(self, reply_to, command, reply):
+        envelope, request_id = reply_to
+        reply = dict(reply)
+        status = reply.pop('Status')
+        self.command_socket.send_multipart(envelope + [encode_reply(request_id, command, status, **reply)])
+
+    def handle_command(self, envelope, frame):
+        try:
+            request_id, command, msg = decode_message(frame)
+            check_request(command, msg)
+        except ProtocolError as e:
+            print('Bad command message: {}'.format(e))
+            self.command_socket.send_multipart(envelope + [error_reply(frame, e)])
+            return
+        reply_to = (envelope, request_id)
+
+        if command == 'LoadModel':
+            self.load_model(msg, reply_to)
+        elif command == 'QueryModelStatus' and 'ModelID' not in msg:
+            self.send_reply(reply_to, command, dict(self.model_status_fields, Status=self.model_status))
+        elif command == 'ActivateModel':
+            fields = dict(msg, AtFrame=msg.get('AtFrame', latest_frame(self.shared_frames) + self.activation_frames))
+            def activated(replies):
+                reply = merge_replies(replies)
+                if reply['Status'] == 'ModelActivated': # (reply once it's on screen, as a single renderer does)
+                    self.frame_waits.append((reply['Frame'], lambda: self.send_reply(reply_to, command, reply)))
+                else:
+                    self.send_reply(reply_to, command, reply)
+            self.fan_out(command, fields, activated)
+        elif command == 'UpdateDataServer':
+            # Only the leader reads the position stream (the others get the position from it)
+            self.fan_out(command, msg, lambda replies: self.send_reply(reply_to, command, replies[0]), processes=[0])
+        elif command == 'Exit':
+            # (The view processes exit as they reply, so we don't wait for all of them)
+            self.fan_out(command, msg, lambda replies: None)
+            self.send_reply(reply_to, command, {'Status': 'Exiting'})
+            self.exiting = True
+        else:
+            self.fan_out(command, msg, lambda replies: self.send_reply(reply_to, command, merge_replies(replies)))
+
+    def load_model(self, msg, reply_to):
+        # PreloadModel everywhere, then ActivateModel on the same (future) frame everywhere
+        model_id = '_LoadModel{}'.format(next(self.load_ids))
+        fields = {key: msg[key] for key in ('MazeConfig', 'MazeHash') if key in msg} or {'MazeConfig': {}}
+        self.loads_in_progress += 1
+        self.model_status, self.model_status_fields = 'ModelLoading', {}
+
+        def finish(status, **reply_fields):
+            self.loads_in_progress -= 1
+            if not self.loads_in_progress:
+                self.model_status, self.model_status_fields = status, reply_fields
+            self.send_reply(reply_to, 'LoadModel', dict(reply_fields, Status=status))
+
+        def evict():
+            # (some view processes may have the model even if others failed)
+            self.fan_out('EvictModel', {'ModelID': model_id}, lambda replies: None)
+
+        def preloaded(replies):
+            reply = merge_replies(replies)
+            if reply['Status'] == 'ModelNotCached':
+                evict()
+                finish('ModelNotCached', MazeHash=reply['MazeHash'])
+            elif reply['Status'] != 'ModelPreloaded':
+                evict()
+                finish('ModelFailure')
+            else:
+                at_frame = latest_frame(self.shared_frames) + self.activation_frames
+                self.fan_out('ActivateModel', {'ModelID': model_id, 'AtFrame': at_frame}, activated)
+
+        def activated(replies):
+            reply = merge_replies(replies)
+            if reply['Status'] != 'ModelActivated':
+                evict()
+                finish('ModelFailure')
+                return
+            if self.loaded_model_id: # (it stays on screen until the new one is activated)
+                self.fan_out('EvictModel', {'ModelID': self.loaded_model_id}, lambda replies: None)
+            self.loaded_model_id = model_id
+            self.frame_waits.append((reply['Frame'], lambda: finish('ModelLoaded', Frame=reply['Frame'])))
+
+        self.fan_out('PreloadModel', dict(fields, ModelID=model_id), preloaded)
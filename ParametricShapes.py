@@ -1,9 +1,19 @@
 # Core imports
-from panda3d.core import Geom, GeomVertexFormat, GeomVertexData, GeomVertexWriter, GeomTristrips
+from panda3d.core import Geom, GeomVertexFormat, GeomVertexData, GeomVertexWriter, GeomTristrips, PTA_int
 import math
+import functools
+import numpy as np
 
-# helper function to make a vertical cylinder given center, radius, and height
-def makePlane(cx, cy, cz, width, height, facing="left", color=[0.25, 0.25, 0.25], 
+# One row of GeomVertexFormat.getV3n3cpt2(), as a NumPy structured type. The color is a packed
+#   uint32 (Panda3D's "packed_dabc"), i.e., the bytes are B, G, R, A in memory.
+VERTEX_DTYPE = np.dtype([('vertex', '<f4', (3,)), ('normal', '<f4', (3,)),
+                         ('color', '<u4'), ('texcoord', '<f4', (2,))])
+
+# Per-vertex (GeomVertexWriter) reference implementations. These are much slower than the
+#   array-based versions below, but are kept for comparison (see benchmark_shapes.py).
+
+# helper function to make a plane given center, size, and facing direction
+def makePlaneVertexWriter(cx, cy, cz, width, height, facing="left", color=[0.25, 0.25, 0.25], 
               texHScaling=1.0, texVScaling=1.0, alpha=1.0):
     format = GeomVertexFormat.getV3n3cpt2()
     vdata = GeomVertexData('plane', format, Geom.UHDynamic)
@@ -98,7 +108,7 @@ def makePlane(cx, cy, cz, width, height, facing="left", color=[0.25, 0.25, 0.25]
 
 
 # helper function to make a vertical cylinder given center, radius, and height
-def makeCylinder(cx, cy, cz, radius, height, num_divisions=20, facing="outward",
+def makeCylinderVertexWriter(cx, cy, cz, radius, height, num_divisions=20, facing="outward",
                  texHScaling=1.0, texVScaling=1.0, color=[0.25, 0.25, 0.25],
                  alpha=1.0):
 
@@ -122,7 +132,7 @@ def makeCylinder(cx, cy, cz, radius, height, num_divisions=20, facing="outward",
             vertex.addData3(cx + radius*math.cos(th), cy + radius*math.sin(th), cz - height/2)
             vertex.addData3(cx + radius*math.cos(th), cy + radius*math.sin(th), cz + height/2)
         else:
-            raise(ValueError("Cylinder facing direction unknown. ({})".forward(facing)))
+            raise(ValueError("Cylinder facing direction unknown. ({})".format(facing)))
 
 
         vertexNormals.addData3(cx + radius*math.cos(th), cy + radius*math.sin(th), 0)
@@ -141,3 +151,148 @@ def makeCylinder(cx, cy, cz, radius, height, num_divisions=20, facing="outward",
     cylinder = Geom(vdata)
     cylinder.addPrimitive(tris)
     return cylinder
+
+
+# ----------------------------------------------------------------------------------------------
+# Array-based geometry builders. All of the vertex attributes for a shape are computed at once
+#   into a VERTEX_DTYPE array, and then copied into the GeomVertexData in one bulk write. The
+#   *Vertices() functions return just the arrays, so that many shapes can be packed into a single
+#   Geom with makeGeom().
+
+FACING_NORMALS = {'front': (0, -1, 0), 'left': (-1, 0, 0), 'right': (1, 0, 0), 'up': (0, 0, 1)}
+
+def packColor(color, alpha=1.0):
+    # Pack an rgb triple + alpha the way Panda3D does (truncating to 8 bits per channel)
+    r, g, b = (min(max(int(c * 255), 0), 255) for c in color)
+    a = min(max(int(alpha * 255), 0), 255)
+    return (a << 24) | (r << 16) | (g << 8) | b
+
+
+def planeVertices(cx, cy, cz, width, height, facing="left", color=[0.25, 0.25, 0.25],
+                  texHScaling=1.0, texVScaling=1.0, alpha=1.0):
+    # Same vertex ordering as makePlaneVertexWriter() (see the picture there).
+    w_2 = width/2
+    h_2 = height/2
+    facing = facing.lower()
+    if facing == "front":
+        corners = [(cx - w_2, cy, cz - h_2), (cx + w_2, cy, cz - h_2), (cx - w_2, cy, cz + h_2), (cx + w_2, cy, cz + h_2)]
+    elif facing == "left":
+        corners = [(cx, cy + w_2, cz - h_2), (cx, cy - w_2, cz - h_2), (cx, cy + w_2, cz + h_2), (cx, cy - w_2, cz + h_2)]
+    elif facing == "right":
+        corners = [(cx, cy - w_2, cz - h_2), (cx, cy + w_2, cz - h_2), (cx, cy - w_2, cz + h_2), (cx, cy + w_2, cz + h_2)]
+    elif facing == "up":
+        corners = [(cx - w_2, cy - h_2, cz), (cx + w_2, cy - h_2, cz), (cx - w_2, cy + h_2, cz), (cx + w_2, cy + h_2, cz)]
+    else:
+        raise(ValueError("Unknown facing parameter: {}".format(facing)))
+
+    vertices = np.empty(4, dtype=VERTEX_DTYPE)
+    vertices['vertex'] = corners
+    vertices['normal'] = FACING_NORMALS[facing]
+    vertices['color'] = packColor(color, alpha)
+    vertices['texcoord'] = [(0.0, 0.0), (texHScaling, 0.0), (0.0, texVScaling), (texHScaling, texVScaling)]
+    return vertices
+
+
+@functools.lru_cache(maxsize=None)
+def unitCircle(num_divisions):
+    # cos/sin table for num_divisions steps around a circle, closed by repeating the first point.
+    #   Shared by every cylinder with the same number of divisions.
+    theta = 2 * np.pi * np.arange(num_divisions + 1) / num_divisions
+    theta[-1] = 0
+    table = np.stack([np.cos(theta), np.sin(theta)], axis=1)
+    table.flags.writeable = False
+    return table
+
+
+@functools.lru_cache(maxsize=None)
+def cylinderDivisions(radius, distance, max_angular_error, min_divisions=8, max_divisions=256):
+    # Number of divisions for a cylinder seen from (at closest) distance, so that its outline is
+    #   within max_angular_error (radians, as seen by the viewer) of a true circle. A chord across
+    #   one division falls short of the circle by radius * (1 - cos(pi / n)). Rounded up to a
+    #   multiple of 4, so that similar cylinders share unitCircle() tables.
+    max_deviation = max_angular_error * distance
+    if radius <= 0 or max_deviation >= radius:
+        return min_divisions
+    n = math.ceil(math.pi / math.acos(1 - max_deviation / radius))
+    return min(max(4 * math.ceil(n / 4), min_divisions), max_divisions)
+
+
+def cylinderVertices(cx, cy, cz, radius, height, num_divisions=20, facing="outward",
+                     texHScaling=1.0, texVScaling=1.0, color=[0.25, 0.25, 0.25],
+                     alpha=1.0):
+    # Same vertex ordering as makeCylinderVertexWriter(): a top/bottom (or bottom/top) pair per division.
+    if facing.lower()=="outward":
+        z = (cz + height/2, cz - height/2)
+    elif facing.lower()=="inward":
+        z = (cz - height/2, cz + height/2)
+    else:
+        raise(ValueError("Cylinder facing direction unknown. ({})".format(facing)))
+
+    circle = unitCircle(num_divisions)
+    xy = np.repeat(circle * radius + (cx, cy), 2, axis=0)
+    vertices = np.empty(2 * (num_divisions + 1), dtype=VERTEX_DTYPE)
+    vertices['vertex'][:, :2] = xy
+    vertices['vertex'][:, 2] = np.tile(z, num_divisions + 1)
+    vertices['normal'][:, :2] = xy
+    vertices['normal'][:, 2] = 0
+    vertices['color'] = packColor(color, alpha)
+    vertices['texcoord'][:, 0] = np.repeat(np.arange(num_divisions + 1) / num_divisions * texHScaling, 2)
+    vertices['texcoord'][:, 1] = np.tile((1.0 * texVScaling, 0.0), num_divisions + 1)
+    return vertices
+
+
+def makeGeom(vertex_arrays, name='shapes', usage=Geom.UHStatic):
+    # Maze geometry never changes once it is built, so it defaults to static (lets the driver
+    #   keep it in GPU memory).
+    # Pack a list of vertex arrays (one triangle strip each) into a single Geom
+    if isinstance(vertex_arrays, np.ndarray):
+        vertex_arrays = [vertex_arrays]
+    vertices = np.concatenate(vertex_arrays) if len(vertex_arrays) > 1 else vertex_arrays[0]
+
+    vdata = GeomVertexData(name, GeomVertexFormat.getV3n3cpt2(), usage)
+    vdata.uncleanSetNumRows(len(vertices))
+    buffer = np.asarray(memoryview(vdata.modifyArray(0)).cast('B'))
+    buffer[:] = vertices.view(np.uint8)
+
+    tris = GeomTristrips(usage)
+    if len(vertex_arrays) == 1:
+        tris.addConsecutiveVertices(0, len(vertices))
+        tris.closePrimitive() # an unclosed strip can't be merged by flattenStrong()
+    else:
+        # Build the index column directly. This reproduces what closePrimitive() does: strips are
+        #   joined by repeating the last vertex of one and the first of the next, and the ends
+        #   array marks where each strip stops.
+        pieces = []
+        ends = PTA_int.emptyArray(len(vertex_arrays))
+        n_indices = 0
+        start = 0
+        for k, v in enumerate(vertex_arrays):
+            if k > 0:
+                pieces.append([start - 1, start])
+                n_indices += 2
+            pieces.append(np.arange(start, start + len(v)))
+            n_indices += len(v)
+            ends[k] = n_indices
+            start += len(v)
+        tris.setIndexType(Geom.NT_uint32)
+        index = tris.modifyVertices()
+        index.uncleanSetNumRows(n_indices)
+        np.asarray(memoryview(index).cast('B'))[:] = np.concatenate(pieces).astype('<u4').view(np.uint8)
+        tris.setEnds(ends)
+
+    geom = Geom(vdata)
+    geom.addPrimitive(tris)
+    return geom
+
+
+def makePlane(cx, cy, cz, width, height, facing="left", color=[0.25, 0.25, 0.25],
+              texHScaling=1.0, texVScaling=1.0, alpha=1.0):
+    return makeGeom(planeVertices(cx, cy, cz, width, height, facing, color,
+                                  texHScaling, texVScaling, alpha), 'plane')
+
+
+def makeCylinder(cx, cy, cz, radius, height, num_divisions=20, facing="outward",
+                 texHScaling=1.0, texVScaling=1.0, color=[0.25, 0.25, 0.25],
+                 alpha=1.0):
+    return makeGeom(cylinderVertices(cx, cy, cz, radius, height, num_divisions, facing,
+                                     texHScaling, texVScaling, color, alpha), 'cylinder')
@@ -0,0 +1,220 @@
+# Utilities
+import csv
+import math
+import argparse
+from collections import deque
+
+import numpy as np
+
+# The image the animal sees is displayed some time after the newest position sample arrived
+#   (the rest of the frame, plus waiting for the flip). Predictors estimate where the animal
+#   will be at that time, from the timestamped samples in the position stream.
+#
+#   Samples are given to update() as they arrive (on the position receiver thread), and the
+#   render loop calls predict() with the local time (time.perf_counter()) at which the frame
+#   is expected to reach the screen. The predictor state is replaced as a single tuple, so
+#   predict() never sees a half-updated state.
+#
+#   Positions wrap around at the end of the track. If track_length is set, differences
+#   between samples are unwrapped, and predictions are wrapped back into [0, track_length).
+#   (The renderer only sets it for predictors that extrapolate.)
+
+
+class PositionPredictor:
+    """ PositionPredictor: no prediction - always the newest sample's position
+
+        Also the base class for the other predictors. timestamp_units is the number of seconds
+        per tick of the stream's timestamps, which are only used to measure velocity (the clock
+        they come from isn't comparable with ours). Jumps faster than max_speed (position units
+        per second, e.g., a teleport) restart the velocity estimate.
+    """
+    extrapolates = False # (the position is passed through untouched, so it isn't wrapped either)
+
+    def __init__(self, timestamp_units=1e-3, track_length=None, max_speed=500.0):
+        self.timestamp_units = timestamp_units
+        self.track_length = track_length
+        self.max_speed = max_speed
+        self.reset()
+
+    def reset(self):
+        self._previous = None # (source time in seconds, raw position) of the previous sample
+        self._state = None # (position, velocity, local receive time)
+
+    def source_time(self, timestamp):
+        # Seconds, unwrapping the uint32 timestamp counter
+        if self._previous is None:
+            return timestamp * self.timestamp_units
+        t_previous = self._previous[0]
+        ticks = (timestamp - round(t_previous / self.timestamp_units)) % (1 << 32)
+        return t_previous + ticks * self.timestamp_units
+
+    def displacement(self, pos, previous_pos):
+        delta = pos - previous_pos
+        if self.track_length:
+            delta = (delta + self.track_length / 2) % self.track_length - self.track_length / 2
+        return delta
+
+    def update(self, timestamp, pos, receive_time):
+        t = self.source_time(timestamp)
+        if self._previous is None:
+            self.restart(t, pos, receive_time)
+        else:
+            dt = t - self._previous[0]
+            delta = self.displacement(pos, self._previous[1])
+            if dt <= 0 or abs(delta) > self.max_speed * dt:
+                self.restart(t, pos, receive_time)
+            else:
+                self.step(t, dt, pos, delta, receive_time)
+        self._previous = (t, pos)
+
+    def restart(self, t, pos, receive_time):
+        self._state = (pos, 0.0, receive_time)
+
+    def step(self, t, dt, pos, delta, receive_time):
+        self._state = (pos, 0.0, receive_time)
+
+    def predict(self, t):
+        """ Position at local time t, or None if there haven't been any samples. """
+        state = self._state
+        if state is None:
+            return None
+        pos, velocity, receive_time = state
+        pos = pos + velocity * max(0.0, t - receive_time)
+        if self.track_length:
+            pos = pos % self.track_length
+        return pos
+
+
+class ConstantVelocityPredictor(PositionPredictor):
+    """ ConstantVelocityPredictor: extrapolate with the average velocity over the last window samples """
+    extrapolates = True
+
+    def __init__(self, window=8, **kwargs):
+        self.window = window
+        PositionPredictor.__init__(self, **kwargs)
+
+    def restart(self, t, pos, receive_time):
+        self._history = deque([(t, 0.0)], maxlen=self.window) # (source time, unwrapped position)
+        self._state = (pos, 0.0, receive_time)
+
+    def step(self, t, dt, pos, delta, receive_time):
+        self._history.append((t, self._history[-1][1] + delta))
+        (t0, x0), (t1, x1) = self._history[0], self._history[-1]
+        self._state = (pos, (x1 - x0) / (t1 - t0), receive_time)
+
+
+class AlphaBetaPredictor(PositionPredictor):
+    """ AlphaBetaPredictor: alpha-beta filter (a steady state Kalman filter for constant velocity)
+
+        Larger alpha/beta follow changes in speed faster; smaller ones smooth out encoder noise.
+    """
+    extrapolates = True
+
+    def __init__(self, alpha=0.5, beta=0.1, **kwargs):
+        self.alpha = alpha
+        self.beta = beta
+        PositionPredictor.__init__(self, **kwargs)
+
+    def restart(self, t, pos, receive_time):
+        self._filter = (pos, 0.0) # (filtered position, velocity)
+        self._state = (pos, 0.0, receive_time)
+
+    def step(self, t, dt, pos, delta, receive_time):
+        x, v = self._filter
+        x_predicted = x + v * dt
+        residual = self.displacement(pos, x_predicted)
+        x = x_predicted + self.alpha * residual
+        v = v + self.beta / dt * residual
+        if self.track_length:
+            x = x % self.track_length
+        self._filter = (x, v)
+        self._state = (x, v, receive_time)
+
+
+PREDICTORS = {
+    'none': PositionPredictor,
+    'constant_velocity': ConstantVelocityPredictor,
+    'alpha_beta': AlphaBetaPredictor,
+}
+
+def make_predictor(name='none', **kwargs):
+    if name not in PREDICTORS:
+        raise ValueError('Unknown position predictor {} (expected one of {})'.format(name, ', '.join(PREDICTORS)))
+    return PREDICTORS[name](**kwargs)
+
+
+TRACE_COLUMNS = (('timestamp',), ('posY', 'position')) # column names (FrameLog.py --csv, Telemetry.py --save)
+
+def trace_column(names, filename, i):
+    column = next((n for n in names if n in TRACE_COLUMNS[i]), None)
+    if column is None:
+        raise ValueError('{} has no {} column'.format(filename, ' or '.join(TRACE_COLUMNS[i])))
+    return column
+
+def load_trace(filename):
+    # A recorded trace is (timestamp, position) rows: a .npy array, or a CSV (e.g., an exported
+    #   frame log). If the columns are named (a CSV header or a structured array), they're found
+    #   by name; otherwise they're the first two.
+    if filename.endswith('.npy'):
+        data = np.load(filename)
+        if data.dtype.names:
+            return tuple(data[trace_column(data.dtype.names, filename, i)].astype(float) for i in range(2))
+    else:
+        with open(filename, 'r') as f:
+            rows = [row for row in csv.reader(f) if row]
+        columns = [0, 1]
+        try:
+            float(rows[0][0])
+        except ValueError:
+            header = [name.strip() for name in rows.pop(0)]
+            columns = [header.index(trace_column(header, filename, i)) for i in range(2)]
+        data = np.array([[float(row[c]) for c in columns] for row in rows])
+    return data[:, 0], data[:, 1]
+
+
+def evaluate(predictor, timestamps, positions, horizon, timestamp_units=1e-3, track_length=None):
+    # Replay a trace (pretending that samples arrive exactly at their timestamps), predict each
+    #   sample's position horizon seconds ahead, and compare with the (interpolated) trace.
+    #   Returns the array of errors.
+    t = (timestamps - timestamps[0]) * timestamp_units
+    x = positions.astype(float)
+    if track_length:
+        x = x[0] + np.concatenate([[0], np.cumsum((np.diff(x) + track_length / 2) % track_length - track_length / 2)])
+    errors = []
+    for i in range(len(t)):
+        predictor.update(int(timestamps[i]), float(positions[i]), t[i])
+        if t[i] + horizon > t[-1]:
+            break
+        predicted = predictor.predict(t[i] + horizon)
+        error = predicted - np.interp(t[i] + horizon, t, x)
+        if track_length:
+            error = (error + track_length / 2) % track_length - track_length / 2
+        errors.append(error)
+    return np.array(errors)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Evaluate position predictors on a recorded (timestamp, position) trace')
+    parser.add_argument('trace', help='.npy array or CSV file with timestamp and position columns')
+    parser.add_argument('--horizon-ms', type=float, nargs='+', default=[8, 16, 33, 50], help='prediction horizons')
+    parser.add_argument('--timestamp-units', type=float, default=1e-3, help='seconds per timestamp tick')
+    parser.add_argument('--track-length', type=float, default=None, help='positions wrap at this value')
+    parser.add_argument('--alpha', type=float, default=0.5)
+    parser.add_argument('--beta', type=float, default=0.1)
+    parser.add_argument('--window', type=int, default=8)
+    args = parser.parse_args()
+
+    timestamps, positions = load_trace(args.trace)
+    common = dict(timestamp_units=args.timestamp_units, track_length=args.track_length)
+    predictors = {
+        'none': lambda: PositionPredictor(**common),
+        'constant_velocity': lambda: ConstantVelocityPredictor(window=args.window, **common),
+        'alpha_beta': lambda: AlphaBetaPredictor(alpha=args.alpha, beta=args.beta, **common),
+    }
+    print('{} samples over {:.1f} s'.format(len(timestamps), (timestamps[-1] - timestamps[0]) * args.timestamp_units))
+    print('{:>10s} {:>18s} {:>10s} {:>10s} {:>10s} {:>10s}'.format('horizon', 'predictor', 'rms', 'mean abs', 'p95 abs', 'max abs'))
+    for horizon_ms in args.horizon_ms:
+        for name, predictor in predictors.items():
+            errors = np.abs(evaluate(predictor(), timestamps, positions, horizon_ms / 1000, **common))
+            print('{:>8.1f}ms {:>18s} {:10.4f} {:10.4f} {:10.4f} {:10.4f}'.format(horizon_ms, name,
+                math.sqrt(np.mean(errors ** 2)), np.mean(errors), np.percentile(errors, 95), np.max(errors)))
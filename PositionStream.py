@@ -0,0 +1,265 @@
+# Utilities
+import os
+import zmq
+import mmap
+import struct
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+# Position samples are streamed as a little-endian (uint32 timestamp, float64 position) pair.
+POSITION_MESSAGE_FORMAT = '<Ld'
+
+# Same-host transport (addresses of the form shm://name): a ring of samples in a file in
+#   /dev/shm, which the writer (e.g., send_position_stream.py) appends to and any number of
+#   renderers read from, without a socket or a thread in between. The file is HEADER followed
+#   by n_slots SHM_SAMPLE_DTYPE records. The writer sets a record's sequence to 2n+1 while it
+#   writes sample n, then stores the whole record (with sequence 2n+2), and only then advances
+#   the head (the number of samples written) in the header.
+#
+#   There are no memory barriers here (Python has none to offer), so another core may see
+#   these stores in a different order - on ARM (e.g., a Raspberry Pi), the head can arrive
+#   before the record, or a record half old and half new. Each record therefore also carries
+#   a check word, a hash of its other fields. A reader keeps a copied record only if its
+#   sequence is 2n+2 and its check word matches, so it never uses a torn or overwritten
+#   sample. One which isn't complete yet (as seen from the reader's core) is read again on
+#   the next call, and one which has been overwritten is skipped.
+#   write_time is the writer's time.perf_counter() (CLOCK_MONOTONIC on Linux, so it's
+#   comparable between processes) and is used as the sample's receive time.
+SHM_MAGIC = b'PRMSHM02'
+SHM_HEADER = struct.Struct('<8sIIQ') # magic, record size, number of slots, head
+SHM_HEAD_OFFSET = 16
+SHM_SAMPLE_DTYPE = np.dtype([('sequence', '<u8'), ('timestamp', '<u4'), ('pad', '<u4'),
+                             ('posY', '<f8'), ('write_time', '<f8'), ('check', '<u8')])
+
+
+def record_check(records):
+    # The check word for SHM_SAMPLE_DTYPE records (a 64 bit hash of the other fields)
+    words = [records['sequence'], records['timestamp'].astype(np.uint64),
+             np.ascontiguousarray(records['posY']).view(np.uint64),
+             np.ascontiguousarray(records['write_time']).view(np.uint64)]
+    h = np.full(len(records), 0x9E3779B97F4A7C15, dtype=np.uint64)
+    for word in words:
+        h = (h ^ word) * np.uint64(0xBF58476D1CE4E5B9)
+        h ^= h >> np.uint64(31)
+    return h
+
+
+def shm_path(address):
+    # shm://name -> /dev/shm/name (or the temp directory, where there's no /dev/shm)
+    name = address[len('shm://'):] if address.startswith('shm://') else address
+    if not name or '/' in name:
+        raise ValueError('Bad shared memory address {}'.format(address))
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, name)
+
+
+class SharedMemoryPositionWriter:
+    """ SharedMemoryPositionWriter: the single producer for an shm:// position stream
+
+        Creates (or replaces) the ring file. Readers which had the old file open notice the
+        new one within a second of it going quiet.
+    """
+    def __init__(self, address, n_slots=1024):
+        self.path = shm_path(address)
+        self.n_slots = n_slots
+        size = SHM_HEADER.size + n_slots * SHM_SAMPLE_DTYPE.itemsize
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w+b') as f:
+            f.truncate(size)
+            self.map = mmap.mmap(f.fileno(), size)
+        SHM_HEADER.pack_into(self.map, 0, SHM_MAGIC, SHM_SAMPLE_DTYPE.itemsize, n_slots, 0)
+        os.replace(tmp_path, self.path) # (readers never see a file without a header)
+        self.samples = np.frombuffer(self.map, dtype=SHM_SAMPLE_DTYPE, count=n_slots, offset=SHM_HEADER.size)
+        self.head = np.frombuffer(self.map, dtype='<u8', count=1, offset=SHM_HEAD_OFFSET)
+        self.n = 0
+
+    def write(self, timestamp, posY, write_time=None):
+        record = np.zeros(1, dtype=SHM_SAMPLE_DTYPE)
+        record['sequence'] = 2 * self.n + 2
+        record['timestamp'] = timestamp
+        record['posY'] = posY
+        record['write_time'] = time.perf_counter() if write_time is None else write_time
+        record['check'] = record_check(record)
+        slot = self.n % self.n_slots
+        self.samples['sequence'][slot] = 2 * self.n + 1
+        self.samples[slot] = record[0]
+        self.n += 1
+        self.head[0] = self.n
+
+    def close(self, unlink=True):
+        del self.samples, self.head # (the map can't be closed while arrays refer to it)
+        self.map.close()
+        if unlink:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class ZMQPositionReceiver(threading.Thread):
+    """ ZMQPositionReceiver: background thread which subscribes to a position PUB/SUB stream
+
+        Position data servers typically stream at 500 Hz or more, while we only render at the
+        display refresh rate. Rather than draining the socket on the render thread, this thread
+        receives every sample as it arrives and keeps only the newest one in a "latest value"
+        slot. The render loop then calls latest() once per frame, which never blocks. If a
+        predictor is given, every sample is also passed to its update() (on this thread).
+    """
+    poll_timeout = 100 # ms - how often we check whether we've been asked to stop
+
+    def __init__(self, address, context=None, predictor=None):
+        threading.Thread.__init__(self, name='ZMQPositionReceiver', daemon=True)
+        self.address = address
+        self.predictor = predictor
+        self.context = context if context else zmq.Context.instance()
+        self.socket = self.context.socket(zmq.SUB)
+        try:
+            self.socket.connect(address) # will raise if the address is malformed
+        except:
+            self.socket.close(linger=0)
+            raise
+        self.socket.setsockopt(zmq.SUBSCRIBE, b"")
+
+        self.n_samples = 0 # number of samples received (including ones that were superceded)
+        self._latest = None # (timestamp, posY, local receive time) - replaced as a single tuple
+        self._running = True
+
+    def run(self):
+        # NOTE: After start(), the socket is only touched from this thread.
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        while self._running:
+            if not poller.poll(timeout=self.poll_timeout):
+                continue
+            # Drain everything that is queued - only the newest sample matters.
+            while True:
+                try:
+                    msg = self.socket.recv(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                self.handle_message(msg, time.perf_counter())
+        self.socket.close(linger=0)
+
+    def handle_message(self, msg, receive_time):
+        try:
+            timestamp, posY = struct.unpack(POSITION_MESSAGE_FORMAT, msg)
+        except struct.error:
+            print('Malformed position message ({} bytes)'.format(len(msg)))
+            return
+        self.n_samples += 1
+        if self.predictor:
+            self.predictor.update(timestamp, posY, receive_time)
+        self._latest = (timestamp, posY, receive_time)
+
+    def latest(self):
+        """ Returns the newest (timestamp, posY, receive_time) tuple, or None if nothing has arrived yet. """
+        return self._latest
+
+    def stop(self):
+        self._running = False
+        if self.is_alive():
+            self.join()
+        else:
+            self.socket.close(linger=0)
+
+
+class SharedMemoryPositionReceiver:
+    """ SharedMemoryPositionReceiver: reads an shm:// position stream (see above)
+
+        Has the same interface as ZMQPositionReceiver, but there is no thread: latest() reads
+        the ring directly (through a NumPy view of the mapped file), on the render thread.
+        Samples written since the last call are passed to the predictor in order, so it sees
+        every sample, as with the socket (unless more than n_slots arrived in between).
+    """
+    reopen_interval = 1.0 # s - if nothing new arrives for this long, check whether the writer restarted
+
+    def __init__(self, address, context=None, predictor=None):
+        self.address = address
+        self.path = shm_path(address)
+        self.predictor = predictor
+        self.n_samples = 0
+        self._latest = None
+        self.map = None
+        self.next = 0
+        self.open() # will raise if there's no writer
+
+    def open(self):
+        with open(self.path, 'rb') as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, record_size, self.n_slots, head = SHM_HEADER.unpack_from(self.map, 0)
+        if magic != SHM_MAGIC or record_size != SHM_SAMPLE_DTYPE.itemsize:
+            self.map.close()
+            raise ValueError('{} is not a position stream'.format(self.path))
+        self.samples = np.frombuffer(self.map, dtype=SHM_SAMPLE_DTYPE, count=self.n_slots, offset=SHM_HEADER.size)
+        self.head = np.frombuffer(self.map, dtype='<u8', count=1, offset=SHM_HEAD_OFFSET)
+        self.next = max(int(head) - 1, 0) # (start from the newest sample)
+        self.last_new_sample = time.perf_counter()
+
+    def start(self):
+        pass # (nothing runs in the background)
+
+    def is_alive(self):
+        return self.map is not None
+
+    def latest(self):
+        """ Returns the newest (timestamp, posY, receive_time) tuple, or None if nothing has arrived yet. """
+        head = int(self.head[0]) if self.map is not None else self.next
+        if head > self.next:
+            n = np.arange(max(self.next, head - self.n_slots), head, dtype=np.uint64)
+            new_samples = self.samples[n % self.n_slots] # (a copy)
+            # Keep the complete ones (see above). If one isn't complete yet, it and the ones after
+            #   it are read again next time.
+            complete = (new_samples['sequence'] == 2 * n + 2) & (new_samples['check'] == record_check(new_samples))
+            waiting = ~complete & (new_samples['sequence'] <= 2 * n + 2) # (rather than overwritten)
+            if waiting.any():
+                first_waiting = int(np.argmax(waiting))
+                head = int(n[first_waiting])
+                new_samples, complete = new_samples[:first_waiting], complete[:first_waiting]
+            new_samples = new_samples[complete]
+            if len(new_samples):
+                self.n_samples += len(new_samples)
+                samples = list(zip(new_samples['timestamp'].tolist(), new_samples['posY'].tolist(),
+                                   new_samples['write_time'].tolist()))
+                if self.predictor:
+                    for sample in samples:
+                        self.predictor.update(*sample)
+                self._latest = samples[-1]
+            self.next = head
+            self.last_new_sample = time.perf_counter()
+        elif time.perf_counter() - self.last_new_sample > self.reopen_interval:
+            self.last_new_sample = time.perf_counter()
+            self.reopen_if_replaced()
+        return self._latest
+
+    def reopen_if_replaced(self):
+        # (If the writer is gone, we keep the last sample until it comes back)
+        try:
+            if self.map is not None and os.stat(self.path).st_ino == self.inode:
+                return
+        except OSError:
+            return
+        self.close()
+        try:
+            self.open()
+        except (OSError, ValueError):
+            pass
+
+    def stop(self):
+        self.close()
+
+    def close(self):
+        if self.map is not None:
+            del self.samples, self.head
+            self.map.close()
+            self.map = None
+
+
+def make_position_receiver(address, context=None, predictor=None):
+    # shm://name for a same-host writer, otherwise a ZMQ address (e.g., tcp://host:port)
+    if address.startswith('shm://'):
+        return SharedMemoryPositionReceiver(address, context, predictor)
+    return ZMQPositionReceiver(address, context, predictor)
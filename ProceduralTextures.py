@@ -0,0 +1,193 @@
+# Core imports
+from panda3d.core import Texture, SamplerState, Filename
+
+# Utilities
+import os
+import json
+import hashlib
+import numpy as np
+
+# Procedural textures. Rather than a PNG file, a feature's Texture can be the parameters of a
+#   pattern, which is generated (with numpy) when the maze is built and handed straight to
+#   Panda3D, without being encoded or decoded as an image file:
+#
+#   Texture: {Procedural: grating, Period: 64, Orientation: 45, Size: 512}
+#
+#   Sizes and periods are in texels. Every pattern repeats seamlessly across the texture (an
+#   oriented grating has its period and orientation adjusted slightly, so that it fits a whole
+#   number of cycles across the texture in each direction), so TextureScaling tiles them as
+#   usual. Gray patterns can be given a Color (e.g., [0, 1, 0] for green); the two alpha
+#   blended patterns (gaussian, raised_sine) are RGBA as they were in textures/GenerateTextures.ipynb.
+#
+#   Textures are shared by name (the parameters, with defaults filled in) through the
+#   TextureManager, and are also cached on disk as .txo files, so each variant is only ever
+#   generated once.
+
+PROCEDURAL_PREFIX = 'procedural:' # texture names, which record the parameters (see procedural_name())
+PROCEDURAL_VERSION = 2 # bump when a pattern changes, so textures cached on disk aren't reused
+
+DEFAULT_PARAMETERS = {
+    'grating': {'Size': 256, 'Period': None, 'Orientation': 0, 'Phase': 0, 'Contrast': 1.0, 'Waveform': 'sine',
+                'Color': None},
+    'checkerboard': {'Size': 256, 'Period': None, 'Contrast': 1.0, 'Color': None},
+    'whitenoise': {'Size': 256, 'Grain': 1, 'Seed': 0, 'Contrast': 1.0, 'Color': None},
+    'gaussian': {'Size': 256, 'Sigma': 1 / (2 * np.pi)},
+    'raised_sine': {'Size': 256},
+}
+
+
+def texture_coordinates(size):
+    # (u, v) of the texel centers, each (size, size). Rows run bottom to top, as in a Texture's RAM image.
+    t = (np.arange(size) + 0.5) / size
+    return np.meshgrid(t, t)
+
+
+def cycles(size, period):
+    # Whole number of cycles of period texels across the texture (at least 1)
+    return max(1, int(round(size / (period or size))))
+
+
+def grating(p):
+    u, v = texture_coordinates(p['Size'])
+    theta = np.radians(p['Orientation']) # 0 = the bars are vertical
+    n = p['Size'] / (p['Period'] or p['Size'])
+    ku, kv = int(round(n * np.cos(theta))), int(round(n * np.sin(theta)))
+    if ku == 0 and kv == 0:
+        ku = 1
+    phase = 2 * np.pi * (ku * u + kv * v) + np.radians(p['Phase'])
+    if p['Waveform'] == 'square':
+        wave = np.where(np.sin(phase) >= 0, 1.0, -1.0)
+    elif p['Waveform'] == 'sine':
+        wave = np.sin(phase)
+    else:
+        raise ValueError('Unknown grating Waveform {}'.format(p['Waveform']))
+    return 0.5 + 0.5 * p['Contrast'] * wave
+
+
+def checkerboard(p):
+    # Period is that of a light and a dark check (so the default has 2x2 checks, like checkerboard.png)
+    u, v = texture_coordinates(p['Size'])
+    n = cycles(p['Size'], p['Period'])
+    checks = (np.floor(2 * n * u) + np.floor(2 * n * v)) % 2
+    return 0.5 + 0.5 * p['Contrast'] * (2 * checks - 1)
+
+
+def whitenoise(p):
+    # Gaussian noise with standard deviation Contrast/2 around mid gray (clipped). Each sample
+    #   covers Grain x Grain texels.
+    grain = max(1, int(p['Grain']))
+    n = -(-p['Size'] // grain)
+    noise = np.random.default_rng(p['Seed']).standard_normal((n, n))
+    noise = np.repeat(np.repeat(noise, grain, axis=0), grain, axis=1)[:p['Size'], :p['Size']]
+    return np.clip(0.5 + 0.5 * p['Contrast'] * noise, 0, 1)
+
+
+def gaussian(p):
+    # A dark translucent blob: RGB = 0.1 * (1 - g), alpha = g, g a gaussian of width Sigma (a fraction of the texture)
+    u, v = texture_coordinates(p['Size'])
+    g = np.exp(-((u - 0.5) ** 2 + (v - 0.5) ** 2) / (2 * p['Sigma'] ** 2))
+    return np.stack([0.1 * (1 - g)] * 3 + [g], axis=-1)
+
+
+def raised_sine(p):
+    # RGB = 1 - g, alpha = g, g = sin(pi u) sin(pi v)
+    u, v = texture_coordinates(p['Size'])
+    g = np.sin(np.pi * u) * np.sin(np.pi * v)
+    return np.stack([1 - g] * 3 + [g], axis=-1)
+
+
+PATTERNS = {'grating': grating, 'checkerboard': checkerboard, 'whitenoise': whitenoise, 'gaussian': gaussian,
+            'raised_sine': raised_sine}
+
+
+def procedural_parameters(texture):
+    # The full set of parameters (defaults filled in) for a Texture entry from a maze
+    if isinstance(texture, str):
+        return json.loads(texture[len(PROCEDURAL_PREFIX):])
+    pattern = str(texture.get('Procedural', '')).lower()
+    if pattern not in DEFAULT_PARAMETERS:
+        raise ValueError('Unknown procedural texture {} (expected one of {})'.format(
+            texture.get('Procedural'), ', '.join(sorted(DEFAULT_PARAMETERS))))
+    unknown = set(texture) - set(DEFAULT_PARAMETERS[pattern]) - {'Procedural'}
+    if unknown:
+        raise ValueError('Unknown parameters for procedural texture {}: {}'.format(pattern, ', '.join(sorted(unknown))))
+    parameters = dict(DEFAULT_PARAMETERS[pattern])
+    parameters.update(texture, Procedural=pattern)
+    if not (isinstance(parameters['Size'], int) and parameters['Size'] > 0):
+        raise ValueError('Procedural texture Size must be a positive integer (got {})'.format(parameters['Size']))
+    return parameters
+
+
+def procedural_name(texture):
+    return PROCEDURAL_PREFIX + json.dumps(procedural_parameters(texture), sort_keys=True)
+
+
+def is_procedural(texture):
+    # True for a Texture entry (a dict of parameters) or texture name which is a procedural texture
+    return isinstance(texture, dict) or (isinstance(texture, str) and texture.startswith(PROCEDURAL_PREFIX))
+
+
+def make_texture(name, parameters):
+    values = PATTERNS[parameters['Procedural']](parameters)
+    color = parameters.get('Color', None)
+    if values.ndim == 2 and color is not None:
+        values = values[..., None] * np.asarray(color, dtype=np.float64)
+    pixels = np.round(np.clip(values, 0, 1) * 255).astype(np.uint8)
+    size = parameters['Size']
+    tex = Texture(name)
+    if pixels.ndim == 2:
+        tex.setup2dTexture(size, size, Texture.T_unsigned_byte, Texture.F_luminance)
+    else:
+        tex.setup2dTexture(size, size, Texture.T_unsigned_byte, Texture.F_rgba if pixels.shape[2] == 4 else Texture.F_rgb)
+        pixels = pixels[..., [2, 1, 0, 3][:pixels.shape[2]]] # (Panda3D stores BGR(A))
+    tex.setRamImage(np.ascontiguousarray(pixels).tobytes())
+    # Mipmapped like the image file textures (see TextureManager.read_texture()), in the .txo too
+    tex.generateRamMipmapImages()
+    tex.setMinfilter(SamplerState.FT_linear_mipmap_linear)
+    return tex
+
+
+# Generated textures are also cached on disk (in a new process, they're read back rather than
+#   generated again). Call set_cache_directory() (None to turn this off) before any mazes are built.
+cache_directory = 'texture_cache'
+
+def set_cache_directory(directory):
+    global cache_directory
+    cache_directory = directory
+
+
+def cache_filename(name):
+    digest = hashlib.sha256('{}:{}'.format(PROCEDURAL_VERSION, name).encode()).hexdigest()
+    return os.path.join(cache_directory, 'procedural-{}.txo'.format(digest))
+
+
+def procedural_texture(texture):
+    """ procedural_texture(): a new Texture for a procedural Texture entry (or name)
+
+        Read from a .txo file in cache_directory if it's there, otherwise generated (and
+        written there). Mazes get these through TextureManager.load_texture(), which shares
+        them by name and counts them against the texture memory budget.
+    """
+    name = procedural_name(texture)
+    tex = None
+    if cache_directory:
+        path = cache_filename(name)
+        if os.path.exists(path):
+            tex = Texture(name)
+            if not tex.read(Filename.fromOsSpecific(os.path.abspath(path))):
+                tex = None
+    if tex is None:
+        tex = make_texture(name, procedural_parameters(name))
+        if cache_directory:
+            os.makedirs(cache_directory, exist_ok=True)
+            tmp_path = path[:-len('.txo')] + '.{}.tmp.txo'.format(os.getpid()) # (other renderer processes may be reading)
+            if tex.write(Filename.fromOsSpecific(os.path.abspath(tmp_path))):
+                os.replace(tmp_path, path)
+    # Named (and "filed") after the parameters, so cached mazes and texture atlases can find it again
+    tex.setName(name)
+    tex.setFilename(Filename(name))
+    tex.setFullpath(Filename(name))
+    # There's no file to read it back from, so keep the image once it's on the GPU (texture
+    #   atlases made later need it)
+    tex.setKeepRamImage(True)
+    return tex
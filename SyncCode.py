@@ -0,0 +1,86 @@
+# Utilities
+import math
+import numpy as np
+
+# Binary codes for the sync squares. The right sync square shows one bit of a pseudorandom code
+#   per frame (the left one still alternates every frame, as a frame clock). A maximal length
+#   sequence (MLS) of B bits repeats only every 2**B - 1 frames, and any stretch of it matches
+#   itself at just one offset - so a photodiode recording can be matched back to the frame log
+#   unambiguously by cross-correlation (see align_sync.py). Gold codes (the XOR of a "preferred
+#   pair" of MLSs, one of them shifted) are a family of codes with low cross-correlation with
+#   each other, e.g., for rigs whose photodiodes may see each other's screens. They are only
+#   defined for some B, and are much shorter.
+#
+#   In display_config.yaml:
+#       SyncCode:
+#           Type: mls # or gold
+#           Bits: 20 # 2**20 - 1 frames, about 4.8 hours at 60 Hz
+#           Shift: 0 # gold: which member of the family
+
+# Feedback taps of a linear feedback shift register which produces an MLS: bit[k] is the XOR
+#   of bit[k - t] for t in the taps. (From primitive polynomials over GF(2).)
+MLS_TAPS = {
+    3: (3, 2), 4: (4, 3), 5: (5, 3), 6: (6, 5), 7: (7, 6), 8: (8, 4, 3, 2), 9: (9, 5), 10: (10, 7), 11: (11, 9),
+    12: (12, 11, 10, 4), 13: (13, 12, 11, 8), 14: (14, 13, 12, 2), 15: (15, 14), 16: (16, 15, 13, 4), 17: (17, 14),
+    18: (18, 11), 19: (19, 18, 17, 14), 20: (20, 17), 21: (21, 19), 22: (22, 21), 23: (23, 18), 24: (24, 23, 22, 17),
+}
+
+# Preferred pairs (whose MLSs have three-valued cross-correlation), which make Gold codes
+GOLD_TAPS = {
+    5: ((5, 3), (5, 4, 3, 2)), 6: ((6, 5), (6, 5, 4, 1)), 7: ((7, 4), (7, 6, 5, 4)), 9: ((9, 5), (9, 6, 5, 3)),
+    10: ((10, 7), (10, 9, 8, 7)), 11: ((11, 9), (11, 10, 8, 6)),
+}
+
+DEFAULT_SYNC_CODE = {'Type': 'mls', 'Bits': 20, 'Shift': 0}
+
+
+def lfsr_sequence(taps, length):
+    """ lfsr_sequence(): the first length bits (uint8) of the sequence from a Fibonacci LFSR
+
+        The register starts with all ones. Rather than stepping bit by bit, whole blocks of
+        bits are computed at once, using the fact that bit[k] is also the XOR of
+        bit[k - s * t] for s any power of two (squaring a polynomial over GF(2) just doubles
+        its exponents), so later blocks can be as long as the sequence so far.
+    """
+    taps = np.asarray(taps)
+    bits = np.zeros(max(length, taps.max()), dtype=np.uint8)
+    bits[:taps.max()] = 1
+    n = taps.max()
+    while n < length:
+        scale = 2 ** int(math.log2(n // taps.max()))
+        block = min(scale * taps.min(), length - n)
+        new = np.zeros(block, dtype=np.uint8)
+        for t in scale * taps:
+            new ^= bits[n - t:n - t + block]
+        bits[n:n + block] = new
+        n += block
+    return bits[:length]
+
+
+def sync_code_parameters(config):
+    # SyncCode settings (from the display config) with defaults filled in, and checked
+    parameters = dict(DEFAULT_SYNC_CODE, **(config or {}))
+    parameters['Type'] = parameters['Type'].lower()
+    if parameters['Type'] == 'mls':
+        if parameters['Bits'] not in MLS_TAPS:
+            raise ValueError('SyncCode Bits must be one of {} for an MLS'.format(sorted(MLS_TAPS)))
+    elif parameters['Type'] == 'gold':
+        if parameters['Bits'] not in GOLD_TAPS:
+            raise ValueError('SyncCode Bits must be one of {} for a Gold code'.format(sorted(GOLD_TAPS)))
+    else:
+        raise ValueError('SyncCode Type must be mls or gold (got {})'.format(parameters['Type']))
+    return parameters
+
+
+def sync_code(config=None):
+    """ sync_code(): one period of the sync code (uint8 0/1) for SyncCode settings
+
+        The right sync square shows sync_code[sync_state % len(sync_code)] (sync_state is
+        logged with each frame).
+    """
+    parameters = sync_code_parameters(config)
+    length = 2 ** parameters['Bits'] - 1
+    if parameters['Type'] == 'mls':
+        return lfsr_sequence(MLS_TAPS[parameters['Bits']], length)
+    first, second = GOLD_TAPS[parameters['Bits']]
+    return lfsr_sequence(first, length) ^ np.roll(lfsr_sequence(second, length), -(parameters['Shift'] % length))
@@ -0,0 +1,118 @@
+# Utilities
+import zmq
+import time
+import struct
+import argparse
+
+import numpy as np
+
+# Per-frame telemetry, published by the renderer on a PUB socket (TelemetryAddress in
+#   display_config.yaml). Each message is one frame:
+#       frame number (uint32), source timestamp of the position sample used (uint32),
+#       position in that sample (float64), position the cameras were set to (the prediction, see
+#       PositionPredictor.py), local time the sample was received, local time the cameras
+#       were set, and local time the frame was drawn (when igLoop returned).
+#   The frame isn't on the screen yet at that point: auto-flip is off, so its buffers are
+#   flipped at the start of the next frame's igLoop (which is where a sync-video wait happens).
+#   Frame end intervals still show dropped frames, but the latencies below stop short of the
+#   flip - to measure motion-to-photon, use the sync squares (see align_sync.py).
+#   Times are time.perf_counter() seconds on the renderer. Frames drawn before any position
+#   sample arrived have a receive time of NaN.
+TELEMETRY_RECORD = struct.Struct('<IIddddd')
+TELEMETRY_DTYPE = np.dtype([('frame', '<u4'), ('timestamp', '<u4'), ('position', '<f8'), ('camera_position', '<f8'),
+                            ('receive_time', '<f8'), ('camera_time', '<f8'), ('frame_end_time', '<f8')])
+
+
+class TelemetryPublisher:
+    """ TelemetryPublisher: PUB socket for per-frame telemetry
+
+        Sending never blocks - if no subscriber is keeping up, records are dropped (which shows
+        up as gaps in the frame numbers, not as dropped frames).
+    """
+    def __init__(self, address, context=None):
+        self.context = context if context else zmq.Context.instance()
+        self.socket = self.context.socket(zmq.PUB)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.bind(address)
+
+    def publish(self, frame, timestamp, position, camera_position, receive_time, camera_time, frame_end_time):
+        try:
+            self.socket.send(TELEMETRY_RECORD.pack(frame, timestamp, position, camera_position, receive_time, camera_time,
+                                                   frame_end_time), zmq.NOBLOCK)
+        except zmq.Again:
+            pass
+
+    def close(self):
+        self.socket.close()
+
+
+def record(address, duration):
+    # Subscribe to a renderer's telemetry for duration seconds. Returns a TELEMETRY_DTYPE array.
+    socket = zmq.Context.instance().socket(zmq.SUB)
+    socket.connect(address)
+    socket.setsockopt(zmq.SUBSCRIBE, b"")
+    messages = []
+    t_end = time.monotonic() + duration
+    while time.monotonic() < t_end:
+        if socket.poll(100):
+            messages.append(socket.recv())
+    socket.close(linger=0)
+    return np.frombuffer(b''.join(m for m in messages if len(m) == TELEMETRY_RECORD.size), dtype=TELEMETRY_DTYPE)
+
+
+def print_histogram(name, values_ms, bins):
+    values_ms = values_ms[np.isfinite(values_ms)]
+    if len(values_ms) == 0:
+        print('{}: no data'.format(name))
+        return
+    print('{}: n={} mean {:.2f} ms, median {:.2f}, p95 {:.2f}, p99 {:.2f}, max {:.2f}'.format(name, len(values_ms),
+        np.mean(values_ms), np.median(values_ms), np.percentile(values_ms, 95), np.percentile(values_ms, 99), np.max(values_ms)))
+    counts, edges = np.histogram(np.clip(values_ms, bins[0], bins[-1]), bins)
+    for count, lo, hi in zip(counts, edges[:-1], edges[1:]):
+        print('  {:7.1f} - {:7.1f} ms {:8d} {}'.format(lo, hi, count, '#' * int(round(50 * count / max(counts.max(), 1)))))
+
+
+def analyze(data, refresh_rate=None):
+    data = np.sort(data, order='frame')
+    print('{} frames ({} to {})'.format(len(data), data['frame'][0], data['frame'][-1]))
+    missing_records = int(data['frame'][-1] - data['frame'][0] + 1 - len(data))
+    if missing_records:
+        print('{} telemetry records were not received'.format(missing_records))
+
+    # Frame intervals, only between consecutive frames (a lost record isn't a dropped frame)
+    consecutive = np.diff(data['frame']) == 1
+    intervals = np.diff(data['frame_end_time'])[consecutive] * 1000
+    nominal = 1000 / refresh_rate if refresh_rate else np.median(intervals)
+    missed = np.maximum(np.round(intervals / nominal) - 1, 0)
+    print('Frame interval nominal {:.2f} ms: {} late frames, {} refreshes missed in total'.format(
+        nominal, int(np.sum(missed > 0)), int(np.sum(missed))))
+    print_histogram('Frame interval', intervals, np.linspace(0, 4 * nominal, 17))
+
+    # Latencies (all on the renderer's clock, up to when igLoop drew the frame - not to the flip)
+    latency = (data['frame_end_time'] - data['receive_time']) * 1000
+    print_histogram('Receive to frame drawn (before the flip)', latency, np.linspace(0, 4 * nominal, 17))
+    print_histogram('Receive to camera set', (data['camera_time'] - data['receive_time']) * 1000, np.linspace(0, 2 * nominal, 17))
+    print_histogram('Camera set to frame drawn', (data['frame_end_time'] - data['camera_time']) * 1000, np.linspace(0, 2 * nominal, 17))
+    stale = np.sum(np.diff(data['timestamp'])[consecutive] == 0)
+    print('{} frames reused the previous frame\'s position sample'.format(int(stale)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Record and analyze PyRenderMaze per-frame telemetry')
+    parser.add_argument('source', help='telemetry address (e.g., tcp://10.129.151.177:8558) or a saved .npy file')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to record for')
+    parser.add_argument('--save', default=None, help='save the recorded telemetry to this .npy file')
+    parser.add_argument('--refresh-rate', type=float, default=None, help='display refresh rate (default: from the median frame interval)')
+    args = parser.parse_args()
+
+    if args.source.endswith('.npy'):
+        data = np.load(args.source)
+    else:
+        print('Recording from {} for {} s'.format(args.source, args.duration))
+        data = record(args.source, args.duration)
+        if args.save:
+            np.save(args.save, data)
+    if len(data) < 2:
+        print('Not enough telemetry received')
+    else:
+        analyze(data, args.refresh_rate)
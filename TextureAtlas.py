@@ -0,0 +1,385 @@
+# Core imports
+from panda3d.core import (Geom, GeomTriangles, GeomVertexData, GeomVertexFormat, PNMImage, Texture, SamplerState,
+                          TextureStage)
+
+# Utilities
+import json
+import numpy as np
+
+# Local code
+from ParametricShapes import VERTEX_DTYPE
+from TextureManager import load_texture, generated_texture
+
+# Texture atlasing. Features with different textures can't be merged into one Geom by
+#   flattenStrong() (each texture is a separate render state, so a separate draw call). At build
+#   time, the textures used by a maze's features are packed into one (or a few) atlas textures,
+#   and each feature's texture coordinates are rewritten to point at its texture's rectangle.
+#
+#   Our textures tile (TextureScaling, walls longer than they are high), which an atlas can't do
+#   with a wrap mode, and we don't want to need shaders. So instead each feature's triangles are
+#   cut along the lines where its texture repeats, and every piece gets coordinates within one
+#   copy of the texture. (RotateTexture is baked into the coordinates first, so it works too.)
+#   Each texture is surrounded by a border of its own (wrapped) pixels, so that filtering at the
+#   seams looks the same as it did with the repeating texture. Features that would need too many
+#   pieces, or whose textures are too big to pack, just keep their own texture.
+#
+#   Atlases are mipmapped like the textures they replace (see TextureManager.py), but each
+#   level is made per texture - every texture's rectangle is shrunk on its own and its border
+#   wrapped again - and only as many levels are used as the border is wide (ATLAS_PADDING = 8
+#   gives 3), since beyond that neighboring textures would bleed into each other.
+
+ATLAS_PREFIX = 'atlas:' # atlas texture names, which record what's in them (see atlas_texture())
+MAX_ATLAS_SIZE = 2048 # pixels (square). More textures than fit go into further atlases.
+ATLAS_PADDING = 8 # border (in pixels) of wrapped texture around each texture (a power of two)
+MAX_TILES_PER_FEATURE = 1024 # features whose texture repeats more often than this aren't atlased
+
+
+def pack_textures(sizes, atlas_size, padding=ATLAS_PADDING):
+    # Shelf packing: [(x, y)] (top left of each texture, in pixels from the top left of the
+    #   atlas), or None for the textures which don't fit. Only the ones which fit affect where
+    #   others go, so packing just those again (in the same order) puts them in the same places.
+    positions = []
+    x = y = shelf_height = 0
+    for w, h in sizes:
+        pw, ph = w + 2 * padding, h + 2 * padding
+        px, py, new_shelf_height = x, y, shelf_height
+        if px + pw > atlas_size: # next shelf
+            px, py, new_shelf_height = 0, y + shelf_height, 0
+        if px + pw > atlas_size or py + ph > atlas_size:
+            positions.append(None)
+            continue
+        positions.append((px + padding, py + padding))
+        x, y, shelf_height = px + pw, py, max(new_shelf_height, ph)
+    return positions
+
+
+def plan_atlases(textures, max_size=MAX_ATLAS_SIZE, padding=ATLAS_PADDING):
+    # Split textures (name -> (width, height)) into atlases. Returns [(atlas size, [names])],
+    #   each atlas being the smallest power of two that holds its textures. Textures too big for
+    #   an atlas are left out.
+    names = sorted((n for n, (w, h) in textures.items() if max(w, h) + 2 * padding <= max_size),
+                   key=lambda n: (-textures[n][1], -textures[n][0], n))
+    atlases = []
+    while names:
+        size = 1
+        while True:
+            size = min(2 * size, max_size)
+            positions = pack_textures([textures[n] for n in names], size, padding)
+            if all(positions) or size == max_size:
+                break
+        atlases.append((size, [n for n, p in zip(names, positions) if p]))
+        names = [n for n, p in zip(names, positions) if not p]
+    return atlases
+
+
+def texture_size(name):
+    # (width, height) of a texture as loaded (Panda3D may have rescaled it to a power of two)
+    tex = load_texture(name)
+    if tex is None:
+        raise ValueError('Texture {} could not be loaded for the texture atlas'.format(name))
+    return tex.getXSize(), tex.getYSize()
+
+
+def texture_image(name):
+    # The texture as a 4 channel image (grayscale textures are expanded, and given alpha = 1)
+    tex = load_texture(name)
+    image = PNMImage()
+    if tex is None or not (tex.store(image) or image.read(tex.getFullpath())):
+        raise ValueError('Texture {} could not be read for the texture atlas'.format(name))
+    if (image.getXSize(), image.getYSize()) != (tex.getXSize(), tex.getYSize()):
+        scaled = PNMImage(tex.getXSize(), tex.getYSize(), image.getNumChannels(), image.getMaxval())
+        scaled.quickFilterFrom(image)
+        image = scaled
+    if image.isGrayscale():
+        image.makeRgb()
+    if not image.hasAlpha():
+        image.addAlpha()
+        image.alphaFill(1)
+    return image
+
+
+def make_atlas_image(images, size, padding=ATLAS_PADDING):
+    # Copy images into a size x size image (as placed by pack_textures()), each surrounded by
+    #   padding pixels of itself, wrapped around (as a repeating texture would be)
+    atlas = PNMImage(size, size, 4)
+    atlas.alphaFill(0)
+    positions = pack_textures([(image.getXSize(), image.getYSize()) for image in images], size, padding)
+    for image, (x, y) in zip(images, positions):
+        w, h = image.getXSize(), image.getYSize()
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                # The part of this copy of the image which lands in the padded rectangle
+                x0, x1 = max(x + dx * w, x - padding), min(x + (dx + 1) * w, x + w + padding)
+                y0, y1 = max(y + dy * h, y - padding), min(y + (dy + 1) * h, y + h + padding)
+                if x1 > x0 and y1 > y0:
+                    atlas.copySubImage(image, x0, y0, x0 - (x + dx * w), y0 - (y + dy * h), x1 - x0, y1 - y0)
+    return atlas, positions
+
+
+def wrap_padding(pixels, x, y, w, h, padding):
+    # Fill the border around the w x h rectangle at (x, y) of an image array (rows top to bottom)
+    #   with the rectangle's own pixels, wrapped around
+    rows = y + np.arange(-padding, h + padding) % h
+    columns = x + np.arange(-padding, w + padding) % w
+    pixels[y - padding:y + h + padding, x - padding:x + w + padding] = pixels[np.ix_(rows, columns)]
+
+
+def mipmap_levels(sizes, padding=ATLAS_PADDING):
+    # How many mipmap levels below the full size an atlas of these (width, height)s can have,
+    #   with every texture keeping at least a pixel of border and whole pixels on every level
+    levels = padding.bit_length() - 1
+    for w, h in sizes:
+        while levels and (w | h) & ((1 << levels) - 1):
+            levels -= 1
+    return levels
+
+
+def make_atlas_mipmaps(tex, rectangles, levels, padding=ATLAS_PADDING):
+    # Add the mipmap images to an atlas texture (which has its full size RAM image). Each is the
+    #   level above averaged over 2 x 2 pixels. For the first levels, that only mixes pixels of
+    #   the same texture (rectangles [(x, y, w, h)] are on multiples of 2 ** levels), and the
+    #   borders are wrapped again. The rest are only there because Panda3D would otherwise
+    #   generate every level itself (the sampler's max LOD keeps them from being used).
+    size = tex.getXSize()
+    pixels = np.frombuffer(tex.getRamImage(), dtype=np.uint8).reshape(size, size, 4)[::-1] # (rows bottom to top)
+    for level in range(1, size.bit_length()):
+        size //= 2
+        pixels = pixels.reshape(size, 2, size, 2, 4).mean(axis=(1, 3), dtype=np.float32).round().astype(np.uint8)
+        if level <= levels:
+            for x, y, w, h in rectangles:
+                wrap_padding(pixels, x >> level, y >> level, w >> level, h >> level, padding >> level)
+        tex.makeRamMipmapImage(level)
+        np.asarray(memoryview(tex.modifyRamMipmapImage(level)).cast('B'))[:] = pixels[::-1].reshape(-1)
+
+
+def atlas_name(size, names):
+    return ATLAS_PREFIX + json.dumps([size, names])
+
+
+def is_atlas_name(name):
+    return name.startswith(ATLAS_PREFIX)
+
+
+def make_atlas_texture(name):
+    size, names = json.loads(name[len(ATLAS_PREFIX):])
+    images = [texture_image(n) for n in names]
+    image, positions = make_atlas_image(images, size)
+    tex = Texture(name)
+    tex.load(image)
+    levels = mipmap_levels([(img.getXSize(), img.getYSize()) for img in images])
+    if levels:
+        make_atlas_mipmaps(tex, [(x, y, img.getXSize(), img.getYSize()) for img, (x, y) in zip(images, positions)], levels)
+    sampler = SamplerState(tex.getDefaultSampler())
+    sampler.setMinfilter(SamplerState.FT_linear_mipmap_linear if levels else SamplerState.FT_linear)
+    sampler.setMagfilter(SamplerState.FT_linear)
+    sampler.setMaxLod(levels) # (the levels below those would blend neighboring textures together)
+    sampler.setWrapU(SamplerState.WM_clamp)
+    sampler.setWrapV(SamplerState.WM_clamp)
+    tex.setDefaultSampler(sampler)
+    return tex
+
+
+def atlas_texture(name):
+    """ atlas_texture(): the atlas texture called name (see atlas_name()), and where each texture is in it
+
+        Returns (Texture, {texture name: (u0, v0, u1, v1)}). Atlases are shared by every maze
+        built with the same set of textures, through the TextureManager (which counts them
+        against its budget like any other texture), and are rebuilt from their names when
+        mazes are read back from the maze cache.
+    """
+    size, names = json.loads(name[len(ATLAS_PREFIX):])
+    tex = generated_texture(name, lambda: make_atlas_texture(name))
+    sizes = [texture_size(n) for n in names]
+    rects = {}
+    for n, (w, h), (x, y) in zip(names, sizes, pack_textures(sizes, size)):
+        # (image rows run top to bottom, texture coordinates bottom to top)
+        rects[n] = (x / size, 1 - (y + h) / size, (x + w) / size, 1 - y / size)
+    return tex, rects
+
+
+def geom_vertices(geom):
+    # The vertices of a ParametricShapes Geom as a VERTEX_DTYPE array, and its triangles as an
+    #   (n, 3) array of indices into it. None if geom isn't in our vertex format.
+    vdata = geom.getVertexData()
+    if vdata.getFormat() != GeomVertexFormat.getV3n3cpt2() or vdata.getNumArrays() != 1:
+        return None
+    vertices = np.frombuffer(memoryview(vdata.getArray(0)).cast('B'), dtype=VERTEX_DTYPE).copy()
+    triangles = []
+    for i in range(geom.getNumPrimitives()):
+        primitive = geom.getPrimitive(i).decompose()
+        triangles.extend(primitive.getVertex(j) for j in range(primitive.getNumVertices()))
+    triangles = np.array(triangles, dtype=np.int64).reshape(-1, 3)
+    # (drop the degenerate triangles joining strips together)
+    keep = (triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) & (triangles[:, 0] != triangles[:, 2])
+    return vertices, triangles[keep]
+
+
+def clip_polygons(polygons, counts, axis, bound, keep_above):
+    # Clip convex polygons ((n, MAX_PIECE_VERTICES, 2) texture coordinates, the first counts of
+    #   each being used) to u >= bound (axis 0, keep_above) or u <= bound, or the same for v
+    #   (axis 1). bound is a number, or one per polygon. One step of Sutherland-Hodgman, done
+    #   for all of the polygons at once.
+    n, k = polygons.shape[:2]
+    index = np.arange(k)
+    valid = index < counts[:, None]
+    following = np.take_along_axis(polygons, ((index + 1) % np.maximum(counts, 1)[:, None])[:, :, None], axis=1)
+    bound = np.reshape(bound, (-1, 1)) # (one for all, or one per polygon)
+    da = polygons[:, :, axis] - bound
+    db = following[:, :, axis] - bound
+    if not keep_above:
+        da, db = -da, -db
+    inside = valid & (da >= 0)
+    crossing = valid & (((da > 0) & (db < 0)) | ((da < 0) & (db > 0)))
+    t = np.where(crossing, da / np.where(crossing, da - db, 1), 0)
+    # Each vertex is kept if it's inside, followed by where the edge from it crosses the line
+    emit = np.stack([inside, crossing], axis=2).reshape(n, 2 * k)
+    points = np.stack([polygons, polygons + (following - polygons) * t[:, :, None]], axis=2).reshape(n, 2 * k, 2)
+    rows, columns = np.nonzero(emit)
+    clipped = np.zeros_like(polygons)
+    clipped[rows, (np.cumsum(emit, axis=1) - 1)[rows, columns]] = points[rows, columns]
+    return clipped, emit.sum(axis=1)
+
+MAX_PIECE_VERTICES = 8 # (a triangle clipped to a square has at most 7 corners)
+
+
+def tile_triangles(vertices, triangles, uv_matrix, rect):
+    # Cut triangles wherever the texture repeats, and map the texture coordinates of every piece
+    #   into rect (u0, v0, u1, v1) of the atlas. Returns the new vertices (VERTEX_DTYPE) and
+    #   triangles (indices into them). The cutting is done in texture space - each triangle is
+    #   clipped to every copy of the texture (tile) it overlaps - and the other vertex attributes
+    #   of the pieces are then interpolated across the original triangles.
+    uv = np.concatenate([vertices['texcoord'], np.zeros((len(vertices), 1)), np.ones((len(vertices), 1))], axis=1)
+    uv = (uv.astype(np.float64) @ uv_matrix)[:, :2] # (RotateTexture etc., as a row vector transform)
+    u0, v0, u1, v1 = rect
+    corners = uv[triangles] # (n, 3, 2)
+    first_tile = np.floor(corners.min(axis=1))
+    if np.all(first_tile == first_tile[0]) and np.all(corners.max(axis=1) <= first_tile[0] + 1):
+        # Everything is within one copy of the texture, so there's nothing to cut
+        local = uv - first_tile[0]
+        tiled = vertices.copy()
+        tiled['texcoord'] = np.stack([u0 + local[:, 0] * (u1 - u0), v0 + local[:, 1] * (v1 - v0)], axis=1)
+        return tiled, triangles
+
+    edges = corners[:, 1:] - corners[:, :1]
+    area = edges[:, 0, 0] * edges[:, 1, 1] - edges[:, 0, 1] * edges[:, 1, 0]
+
+    # Every (triangle, tile) pair to clip. Triangles with no area in texture space aren't cut.
+    n_tiles = np.maximum(np.ceil(corners.max(axis=1)) - first_tile, 1).astype(np.int64)
+    n_tiles[np.abs(area) < 1e-12] = 1
+    n_pairs = n_tiles[:, 0] * n_tiles[:, 1]
+    source = np.repeat(np.arange(len(triangles)), n_pairs)
+    within = np.arange(len(source)) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+    tile = first_tile[source] + np.stack([within % n_tiles[source, 0], within // n_tiles[source, 0]], axis=1)
+
+    polygons = np.zeros((len(source), MAX_PIECE_VERTICES, 2))
+    polygons[:, :3] = corners[source]
+    counts = np.full(len(source), 3)
+    cut = n_pairs[source] > 1
+    cut_polygons, cut_counts, cut_tiles = polygons[cut], counts[cut], tile[cut]
+    for axis in (0, 1):
+        for offset, keep_above in ((0, True), (1, False)):
+            cut_polygons, cut_counts = clip_polygons(cut_polygons, cut_counts, axis, cut_tiles[:, axis] + offset,
+                                                     keep_above)
+    polygons[cut], counts[cut] = cut_polygons, cut_counts
+
+    # Fan each piece back into triangles
+    piece_source, piece_uv, piece_tile = [], [], []
+    for k in range(1, MAX_PIECE_VERTICES - 1):
+        fan = counts >= k + 2
+        piece_source.append(np.repeat(source[fan], 3))
+        piece_uv.append(polygons[fan][:, [0, k, k + 1]].reshape(-1, 2))
+        piece_tile.append(np.repeat(tile[fan], 3, axis=0))
+    source, piece_uv, piece_tile = np.concatenate(piece_source), np.concatenate(piece_uv), np.concatenate(piece_tile)
+
+    # Barycentric coordinates of each new vertex in its source triangle
+    d = piece_uv - corners[source, 0]
+    e = edges[source]
+    a = np.where(np.abs(area[source]) < 1e-12, np.inf, area[source]) # (no area: use the first corner)
+    weights = np.empty((len(source), 3))
+    weights[:, 1] = (d[:, 0] * e[:, 1, 1] - d[:, 1] * e[:, 1, 0]) / a
+    weights[:, 2] = (e[:, 0, 0] * d[:, 1] - e[:, 0, 1] * d[:, 0]) / a
+    weights[:, 0] = 1 - weights[:, 1] - weights[:, 2]
+
+    corner_indices = triangles[source] # (m, 3)
+    tiled = np.empty(len(source), dtype=VERTEX_DTYPE)
+    for column in ('vertex', 'normal'):
+        values = vertices[column]
+        tiled[column] = sum(weights[:, [j]] * values[corner_indices[:, j]] for j in range(3))
+    tiled['color'] = vertices['color'][corner_indices[np.arange(len(source)), np.argmax(weights, axis=1)]]
+    local = np.clip(piece_uv - piece_tile, 0, 1)
+    tiled['texcoord'] = np.stack([u0 + local[:, 0] * (u1 - u0), v0 + local[:, 1] * (v1 - v0)], axis=1)
+
+    # Pieces share vertices along the cuts (and uncut triangles share theirs), so index them
+    #   (sorting the raw words of each vertex, which is much cheaper than np.unique on a void view)
+    words = tiled.view(np.uint32).reshape(len(tiled), -1)
+    order = np.lexsort(words.T[::-1])
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = np.any(words[order[1:]] != words[order[:-1]], axis=1)
+    index = np.empty(len(order), dtype=np.int64)
+    index[order] = np.cumsum(first) - 1
+    return tiled[order[first]], index.reshape(-1, 3)
+
+
+def make_triangles_geom(vertices, triangles, name='atlased'):
+    vdata = GeomVertexData(name, GeomVertexFormat.getV3n3cpt2(), Geom.UHStatic)
+    vdata.uncleanSetNumRows(len(vertices))
+    np.asarray(memoryview(vdata.modifyArray(0)).cast('B'))[:] = vertices.view(np.uint8)
+    primitive = GeomTriangles(Geom.UHStatic)
+    primitive.setIndexType(Geom.NT_uint32)
+    index = primitive.modifyVertices()
+    index.uncleanSetNumRows(triangles.size)
+    np.asarray(memoryview(index).cast('B'))[:] = triangles.astype('<u4').reshape(-1).view(np.uint8)
+    geom = Geom(vdata)
+    geom.addPrimitive(primitive)
+    return geom
+
+
+def tiles_needed(vertices, triangles, uv_matrix):
+    # How many copies of the texture the triangles cover (at most)
+    uv = np.concatenate([vertices['texcoord'], np.zeros((len(vertices), 1)), np.ones((len(vertices), 1))], axis=1)
+    used = np.zeros(len(vertices), dtype=bool)
+    used[triangles.reshape(-1)] = True
+    uv = (uv @ uv_matrix)[:, :2][used]
+    return int(np.prod(np.floor(uv.max(axis=0)) - np.floor(uv.min(axis=0)) + 1))
+
+
+def atlas_candidate(node):
+    # (texture name, [(geom index, vertices, triangles)], uv matrix) for a feature node whose
+    #   texture could go into an atlas, or None if it has no texture or can't be atlased
+    stage = TextureStage.getDefault()
+    tex = node.getTexture()
+    if tex is None or tex.getTextureType() != Texture.TT_2d_texture:
+        return None
+    uv_matrix = np.array(node.getTexTransform(stage).getMat(), dtype=np.float64)
+    geoms = []
+    for i in range(node.node().getNumGeoms()):
+        data = geom_vertices(node.node().getGeom(i))
+        if data is None or tiles_needed(*data, uv_matrix) > MAX_TILES_PER_FEATURE:
+            return None
+        geoms.append((i, *data))
+    return tex.getFilename().toOsSpecific(), geoms, uv_matrix
+
+
+def plan_placement(texture_names, max_size=MAX_ATLAS_SIZE):
+    # {texture name: atlas name} for the textures which go into atlases (atlases holding just one
+    #   texture aren't worth it, so with fewer than two textures this is empty)
+    sizes = {name: texture_size(name) for name in set(texture_names)}
+    placement = {}
+    if len(sizes) < 2:
+        return placement # (nothing to merge)
+    for size, names in plan_atlases(sizes, max_size):
+        if len(names) > 1:
+            placement.update({n: atlas_name(size, names) for n in names})
+    return placement
+
+
+def apply_atlas(node, candidate, atlas):
+    # Move a feature node (as returned by atlas_candidate()) onto the atlas called atlas. Its
+    #   Geoms are replaced (the originals aren't modified, since they may be shared).
+    name, geoms, uv_matrix = candidate
+    tex, rects = atlas_texture(atlas)
+    for i, vertices, triangles in geoms:
+        node.node().setGeom(i, make_triangles_geom(*tile_triangles(vertices, triangles, uv_matrix, rects[name])))
+    node.clearTexTransform()
+    node.setTexture(tex)
+
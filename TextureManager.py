@@ -0,0 +1,174 @@
+# Core imports
+from panda3d.core import Texture, TexturePool, SamplerState, Filename, VirtualFileSystem, getModelPath
+
+# Utilities
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Local code
+from ProceduralTextures import is_procedural, procedural_name, procedural_texture
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+
+class TextureManager:
+    """ TextureManager: shared registry for the textures used by mazes
+
+        Textures are loaded once and shared by every maze (and every feature) which uses them.
+        They are deduplicated both by (resolved) path and by file contents, and are also
+        registered with Panda3D's TexturePool. (Cached .bam mazes store placeholders which are
+        swapped for textures from here when they're read, see MazeCache.) The total (estimated)
+        texture memory is kept under a budget by releasing the least recently used textures
+        that no maze is currently using.
+
+        If txo_directory is given, decoded images are additionally cached there as .txo files
+        (Panda3D's native texture format) with pre-generated mipmaps, and mipmapped filtering
+        is enabled for them. Loading a .txo skips PNG decoding entirely.
+
+        Textures which don't come from a file (procedural textures and texture atlases) are
+        held here too, under their name (see generated()), so they count towards the budget
+        and show up in residency().
+    """
+    def __init__(self, budget_mb=128, txo_directory=None):
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        self.txo_directory = txo_directory
+        if self.txo_directory:
+            os.makedirs(self.txo_directory, exist_ok=True)
+        self.textures = OrderedDict() # content hash (or generated texture name) -> Texture, least recently used first
+        self.paths = {} # resolved path -> content hash
+        self.base_ref_counts = {} # content hash -> reference count when nothing but us (and the pool) uses it
+        self.lock = threading.RLock()
+
+    def resolve(self, path):
+        # The same search Panda3D does for TexturePool.loadTexture()
+        filename = Filename.fromOsSpecific(path)
+        VirtualFileSystem.getGlobalPtr().resolveFilename(filename, getModelPath().getValue())
+        return filename
+
+    def load(self, path):
+        filename = self.resolve(path)
+        with self.lock:
+            digest = self.paths.get(filename.getFullpath(), None)
+            if digest is None:
+                try:
+                    with open(filename.toOsSpecific(), 'rb') as f:
+                        digest = hashlib.sha256(f.read()).hexdigest()
+                except OSError:
+                    print('Texture {} not found'.format(path))
+                    return None
+                self.paths[filename.getFullpath()] = digest
+
+            if digest not in self.textures:
+                tex = self.read_texture(filename, digest)
+                if tex is None:
+                    return None
+                self.textures[digest] = tex
+                self.base_ref_counts[digest] = tex.getRefCount()
+                self.enforce_budget(keep=digest)
+            else:
+                self.textures.move_to_end(digest)
+            return self.textures[digest]
+
+    def generated(self, name, make):
+        # The texture called name, made by make() if we don't have it (or released it)
+        with self.lock:
+            if name not in self.textures:
+                tex = make()
+                self.textures[name] = tex
+                self.base_ref_counts[name] = tex.getRefCount()
+                self.enforce_budget(keep=name)
+            else:
+                self.textures.move_to_end(name)
+            return self.textures[name]
+
+    def read_texture(self, filename, digest):
+        if not self.txo_directory:
+            return TexturePool.loadTexture(filename)
+
+        txo_filename = Filename.fromOsSpecific(os.path.abspath(os.path.join(self.txo_directory, digest + '.txo')))
+        if os.path.exists(txo_filename.toOsSpecific()):
+            tex = Texture()
+            if not tex.read(txo_filename):
+                return None
+        else:
+            tex = Texture()
+            if not tex.read(filename):
+                return None
+            tex.generateRamMipmapImages()
+            tmp_filename = os.path.join(self.txo_directory, '{}.{}.tmp.txo'.format(digest, os.getpid())) # (Panda3D needs the extension)
+            if tex.write(Filename.fromOsSpecific(tmp_filename)):
+                os.replace(tmp_filename, txo_filename.toOsSpecific()) # (other renderer processes may be reading)
+        tex.setMinfilter(SamplerState.FT_linear_mipmap_linear)
+        # Register under the original image name so that .bam files find this texture
+        tex.setFilename(filename)
+        tex.setFullpath(filename)
+        TexturePool.addTexture(tex)
+        return tex
+
+    def preload(self, directory='textures'):
+        # Load every image in directory (e.g., at startup, so the first maze doesn't have to)
+        for name in sorted(os.listdir(directory)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                self.load(os.path.join(directory, name))
+
+    def in_use(self, digest):
+        return self.textures[digest].getRefCount() > self.base_ref_counts[digest]
+
+    def memory_bytes(self):
+        with self.lock:
+            return sum(tex.estimateTextureMemory() for tex in self.textures.values())
+
+    def enforce_budget(self, keep=None):
+        # Release idle textures (oldest first) until we're within budget. keep is never released.
+        with self.lock:
+            for digest in list(self.textures):
+                if self.memory_bytes() <= self.budget_bytes:
+                    break
+                if digest != keep and not self.in_use(digest):
+                    self.evict(digest)
+
+    def evict(self, digest):
+        tex = self.textures.pop(digest)
+        del self.base_ref_counts[digest]
+        for path in [p for p, d in self.paths.items() if d == digest]:
+            del self.paths[path]
+        TexturePool.releaseTexture(tex)
+        tex.releaseAll() # free the GPU copy
+
+    def residency(self):
+        # [(filename, bytes, in use)] for every texture currently held, least recently used first
+        with self.lock:
+            return [(tex.getFilename().getBasename() or tex.getName(), tex.estimateTextureMemory(), self.in_use(digest))
+                        for digest, tex in self.textures.items()]
+
+
+# Mazes load their textures through load_texture(). By default this goes straight to the
+#   TexturePool; install() a TextureManager to route loads through it instead. Procedural
+#   textures (parameters rather than a file, see ProceduralTextures.py) are generated, and
+#   held like texture atlases (see generated_texture()).
+_manager = None
+_generated_manager = None
+
+def install(manager):
+    global _manager
+    _manager = manager
+
+def load_texture(path):
+    if is_procedural(path):
+        return generated_texture(procedural_name(path), lambda: procedural_texture(path))
+    if _manager:
+        return _manager.load(path)
+    return TexturePool.loadTexture(path)
+
+def generated_texture(name, make):
+    # A texture which isn't read from a file (a procedural texture or a texture atlas), made by make() when it's
+    #   first needed and shared by name. Without an installed TextureManager (e.g., when mazes are
+    #   compiled offline), these are held by a default one.
+    global _generated_manager
+    if _manager:
+        return _manager.generated(name, make)
+    if _generated_manager is None:
+        _generated_manager = TextureManager()
+    return _generated_manager.generated(name, make)
@@ -0,0 +1,342 @@
+# Offline alignment of a photodiode recording of the sync squares with the frame log. Finds the
+#   sample at which every logged frame appeared on the screen, and reports frames which never
+#   appeared (dropped) or stayed up for more than one refresh (duplicated).
+#
+#   python3 align_sync.py photodiode.bin ExperimentLog2021-06-01_1200 --sample-rate 30000 --dtype int16 \
+#       --channels 2 --code-channel 1 --clock-channel 0 --output alignment.npz
+#
+#   The recording can be a raw interleaved binary file (--dtype, --channels, --header-bytes) or
+#   a .npy file (samples x channels). It is read a block at a time, so recordings of many hours
+#   (and GB) don't need to fit in memory. In one pass over it, each photodiode channel
+#   is thresholded (with hysteresis) into square on/off, giving the time of every transition,
+#   and a low-rate copy (--analysis-rate) is kept for matching.
+#
+#   Matching is done in windows (--window seconds). Each window of the code square's low-rate
+#   signal is cross-correlated (with FFTs) against the code the frame log says was shown,
+#   giving the offset between the renderer's clock and the recording's samples. The first good
+#   window is searched for over the whole log (the code is an MLS, see SyncCode.py, so it only
+#   matches in one place); later ones only near where the previous offsets predict, so slow
+#   drift between the two clocks is followed. Every frame's transition(s) (the code square
+#   changes on some frames, the clock square on every frame) are then matched to the nearest
+#   recorded transition. Frames whose transition wasn't found weren't shown (dropped), and the
+#   time between frames gives how many refreshes each was shown for.
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+from FrameLog import load_frame_log
+from SyncCode import sync_code
+
+
+class Recording:
+    """ Recording: a (samples x channels) photodiode recording on disk, read a block at a time
+
+        (Rather than memory mapped, so that reading through a recording larger than memory
+        doesn't leave it all mapped.)
+    """
+    def __init__(self, path, dtype='int16', n_channels=1, header_bytes=0):
+        if path.endswith('.npy'):
+            with open(path, 'rb') as f:
+                version = np.lib.format.read_magic(f)
+                read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+                shape, fortran_order, dtype = read_header(f)
+                header_bytes = f.tell()
+            if fortran_order or len(shape) > 2:
+                raise ValueError('{} should be a (samples x channels) array in C order'.format(path))
+            n_channels = shape[1] if len(shape) == 2 else 1
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.n_channels = n_channels
+        self.header_bytes = header_bytes
+        self.n_samples = (os.path.getsize(path) - header_bytes) // (self.dtype.itemsize * n_channels)
+
+    def __len__(self):
+        return self.n_samples
+
+    def read(self, start, count):
+        count = max(0, min(count, self.n_samples - start))
+        return np.fromfile(self.path, dtype=self.dtype, count=count * self.n_channels,
+                           offset=self.header_bytes + start * self.n_channels * self.dtype.itemsize).reshape(-1, self.n_channels)
+
+
+def estimate_thresholds(recording, channel, n_blocks=200, block_samples=5000, hysteresis=0.2):
+    # (low, high) thresholds between the square's dark and bright levels, from blocks spread
+    #   through the recording. Values must cross the far threshold to change state.
+    starts = np.linspace(0, max(0, len(recording) - block_samples), n_blocks).astype(int)
+    values = np.concatenate([recording.read(start, block_samples)[:, channel] for start in np.unique(starts)]).astype(np.float64)
+    dark, bright = np.percentile(values, [1, 99])
+    if bright - dark <= 0:
+        raise ValueError('Channel {} of the recording is constant'.format(channel))
+    middle, half_band = (dark + bright) / 2, hysteresis * (bright - dark) / 2
+    return middle - half_band, middle + half_band
+
+
+def scan_recording(recording, channels, thresholds, decimation, chunk_samples=1 << 22):
+    """ scan_recording(): one pass over the recording
+
+        Returns, for each channel, the on/off transitions ((sample, new state) arrays), and
+        the fraction of time the square was on in each block of decimation samples.
+    """
+    chunk_samples = max(decimation, chunk_samples // decimation * decimation)
+    edges = {c: ([], []) for c in channels}
+    low_rate = {c: [] for c in channels}
+    state = {c: None for c in channels}
+    for start in range(0, len(recording), chunk_samples):
+        chunk = recording.read(start, chunk_samples)
+        for c in channels:
+            x = chunk[:, c]
+            low, high = thresholds[c]
+            level = np.full(len(x), -1, dtype=np.int8)
+            level[x <= low] = 0
+            level[x >= high] = 1
+            # Between the thresholds, the state is whatever it was last
+            last = np.maximum.accumulate(np.where(level >= 0, np.arange(len(x)), -1))
+            if state[c] is None: # (start in whatever state the recording first shows)
+                state[c] = level[np.argmax(level >= 0)] if np.any(level >= 0) else 0
+            on = np.where(last >= 0, level[np.maximum(last, 0)], state[c]).astype(np.int8)
+            changes = np.flatnonzero(np.diff(on, prepend=state[c]))
+            edges[c][0].append(start + changes)
+            edges[c][1].append(on[changes])
+            state[c] = on[-1]
+            n_blocks = -(-len(on) // decimation)
+            padded = np.resize(on, n_blocks * decimation) if len(on) % decimation else on
+            low_rate[c].append(padded.reshape(n_blocks, decimation).mean(axis=1, dtype=np.float32))
+    return ({c: (np.concatenate(s), np.concatenate(v)) for c, (s, v) in edges.items()},
+            {c: np.concatenate(v) for c, v in low_rate.items()})
+
+
+def expected_signal(frame_times, values, t0, rate, n):
+    # What the square should look like (+/-1) at rate Hz from renderer time t0, given the value
+    #   shown by each frame (each is shown until the next one starts)
+    starts = np.clip(np.ceil((frame_times - t0) * rate).astype(np.int64), 0, n)
+    signal = np.zeros(n, dtype=np.float32)
+    signal[starts[0]:] = np.repeat(np.where(values > 0, 1.0, -1.0).astype(np.float32), np.diff(starts, append=n))
+    return signal
+
+
+def best_match(segment, window, block=1 << 20):
+    # (position, score) of the best match of window within segment, by FFT cross-correlation
+    #   (block positions at a time, so a long segment doesn't need huge FFTs). The score is the
+    #   correlation per sample (1 = a perfect match).
+    size = 1 << (min(len(segment), block + len(window) - 1) - 1).bit_length() # (only lags >= 0 are kept, so no padding)
+    window_fft = np.conj(np.fft.rfft(window, size))
+    best = (0, -np.inf)
+    for first in range(0, len(segment) - len(window) + 1, block):
+        piece = segment[first:first + block + len(window) - 1]
+        scores = np.fft.irfft(np.fft.rfft(piece, size) * window_fft, size)[:len(piece) - len(window) + 1]
+        position = int(np.argmax(scores))
+        if scores[position] > best[1]:
+            best = (first + position, scores[position])
+    return best[0], best[1] / len(window)
+
+
+def track_offsets(recorded, expected, window, margin, min_score=0.5, max_offset=None):
+    """ track_offsets(): offset (in low-rate samples) of the recording against the expected signal, by window
+
+        recorded[k] should equal expected[k - offset]. Returns (window start, offset, score)
+        for each window in which the code was found.
+    """
+    matches = []
+    for start in range(0, len(recorded) - window + 1, window):
+        piece = recorded[start:start + window]
+        if np.std(piece) < 0.1:
+            continue # (the square isn't changing - screen off, or not recorded)
+        piece = piece - piece.mean()
+        if matches:
+            predicted = start - matches[-1][1]
+            first, last = max(0, predicted - margin), min(len(expected), predicted + window + margin)
+        else:
+            first, last = 0, len(expected)
+            if max_offset is not None:
+                first, last = max(0, start - max_offset), min(len(expected), start + window + max_offset)
+        if last - first < window:
+            continue
+        position, score = best_match(expected[first:last], piece)
+        if score >= min_score:
+            matches.append((start, start - (first + position), score))
+    return np.array(matches, dtype=np.float64).reshape(-1, 3)
+
+
+def match_edges(predicted, polarity, edge_samples, edge_states, tolerance):
+    # For each predicted transition, the recorded one of the same polarity nearest to it (within
+    #   tolerance samples), or NaN. A recorded transition is matched at most once (to the nearest).
+    matched = np.full(len(predicted), np.nan)
+    for state in (0, 1):
+        wanted = np.flatnonzero(polarity == state)
+        found = edge_samples[edge_states == state].astype(np.float64)
+        if not len(wanted) or not len(found):
+            continue
+        after = np.minimum(np.searchsorted(found, predicted[wanted]), len(found) - 1)
+        before = np.maximum(after - 1, 0)
+        nearest = np.where(np.abs(found[after] - predicted[wanted]) < np.abs(found[before] - predicted[wanted]), after, before)
+        distance = np.abs(found[nearest] - predicted[wanted])
+        ok = distance <= tolerance
+        # (if two frames claim the same transition, it belongs to the closer one)
+        order = np.lexsort((distance[ok], nearest[ok]))
+        claimed = nearest[ok][order]
+        first = np.ones(len(claimed), dtype=bool)
+        first[1:] = claimed[1:] != claimed[:-1]
+        winners = wanted[ok][order][first]
+        matched[winners] = found[claimed[first]]
+    return matched
+
+
+def edges_between(after, before, polarity, edge_samples, edge_states):
+    # The first recorded transition to each state in polarity which is strictly between after and before, or NaN
+    between = np.full(len(polarity), np.nan)
+    for state in (0, 1):
+        wanted = np.flatnonzero(polarity == state)
+        found = edge_samples[edge_states == state]
+        first = np.searchsorted(found, after[wanted], side='right')
+        ok = first < np.searchsorted(found, before[wanted], side='left')
+        between[wanted[ok]] = found[first[ok]]
+    return between
+
+
+def align(recording, records, sample_rate, code, code_channel, clock_channel=None, analysis_rate=1000, window_seconds=20,
+          margin_seconds=1, refresh_rate=None, max_offset_seconds=None, min_score=0.5, report=print):
+    """ align(): match a photodiode recording to a frame log
+
+        Returns a dict of arrays, one entry per logged frame: "frame", "sync_state", "sample"
+        (where in the recording it appeared; interpolated if its transitions weren't found),
+        "matched", "dropped" and "refreshes" (how many refreshes it was shown for, or -1 if that
+        couldn't be measured), as well as
+        the window offsets ("offsets": window start sample, offset, score) and a "summary".
+    """
+    records = records[np.argsort(records['frame'], kind='stable')]
+    frame_times = records['frame_time']
+    code_bits = code[records['sync_state'] % len(code)].astype(np.int8)
+    clock_bits = (records['sync_state'] % 2).astype(np.int8)
+    if refresh_rate is None:
+        refresh_rate = 1 / np.median(np.diff(frame_times))
+    decimation = max(1, int(round(sample_rate / analysis_rate)))
+    low_rate = sample_rate / decimation
+
+    channels = [code_channel] + ([clock_channel] if clock_channel is not None else [])
+    thresholds = {c: estimate_thresholds(recording, c) for c in channels}
+    edges, recorded = scan_recording(recording, channels, thresholds, decimation)
+    report('{} samples ({:.1f} minutes), {} frames logged ({:.1f} minutes)'.format(
+        len(recording), len(recording) / sample_rate / 60, len(records), (frame_times[-1] - frame_times[0]) / 60))
+
+    # Coarse: window by window offsets of the code square
+    t0 = frame_times[0]
+    expected = expected_signal(frame_times, code_bits, t0, low_rate, int((frame_times[-1] - t0) * low_rate) + 1)
+    offsets = track_offsets(2 * recorded[code_channel] - 1, expected, int(window_seconds * low_rate),
+                            int(margin_seconds * low_rate), min_score,
+                            None if max_offset_seconds is None else int(max_offset_seconds * low_rate))
+    if not len(offsets):
+        raise ValueError('The sync code was not found in the recording')
+    # Offset as a function of renderer time (linear between window centers)
+    window_times = t0 + (offsets[:, 0] - offsets[:, 1] + window_seconds * low_rate / 2) / low_rate
+    offset = np.interp(frame_times, window_times, offsets[:, 1])
+    predicted = ((frame_times - t0) * low_rate + offset) * decimation
+
+    # Fine: match every frame's transitions. The clock square changes on every frame, the code square on some.
+    tolerance = sample_rate / refresh_rate / 2
+    sample = np.full(len(records), np.nan)
+    squares = [(channel, bits, np.zeros(len(records), dtype=bool)) for channel, bits in
+               ((clock_channel, clock_bits), (code_channel, code_bits)) if channel is not None]
+    for channel, bits, found in squares:
+        changes = np.flatnonzero(np.diff(bits, prepend=1 - bits[0]))
+        matched = match_edges(predicted[changes], bits[changes], *edges[channel], tolerance)
+        found[changes[~np.isnan(matched)]] = True
+        sample[changes] = np.where(np.isnan(sample[changes]), matched, sample[changes])
+    # A frame rendered unusually early or late (relative to when it was shown) can miss its
+    #   transition. If both of its neighbors were found, its transition is the one between them.
+    for channel, bits, found in squares:
+        changes = np.flatnonzero(np.diff(bits, prepend=1 - bits[0]))
+        changes = changes[(changes > 0) & (changes < len(records) - 1)]
+        missed = changes[~found[changes] & ~np.isnan(sample[changes - 1]) & ~np.isnan(sample[changes + 1])]
+        between = edges_between(sample[missed - 1], sample[missed + 1], bits[missed], *edges[channel])
+        found[missed[~np.isnan(between)]] = True
+        sample[missed] = np.where(np.isnan(sample[missed]), between, sample[missed])
+    matched = ~np.isnan(sample)
+    if matched.sum() < 2:
+        raise ValueError('Too few frames could be matched to the recording')
+    # (between matched frames, follow the renderer's clock)
+    sample[~matched] = np.interp(frame_times[~matched], frame_times[matched], sample[matched] - predicted[matched]) + \
+        predicted[~matched]
+
+    # A frame which should have changed a square (from the last frame that was shown), but whose
+    #   transition never appeared, wasn't shown. (Without a clock channel, frames which don't
+    #   change the code square can't be checked.) Only frames within the recording are judged.
+    inside = (sample >= 0) & (sample < len(recording))
+    changes = [np.diff(bits, prepend=1 - bits[0]) != 0 for _, bits, _ in squares]
+    checked = np.any(changes, axis=0) & inside
+    dropped = np.zeros(len(records), dtype=bool)
+    for k in np.flatnonzero(checked & ~np.all([found | ~change for (_, _, found), change in zip(squares, changes)], axis=0)):
+        last = k - 1
+        while last >= 0 and dropped[last]:
+            last -= 1
+        if last < 0:
+            continue
+        for channel, bits, found in squares:
+            if last != k - 1 and bits[k] != bits[last]: # (after a dropped frame, it's a change from an earlier one)
+                edge = match_edges(predicted[[k]], bits[[k]], *edges[channel], tolerance)[0]
+                found[k] = not np.isnan(edge)
+                sample[k] = edge if found[k] else sample[k]
+                matched[k] |= found[k]
+            if bits[k] != bits[last] and not found[k]:
+                dropped[k] = True
+    # Refreshes between the frames whose transitions were found (shown frames in between each
+    #   took at least one). Where that's just one frame, it's how long that frame was up.
+    shown = np.flatnonzero(~dropped & inside)
+    measured = shown[matched[shown]]
+    spans = np.round(np.diff(sample[measured]) * refresh_rate / sample_rate).astype(int)
+    frames_in_span = np.diff(np.searchsorted(shown, measured))
+    refreshes = np.full(len(records), -1)
+    refreshes[measured[:-1][frames_in_span == 1]] = spans[frames_in_span == 1]
+    duplicated = refreshes > 1
+    drift_ppm = np.polyfit(window_times, offsets[:, 1] / low_rate, 1)[0] * 1e6 if len(offsets) > 1 else 0.0
+    summary = {
+        'Frames': len(records), 'Matched': int(matched.sum()), 'Dropped': int(dropped.sum()),
+        'Duplicated': int(duplicated.sum()), 'ExtraRefreshes': int(np.maximum(spans - frames_in_span, 0).sum()),
+        'Checked': int(checked.sum()), 'RefreshRate': float(refresh_rate),
+        'Windows': len(offsets), 'MeanScore': float(offsets[:, 2].mean()), 'ClockDriftPPM': float(drift_ppm),
+        'OffsetSeconds': float(offsets[0, 1] / low_rate),
+    }
+    return {'frame': records['frame'], 'sync_state': records['sync_state'], 'sample': sample, 'matched': matched,
+            'dropped': dropped, 'refreshes': refreshes, 'offsets': offsets, 'summary': summary}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Match a photodiode recording of the sync squares to a frame log')
+    parser.add_argument('recording', help='photodiode recording: raw interleaved samples, or .npy (samples x channels)')
+    parser.add_argument('frame_log', help='a .framelog file, or the base name of a rotated log (e.g., ExperimentLog2021-06-01_1200)')
+    parser.add_argument('--sample-rate', type=float, required=True, help='recording sample rate (Hz)')
+    parser.add_argument('--dtype', default='int16', help='sample type of a raw recording')
+    parser.add_argument('--channels', type=int, default=1, help='number of interleaved channels in a raw recording')
+    parser.add_argument('--header-bytes', type=int, default=0, help='bytes to skip at the start of a raw recording')
+    parser.add_argument('--code-channel', type=int, default=0, help='channel of the photodiode on the code (right) square')
+    parser.add_argument('--clock-channel', type=int, default=None, help='channel of the photodiode on the clock (left) square, if recorded')
+    parser.add_argument('--sync-code', default=None, help='SyncCode settings as JSON (default: from the log\'s _sync.json)')
+    parser.add_argument('--refresh-rate', type=float, default=None, help='display refresh rate (default: from the frame log)')
+    parser.add_argument('--analysis-rate', type=float, default=1000, help='rate (Hz) the code is matched at')
+    parser.add_argument('--window', type=float, default=20, help='seconds of recording matched at a time')
+    parser.add_argument('--max-offset', type=float, default=None,
+                        help='seconds the recording may start before or after the log (default: any - needed for short, repeating codes)')
+    parser.add_argument('--output', default=None, help='write the per-frame alignment to this .npz file')
+    args = parser.parse_args()
+
+    base = args.frame_log[:-len('.framelog')].rsplit('_', 1)[0] if args.frame_log.endswith('.framelog') else args.frame_log
+    if args.sync_code:
+        code_config = json.loads(args.sync_code)
+    elif os.path.exists('{}_sync.json'.format(base)):
+        with open('{}_sync.json'.format(base)) as f:
+            code_config = json.load(f)
+    else:
+        code_config = None
+        print('No {}_sync.json - assuming the default sync code'.format(base), file=sys.stderr)
+
+    result = align(Recording(args.recording, args.dtype, args.channels, args.header_bytes), load_frame_log(args.frame_log),
+                   args.sample_rate, sync_code(code_config), args.code_channel, args.clock_channel, args.analysis_rate,
+                   args.window, refresh_rate=args.refresh_rate, max_offset_seconds=args.max_offset)
+    summary = result['summary']
+    print('Matched {Matched} of {Frames} frames in {Windows} windows (mean score {MeanScore:.2f}); '
+          'clock drift {ClockDriftPPM:.1f} ppm, first offset {OffsetSeconds:.3f} s'.format(**summary))
+    print('{Dropped} of {Checked} checked frames dropped, {Duplicated} duplicated ({ExtraRefreshes} extra refreshes '
+          'at {RefreshRate:.2f} Hz)'.format(**summary))
+    if args.output:
+        np.savez(args.output, **{k: v for k, v in result.items() if k != 'summary'}, summary=json.dumps(summary))
@@ -0,0 +1,320 @@
+# Headless benchmark suite for PyRenderMaze. The renderer is run in an offscreen buffer with
+#   Panda3D's software renderer (tinydisplay), so this works on a Linux box without a GPU
+#   (or a rig). Results are printed (or written with --output) as JSON, for regression tracking:
+#
+#   python3 benchmark.py --output results.json
+#   python3 benchmark.py --quick --scenarios frames command_rtt
+#
+#   Each scenario runs in a fresh process (Panda3D only allows one ShowBase per process), with
+#   synthetic mazes of increasing size (see synthetic_maze()). Times are in milliseconds.
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import threading
+import subprocess
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+REPO_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+BENCHMARK_COMMAND_PORT = 18557 # (so we don't collide with a renderer running on this machine)
+BENCHMARK_POSITION_ADDRESSES = {'zmq': 'tcp://127.0.0.1:18556', 'shm': 'shm://pyrendermaze_benchmark'}
+TEXTURES = ['textures/checkerboard.png', 'textures/grating.png', 'textures/whitenoise.png', 'textures/gaussian.png']
+
+
+def synthetic_maze(n_features, track_length=240, seed=0):
+    # A maze with a floor plus n_features walls, wall cylinders and free-standing cylinders,
+    #   at random positions along the track and with a mix of textures.
+    rng = random.Random(seed)
+    features = {'Floor': {'Type': 'Plane', 'Width': 15, 'Height': track_length, 'XPos': 0, 'YPos': track_length / 2,
+                          'ZPos': 0, 'Facing': 'up', 'Texture': 'textures/whitenoise.png', 'TextureScaling': 20}}
+    for i in range(n_features):
+        y = rng.uniform(0, track_length)
+        color = [rng.random(), rng.random(), rng.random()]
+        if i % 3 == 0:
+            features['Wall{}'.format(i)] = {'Type': 'Wall', 'Bounds': [y, min(y + rng.uniform(5, 30), track_length)],
+                                            'Texture': rng.choice(TEXTURES), 'Color': color}
+        elif i % 3 == 1:
+            features['WallCylinder{}'.format(i)] = {'Type': 'WallCylinder', 'YPos': y, 'Height': 50, 'Radius': 5,
+                                                    'Texture': rng.choice(TEXTURES), 'TextureScaling': 10, 'Color': color}
+        else:
+            features['Cylinder{}'.format(i)] = {'Type': 'Cylinder', 'XPos': rng.uniform(-8, 8), 'YPos': y,
+                                                'Radius': rng.uniform(1, 3), 'Height': 30, 'Color': color}
+    return {'TrackLength': track_length, 'WallHeight': 20, 'WallDistance': 24, 'TrackFeatures': features}
+
+
+def display_config(n_views):
+    # n_views side by side views (e.g., left, straight ahead and right), each 640x480
+    angles = {1: [0], 3: [90, 0, -90]}.get(n_views, [0] * n_views)
+    return {
+        'WindowSize': [640 * n_views, 480],
+        'NViews': n_views,
+        'ViewAngles': angles,
+        'DisplayRegions': [[n / n_views, (n + 1) / n_views, 0, 1] for n in range(n_views)],
+        'MonitorSizes': [[43, 24]] * n_views,
+        'MonitorDistances': [12] * n_views,
+        'MonitorOffsets': [[0, 8]] * n_views,
+        'MazeCacheDirectory': None, # (always build)
+        'CommandPort': BENCHMARK_COMMAND_PORT,
+        'LatchReportFrames': 0,
+    }
+
+
+def summarize(seconds):
+    ms = np.asarray(seconds) * 1000
+    return {'n': len(ms), 'mean': float(np.mean(ms)), 'median': float(np.median(ms)),
+            'p95': float(np.percentile(ms, 95)), 'max': float(np.max(ms))}
+
+
+def make_app(n_views=1):
+    # Instantiate the renderer offscreen. (Only once per process!)
+    import main
+    main.configure_headless()
+    config = display_config(n_views)
+    main.configure_window(config, fullscreen=False)
+    main.App.printStatements = False
+    return main.App(display_config=config)
+
+
+# ---- Scenarios (each is run in its own process by run_isolated()) ----
+def bench_shapes(n_shapes=1000, repeat=5):
+    from benchmark_shapes import run_shape_benchmarks
+    return {name: t * 1e6 for name, t in run_shape_benchmarks(n_shapes, repeat).items()} # us per shape call
+
+
+def bench_init_track(feature_counts, repeat=3):
+    app = make_app()
+    results = {}
+    for optimize in (True, False):
+        app.optimize_maze = optimize
+        for n in feature_counts:
+            times = []
+            for r in range(repeat):
+                maze = synthetic_maze(n, seed=r)
+                t0 = time.perf_counter()
+                app.init_track(maze)
+                times.append(time.perf_counter() - t0)
+            results['{}_features{}'.format(n, '' if optimize else '_unoptimized')] = summarize(times)
+    return results
+
+
+def bench_frames(n_views, n_features, n_frames=300, warmup=30):
+    app = make_app(n_views)
+    app.init_track(synthetic_maze(n_features))
+    times = []
+    for frame in range(warmup + n_frames):
+        app.posY = (frame * 0.5) % 240 # walk down the track
+        t0 = time.perf_counter()
+        app.taskMgr.step()
+        if frame >= warmup:
+            times.append(time.perf_counter() - t0)
+    return summarize(times)
+
+
+def bench_command_rtt(n_queries=200, n_loads=5, n_features=50):
+    import zmq
+    from CommandProtocol import CommandClient
+    app = make_app()
+    client = CommandClient(zmq.Context.instance(), 'tcp://127.0.0.1:{}'.format(BENCHMARK_COMMAND_PORT))
+    rtts = {'QueryVersion': [], 'LoadModel': []}
+    requests = [('QueryVersion', {})] * n_queries + \
+               [('LoadModel', {'MazeConfig': synthetic_maze(n_features, seed=i)}) for i in range(n_loads)]
+    done = threading.Event()
+
+    def send_requests():
+        # The renderer only handles commands in its frame loop, so we send from another thread
+        for command, fields in requests:
+            t0 = time.perf_counter()
+            client.send(command, **fields)
+            client.recv()
+            rtts[command].append(time.perf_counter() - t0)
+        done.set()
+
+    threading.Thread(target=send_requests, daemon=True).start()
+    while not done.is_set():
+        app.taskMgr.step()
+    client.close()
+    return {command: summarize(t) for command, t in rtts.items()}
+
+
+STARTUP_SCRIPT = """
+import sys, json
+import main
+config = json.loads(sys.argv[1])
+main.configure_headless()
+main.configure_window(config, fullscreen=False)
+main.App.printStatements = False
+app = main.App(display_config=config)
+app.taskMgr.step() # (the startup report is written once the first frame is drawn)
+"""
+
+def bench_startup(fast_start=True, repeat=5):
+    # Time from starting Python to the first frame, by step (see main.StartupTimer). Each run
+    #   is a new interpreter, since most of the time goes on imports.
+    import tempfile
+    steps = {}
+    for r in range(repeat):
+        with tempfile.TemporaryDirectory() as directory:
+            report_file = os.path.join(directory, 'startup.json')
+            config = dict(display_config(1), FastStart=fast_start, StartupReportFile=report_file)
+            subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, json.dumps(config)], cwd=REPO_DIRECTORY,
+                           check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            with open(report_file) as f:
+                report = json.load(f)
+        for step in report['Steps']:
+            steps.setdefault(step['Step'], []).append(step['MS'] / 1000)
+        steps.setdefault('total', []).append(report['TotalMS'] / 1000)
+    return {step: summarize(seconds) for step, seconds in steps.items()}
+
+
+def bench_textures(size=256, repeat=10):
+    # Time to get a texture: decoding the shipped PNG, generating the same pattern procedurally,
+    #   and reading the generated one back from the disk cache (in a fresh registry each time)
+    import tempfile
+    from panda3d.core import Texture
+    import ProceduralTextures
+    results = {}
+    for pattern in ('grating', 'checkerboard', 'whitenoise', 'raised_sine'):
+        times = {'png': [], 'generated': [], 'disk_cache': []}
+        for r in range(repeat):
+            t0 = time.perf_counter()
+            Texture().read('textures/{}.png'.format(pattern))
+            times['png'].append(time.perf_counter() - t0)
+            with tempfile.TemporaryDirectory() as directory:
+                ProceduralTextures.set_cache_directory(directory)
+                for step in ('generated', 'disk_cache'):
+                    t0 = time.perf_counter()
+                    ProceduralTextures.procedural_texture({'Procedural': pattern, 'Size': size})
+                    times[step].append(time.perf_counter() - t0)
+        results.update({'{}_{}'.format(pattern, step): summarize(t) for step, t in times.items()})
+    return results
+
+
+def position_producer(transport, rate, duration, ready, cpu_seconds):
+    # Stream samples at rate Hz for duration seconds. The position is the time it was sent, so
+    #   the consumer can tell how old each sample is (perf_counter is system-wide on Linux).
+    import zmq
+    from PositionStream import POSITION_MESSAGE_FORMAT, SharedMemoryPositionWriter
+    import struct
+    address = BENCHMARK_POSITION_ADDRESSES[transport]
+    if transport == 'shm':
+        writer = SharedMemoryPositionWriter(address)
+        send = lambda n: writer.write(n, time.perf_counter())
+    else:
+        socket = zmq.Context.instance().socket(zmq.PUB)
+        socket.bind(address)
+        send = lambda n: socket.send(struct.pack(POSITION_MESSAGE_FORMAT, n, time.perf_counter()))
+    ready.set()
+    cpu_start = time.process_time()
+    t_next = time.perf_counter()
+    for n in range(int(rate * duration)):
+        send(n)
+        t_next += 1 / rate
+        time.sleep(max(0, t_next - time.perf_counter()))
+    cpu_seconds.value = time.process_time() - cpu_start
+    if transport == 'shm':
+        writer.close()
+    else:
+        socket.close(linger=0)
+
+
+def bench_position_transport(transport, rate=500, duration=5, frame_rate=60):
+    # Position stream latency and CPU use, with a producer process and a simulated render loop
+    #   which takes the newest sample once per frame (as the renderer does)
+    from PositionStream import make_position_receiver
+    context = multiprocessing.get_context('spawn')
+    ready, cpu_seconds = context.Event(), context.Value('d', 0.0)
+    producer = context.Process(target=position_producer, args=(transport, rate, duration + 1, ready, cpu_seconds))
+    producer.start()
+    ready.wait()
+    receiver = make_position_receiver(BENCHMARK_POSITION_ADDRESSES[transport])
+    receiver.start()
+    time.sleep(0.5) # (let the subscription settle)
+
+    ages, deliveries = [], []
+    cpu_start = time.process_time()
+    t_start = t_next = time.perf_counter()
+    while time.perf_counter() - t_start < duration:
+        t_next += 1 / frame_rate
+        time.sleep(max(0, t_next - time.perf_counter()))
+        sample = receiver.latest()
+        if sample:
+            ages.append(time.perf_counter() - sample[1])
+            deliveries.append(sample[2] - sample[1])
+    consumer_cpu = time.process_time() - cpu_start
+    receiver.stop()
+    producer.join()
+    results = {'frame_sample_age': summarize(ages), 'samples': receiver.n_samples,
+               'consumer_cpu_percent': 100 * consumer_cpu / duration,
+               'producer_cpu_percent': 100 * cpu_seconds.value / (duration + 1)}
+    if transport == 'zmq':
+        results['delivery'] = summarize(deliveries) # (shm samples are "received" when written)
+    return results
+
+
+def scenarios(quick):
+    # {scenario: [(label, function, args)]} - each run gets its own process
+    return {
+        'shapes': [(None, bench_shapes, (200 if quick else 1000,))],
+        'init_track': [(None, bench_init_track, ([10, 50] if quick else [10, 50, 200, 500],))],
+        'frames': [('{}_views_{}_features'.format(v, n), bench_frames, (v, n, 60 if quick else 300))
+                        for v in (1, 3) for n in ([50] if quick else [0, 50, 200])],
+        'command_rtt': [(None, bench_command_rtt, (50 if quick else 200, 2 if quick else 5))],
+        'startup': [('fast_start' if fast_start else 'default', bench_startup, (fast_start, 3 if quick else 10))
+                        for fast_start in (True, False)],
+        'textures': [(None, bench_textures, (256, 3 if quick else 10))],
+        'position_transport': [('{}_{}Hz'.format(transport, rate), bench_position_transport, (transport, rate, 2 if quick else 5))
+                                    for transport in ('zmq', 'shm') for rate in ([500] if quick else [500, 5000])],
+    }
+
+
+def run_isolated(fun, *args):
+    # Run fun(*args) in a fresh process (spawned, so it doesn't inherit any Panda3D state)
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(_run_in_repo, fun, *args).result()
+
+def _run_in_repo(fun, *args):
+    os.chdir(REPO_DIRECTORY) # (mazes refer to textures relative to here)
+    sys.path.insert(0, REPO_DIRECTORY)
+    sys.stdout = sys.stderr # keep the renderer's messages out of the JSON
+    return fun(*args)
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIRECTORY, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    from panda3d.core import PandaSystem
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': platform.node(), 'platform': platform.platform(),
+            'python': platform.python_version(), 'panda3d': PandaSystem.getVersionString(), 'commit': commit}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Headless PyRenderMaze benchmarks (JSON output)')
+    parser.add_argument('--scenarios', nargs='+', choices=list(scenarios(False)), default=list(scenarios(False)))
+    parser.add_argument('--quick', action='store_true', help='fewer/smaller runs (e.g., for CI)')
+    parser.add_argument('--output', default=None, help='write the JSON results here (default: stdout)')
+    args = parser.parse_args()
+
+    results = {'environment': environment(), 'quick': args.quick, 'results': {}}
+    for name in args.scenarios:
+        print('Running {}...'.format(name), file=sys.stderr)
+        t0 = time.perf_counter()
+        runs = scenarios(args.quick)[name]
+        if len(runs) == 1 and runs[0][0] is None:
+            results['results'][name] = run_isolated(runs[0][1], *runs[0][2])
+        else:
+            results['results'][name] = {label: run_isolated(fun, *fun_args) for label, fun, fun_args in runs}
+        print('  {:.1f} s'.format(time.perf_counter() - t0), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,38 @@
+# Microbenchmark comparing the per-vertex (GeomVertexWriter) geometry builders with the
+#   array-based ones in ParametricShapes. Run with `python3 benchmark_shapes.py [n_shapes]`.
+#   (benchmark.py also runs these, as part of the full suite.)
+import sys
+import timeit
+
+from ParametricShapes import (makePlane, makeCylinder, makePlaneVertexWriter, makeCylinderVertexWriter,
+                              makeGeom, planeVertices, cylinderVertices)
+
+plane_args = dict(facing='left', color=[1, 1, 1], texHScaling=2.0, texVScaling=1.0)
+cylinder_args = dict(facing='outward', color=[0, 0.5, 0.25], texHScaling=10.0, texVScaling=4.0)
+
+
+def shape_benchmarks(n_shapes):
+    return {
+        'makePlaneVertexWriter': lambda: [makePlaneVertexWriter(12, y, 10, 30, 20, **plane_args) for y in range(n_shapes)],
+        'makePlane': lambda: [makePlane(12, y, 10, 30, 20, **plane_args) for y in range(n_shapes)],
+        'makeGeom(planeVertices) batched': lambda: makeGeom([planeVertices(12, y, 10, 30, 20, **plane_args) for y in range(n_shapes)]),
+        'makeCylinderVertexWriter': lambda: [makeCylinderVertexWriter(12, y, 0, 5, 60, **cylinder_args) for y in range(n_shapes)],
+        'makeCylinder': lambda: [makeCylinder(12, y, 0, 5, 60, **cylinder_args) for y in range(n_shapes)],
+        'makeGeom(cylinderVertices) batched': lambda: makeGeom([cylinderVertices(12, y, 0, 5, 60, **cylinder_args) for y in range(n_shapes)]),
+    }
+
+
+def run_shape_benchmarks(n_shapes=1000, repeat=5):
+    # Returns {name: best time per shape in seconds}
+    return {name: min(timeit.repeat(fun, number=1, repeat=repeat)) / n_shapes
+                for name, fun in shape_benchmarks(n_shapes).items()}
+
+
+if __name__ == "__main__":
+    n_shapes = 1000
+    if len(sys.argv) > 1:
+        n_shapes = int(sys.argv[1])
+
+    print('{} shapes per run'.format(n_shapes))
+    for name, t in run_shape_benchmarks(n_shapes).items():
+        print('{:40s} {:8.2f} ms total {:8.2f} us/shape'.format(name, t * n_shapes * 1e3, t * 1e6))
@@ -1,74 +1,118 @@
 import zmq
 import yaml
-import pickle
+import time
+import argparse
 
+from CommandProtocol import CommandClient, ProtocolError, maze_digest
 
-maze_config_filename = "example-mazes/example_teleport.yaml"
-with open(maze_config_filename, "r") as stream:
-    maze_config = yaml.safe_load(stream)
-
-
-#
-#  Lazy Pirate client
-#  Use zmq_poll to do a safe request-reply
-#  To run, start lpserver and then randomly kill/restart it
 #
-#   Author: Daniel Lundin <dln(at)eintr(dot)org>
+#  Lazy Pirate style client, but sending to every rig at once: each rig has its own
+#  DEALER socket, and one poller waits on all of them. A rig that doesn't answer in
+#  time gets a fresh socket and the request is resent (to that rig only), so one
+#  offline rig costs REQUEST_TIMEOUT * REQUEST_RETRIES in total, not per rig.
 #
-import itertools
-import sys
 
 REQUEST_TIMEOUT = 2500
 REQUEST_RETRIES = 3
+COMMAND_PORT = 8557
+
+
+def endpoint(address):
+    # Rigs are given as "host" or "host:port" (e.g., "localhost:9001" for a stand-in renderer)
+    if ':' not in address:
+        address = '{}:{}'.format(address, COMMAND_PORT)
+    return 'tcp://{}'.format(address)
+
+
+def send_command(command, fields, client_IPs, success_status, timeout=REQUEST_TIMEOUT):
+    # Send command to every client in parallel. Returns {ip: (reply, latency in seconds)},
+    #   where reply is the reply body (None if the client never answered). Replies are
+    #   matched to requests by their request ID, so a late reply to an earlier (retried)
+    #   attempt is simply ignored.
+    context = zmq.Context.instance()
+    poller = zmq.Poller()
+    clients = {} # ip -> [client, request_id, time sent, deadline, retries left]
+    results = {}
+
+    def start(ip, retries_left):
+        client = CommandClient(context, endpoint(ip))
+        poller.register(client.socket, zmq.POLLIN)
+        t_sent = time.monotonic()
+        clients[ip] = [client, client.send(command, **fields), t_sent, t_sent + timeout / 1000, retries_left]
+
+    def finish(ip, reply):
+        client, _, t_sent, _, _ = clients.pop(ip)
+        poller.unregister(client.socket)
+        client.close()
+        results[ip] = (reply, time.monotonic() - t_sent)
 
-
-
-
-def send_command(msg, client_IPs, success_reply):
-    context = zmq.Context()
     for ip in client_IPs:
-        SERVER_ENDPOINT = "tcp://{}:8557".format(ip)
-        client = context.socket(zmq.REQ)
-        client.connect(SERVER_ENDPOINT)
-        print('Sending to {}'.format(ip))
-        client.send(pickle.dumps(msg))
-
-        retries_left = REQUEST_RETRIES
-        while True:
-            if (client.poll(REQUEST_TIMEOUT) & zmq.POLLIN) != 0:
-                reply = client.recv()
-                print(reply)
-                if reply == success_reply:
-                    break
-                else:
-                    continue
-
-            retries_left -= 1
-            # Socket is confused. Close and remove it.
-            client.setsockopt(zmq.LINGER, 0)
+        print('Sending {} to {}'.format(command, ip))
+        start(ip, REQUEST_RETRIES)
+
+    def retry(ip, retries_left):
+        # Socket is confused. Close and remove it.
+        finish(ip, None)
+        if retries_left > 1:
+            print("+ {}".format(ip))
+            start(ip, retries_left - 1) # (the latency is counted from the last attempt)
+
+    try:
+        while clients:
+            next_deadline = min(c[3] for c in clients.values())
+            events = dict(poller.poll(max(0, next_deadline - time.monotonic()) * 1000))
+            for ip, (client, request_id, _, deadline, retries_left) in list(clients.items()):
+                if client.socket in events:
+                    try:
+                        reply_id, _, reply = client.recv()
+                    except ProtocolError as e:
+                        # (e.g., something other than a rig is listening on that port)
+                        print('{}: bad reply ({})'.format(ip, e))
+                        retry(ip, retries_left)
+                        continue
+                    if reply_id == request_id:
+                        finish(ip, reply)
+                elif time.monotonic() >= deadline:
+                    retry(ip, retries_left)
+    finally:
+        for client, _, _, _, _ in clients.values():
             client.close()
-            if retries_left == 0:
-                print("Server {} seems to be offline, abandoning".format(ip))
-                break
-
-            print("+")
-            # Create new connection
-            client = context.socket(zmq.REQ)
-            client.connect(SERVER_ENDPOINT)
-            client.send(pickle.dumps(msg))
-
-        client.close()
-
-
-client_IPs = ['10.129.151.177', '10.129.151.185', '10.129.151.166']
-msg = {'Command':'LoadModel', 'MazeConfig':maze_config}
-success_reply = b'ModelLoaded'
-
-send_command(msg, client_IPs, success_reply)
-
-
-msg = {'Command':'UpdateDataServer', 'DataServerAddress':"tcp://10.129.151.168:8556"}
-success_reply = b'DataServerUpdated'
-
-send_command(msg, client_IPs, success_reply)
 
+    for ip in client_IPs:
+        reply, latency = results[ip]
+        if reply is None:
+            print("Server {} seems to be offline, abandoning".format(ip))
+        elif reply['Status'] != success_status:
+            print('{}: {} ({:.1f} ms)'.format(ip, reply, latency * 1e3))
+        else:
+            print('{}: {} ({:.1f} ms)'.format(ip, reply['Status'], latency * 1e3))
+    return results
+
+
+def load_model(maze_config, client_IPs, timeout=30000):
+    # Ask for the maze by hash first, and only upload the whole config to rigs which
+    #   don't already have it. The LoadModel reply is only sent once the maze is being
+    #   displayed, so allow for the build in the timeout.
+    fields = {'MazeHash': maze_digest(maze_config)}
+    results = send_command('LoadModel', fields, client_IPs, 'ModelLoaded', timeout)
+    misses = [ip for ip, (reply, _) in results.items() if reply is not None and reply['Status'] == 'ModelNotCached']
+    if misses:
+        fields['MazeConfig'] = maze_config
+        results.update(send_command('LoadModel', fields, misses, 'ModelLoaded', timeout))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Configure PyRenderMaze rigs with a maze and a position data server')
+    parser.add_argument('clients', nargs='*', default=['10.129.151.177', '10.129.151.185', '10.129.151.166'],
+                        help='rig addresses, "host" or "host:port"')
+    parser.add_argument('--maze', default="example-mazes/example_teleport.yaml", help='maze YAML file')
+    parser.add_argument('--data-server', default="tcp://10.129.151.168:8556", help='position stream address')
+    args = parser.parse_args()
+
+    with open(args.maze, "r") as stream:
+        maze_config = yaml.safe_load(stream)
+
+    load_model(maze_config, args.clients)
+
+    send_command('UpdateDataServer', {'DataServerAddress':args.data_server}, args.clients, 'DataServerUpdated')
@@ -1,53 +1,123 @@
+# Startup is timed from here (see StartupTimer)
+import time
+STARTUP_T0 = time.perf_counter()
+
 # Core imports
-from panda3d.core import *
+from panda3d.core import loadPrcFileData, Camera, PerspectiveLens, GeomNode, TextNode, VBase4
 from direct.showbase.ShowBase import ShowBase
-from direct.gui.OnscreenText import OnscreenText
 # Task managers
 from direct.task.Task import Task
-# GUI
-from panda3d.core import loadPrcFileData
 
 # Utilities
 import zmq
 import numpy as np
 import math
-import yaml
-import pickle
+import json
 import datetime
-import csv
+import threading
 
 import sys
-from subprocess import check_output
-
-import struct
-
-import platform
-import socket
-
-# Local code
-from ParametricShapes import makeCylinder, makePlane
-
-version = '1.0'
-
-# Read YAML file
-with open("display_config.yaml", 'r') as stream:
-    display_config = yaml.safe_load(stream)
-
-# Globally change window title name
-windowTitle = "PyRenderMaze"
-loadPrcFileData("", f"window-title {windowTitle}")
-
-w, h = display_config.get("WindowSize", (640, 480))
-loadPrcFileData("", "win-size {} {}".format(w, h))
-loadPrcFileData("", "fullscreen true") # causes some sort of bug where run loop doesn't start in Ubuntu
-# loadPrcFileData("", "auto-flip 1") # try speed up
-# loadPrcFileData("", "sync-video 0") # try speed up
-# loadPrcFileData("", "back-buffers 0") # try speed up - this causes run loop not to start?
-
-
-maze_config_filename = "example-mazes/example_teleport.yaml"
-with open(maze_config_filename, "r") as stream:
-    maze_config = yaml.safe_load(stream)
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+
+# Local code (modules which are only needed for optional features - FrameLog, Telemetry,
+#   PositionStream - are imported when they're first used, to keep startup fast)
+from PositionPredictor import make_predictor
+from CommandProtocol import PROTOCOL_VERSION, ProtocolError, decode_message, check_request, encode_reply, error_reply, maze_digest
+from MazeBuilder import build_maze, update_maze, display_tessellation_error
+from MazeCache import MazeCache
+import TextureManager
+import ProceduralTextures
+
+version = '2.0'
+
+def load_display_config(filename="display_config.yaml"):
+    # Read YAML file (with libyaml's parser if it's available - it's much faster)
+    import yaml
+    with open(filename, 'r') as stream:
+        return yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+def configure_window(display_config, fullscreen=True):
+    # Panda3D reads these settings when the window is opened, so this has to be called before App()
+    # Globally change window title name
+    windowTitle = "PyRenderMaze"
+    loadPrcFileData("", f"window-title {windowTitle}")
+
+    w, h = display_config.get("WindowSize", (640, 480))
+    loadPrcFileData("", "win-size {} {}".format(w, h))
+    if 'WindowOrigin' in display_config: # (set for view processes - see MultiView.py)
+        loadPrcFileData("", "win-origin {} {}".format(*display_config['WindowOrigin']))
+        loadPrcFileData("", "undecorated true")
+    if display_config.get('FastStart', True):
+        # Don't look for Python model loader plugins when ShowBase starts (this scans every
+        #   installed package's metadata, and we only load textures and .bam files)
+        loadPrcFileData("", "loader-support-entry-points false")
+    if fullscreen:
+        loadPrcFileData("", "fullscreen true") # causes some sort of bug where run loop doesn't start in Ubuntu
+    # loadPrcFileData("", "auto-flip 1") # try speed up
+    # loadPrcFileData("", "sync-video 0") # try speed up
+    # loadPrcFileData("", "back-buffers 0") # try speed up - this causes run loop not to start?
+
+def configure_headless():
+    # Render to an offscreen buffer with Panda3D's software renderer, so that no display (or
+    #   GPU) is needed. Used by benchmark.py and render_trace.py. Call before App().
+    loadPrcFileData("", "window-type offscreen\nload-display p3tinydisplay\naudio-library-name null\nsync-video 0")
+
+class StartupTimer:
+    """ StartupTimer: how long each step of startup took, from when main.py was first imported
+
+        mark(step) records that step as finished. report() gives the time each step took, and
+        the total, in ms. These are printed when the first frame has been drawn, and written
+        as JSON to StartupReportFile (if it's set in the display config).
+    """
+    def __init__(self, t0):
+        self.t0 = t0
+        self.marks = [] # (step, time it finished)
+
+    def mark(self, step):
+        self.marks.append((step, time.perf_counter()))
+
+    def report(self):
+        steps, last = [], self.t0
+        for step, t in self.marks:
+            steps.append({'Step': step, 'MS': (t - last) * 1000})
+            last = t
+        return {'Steps': steps, 'TotalMS': (last - self.t0) * 1000}
+
+    def print_report(self):
+        report = self.report()
+        print('Startup took {:.0f} ms: '.format(report['TotalMS']) +
+              ', '.join('{} {:.0f}'.format(step['Step'], step['MS']) for step in report['Steps']))
+
+    def export(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+startup_timer = StartupTimer(STARTUP_T0)
+startup_timer.mark('imports')
+
+def lookup_ip_address(retry_interval=0.5):
+    # The address to show on screen when no maze is loaded. After a reboot, networking may not
+    #   be up yet, so we keep trying (this is run on a background thread - see App).
+    import platform
+    import socket
+    import subprocess
+    while True:
+        IP = None
+        try:
+            if platform.system() == 'Linux':
+                IP = subprocess.check_output(['hostname', '-I']).decode("utf-8","ignore").strip()
+            elif platform.system() == 'Darwin':
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                    s.connect(('8.8.8.8', 80))
+                    IP = s.getsockname()[0]
+            else:
+                return None
+        except (OSError, subprocess.CalledProcessError):
+            pass
+        if IP and len(IP) >= 7:
+            return IP
+        time.sleep(retry_interval)
 
 class App(ShowBase):
     printStatements = True
@@ -55,6 +125,7 @@ class App(ShowBase):
     posX = 0.0
     posY = 0.0
     posZ = 0.0
+    stream_posY = 0.0 # the newest position sample (posY is where the cameras are, i.e., the prediction)
 
     do_frame_synchronization = False # Make this true to enable a task which flashes squares per frame
 
@@ -74,7 +145,19 @@ class App(ShowBase):
                     # the screen. We'll adjust to offset the monitor later.
 
     def __init__(self, display_config={}, maze_config={}):
+        # ZMQ server connection for commands. This is bound first thing, so that controllers can
+        #   connect (and queue commands) while the window is opened and the first maze is built.
+        # We use a ROUTER socket, so several controllers can talk to us at once, and replies
+        #   to slow commands don't hold up anybody else.
+        command_socket_port = display_config.get('CommandPort', 8557)
+        # Socket to talk to server
+        context = zmq.Context()
+        self.command_socket = context.socket(zmq.ROUTER)
+        self.command_socket.bind(display_config.get('CommandAddress', "tcp://*:%s" % command_socket_port))
+        startup_timer.mark('command socket')
+
         ShowBase.__init__(self)
+        startup_timer.mark('window')
         
         # For the proper VR perspective, we need to define the mouse's eye position.
         #   Because we are only using 2D displays, we'll assume they are a cyclops.
@@ -165,37 +248,100 @@ class App(ShowBase):
             lens.setNear(1)
             lens.setFar(5000.0)
             current_cam_node.node().setLens(lens)
+        startup_timer.mark('cameras')
+
+        # The camera is placed where the animal is predicted to be when the frame is displayed,
+        #   PredictionHorizonMS after the camera is set (see PositionPredictor.py)
+        self.predictor = make_predictor(display_config.get('PositionPredictor', 'none'),
+                                        timestamp_units=display_config.get('PositionTimestampUnits', 1e-3))
+        self.prediction_horizon = display_config.get('PredictionHorizonMS', 0) / 1000
+
+        # Flatten and merge maze geometry after it's built to minimize draw calls
+        self.optimize_maze = display_config.get('OptimizeMaze', True)
+        self.tessellation_error = display_tessellation_error(display_config) # (cylinders are tessellated for this display)
+
+        # Textures are shared by all mazes through one registry, with a memory budget
+        self.texture_manager = TextureManager.TextureManager(display_config.get('TextureMemoryMB', 128),
+                                                             display_config.get('TextureCacheDirectory', None))
+        TextureManager.install(self.texture_manager)
+        ProceduralTextures.set_cache_directory(display_config.get('ProceduralTextureCacheDirectory', 'texture_cache'))
+
+        # The IP address is shown when there's no maze. It's looked up in the background (so
+        #   startup doesn't wait for the network to come up), and shown once it's known.
+        self.ip_address = None
+        threading.Thread(target=self.lookup_ip_address, name='IPLookup', daemon=True).start()
+        self.taskMgr.add(self.show_ip_address_when_known, "ShowIPAddress")
 
         self.maze_geometry_root = None
+        self.current_model = None
         self.init_track(maze_config)
+        startup_timer.mark('first maze')
+
+        # Mazes requested with LoadModel are built on a worker thread so the display doesn't freeze
+        self.model_loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ModelLoader')
+        # Textures are preloaded so the first maze doesn't wait on PNG decoding. With FastStart,
+        #   this (and anything else the first frame doesn't need) waits until it has been drawn.
+        self.fast_start = display_config.get('FastStart', True)
+        if not self.fast_start:
+            self.model_loader.submit(self.texture_manager.preload, 'textures')
+        # Built mazes are cached on disk, so reloading a maze we've seen before is just a file read
+        cache_directory = display_config.get('MazeCacheDirectory', 'maze_cache') # null disables the cache
+        self.maze_cache = MazeCache(cache_directory, display_config.get('MazeCacheSizeMB', 256)) if cache_directory else None
+        self.pending_models = [] # (future, reply_to)
+        self.model_status = 'ModelLoaded'
+        self.model_status_fields = {}
+        # Controllers can ask for a maze by its hash alone if we've been sent it before
+        self.known_mazes = OrderedDict() # MazeHash -> maze config, least recently used first
+
+        # Mazes can also be built ahead of time (PreloadModel) and kept detached from render until
+        #   they are switched in (ActivateModel). Least recently used ones are dropped to stay
+        #   within the memory budget.
+        self.preloaded_models = OrderedDict() # ModelID -> MazeModel, least recently used first
+        self.preload_bytes = {} # ModelID -> memory used by the preloaded model (measured once, when it's built)
+        self.pending_preloads = {} # ModelID -> (future, reply_to)
+        self.superseded_preloads = [] # (ModelID, future, reply_to) - replaced by a later PreloadModel with the same ID
+        self.preload_failures = set()
+        self.preload_budget_bytes = display_config.get('PreloadMemoryMB', 64) * 1024 * 1024
 
         base.setBackgroundColor(0, 0, 0)  # set the background color to black
 
-        # ZMQ server connection for commands. 
-        # We use a DEALER/REP architecture for reliability.
-        command_socket_port = "8557"
-        # Socket to talk to server
-        context = zmq.Context()
-        self.command_socket = context.socket(zmq.REP)
-        self.command_socket.bind("tcp://*:%s" % command_socket_port)
-
-        self.poller = zmq.Poller()
-        self.poller.register(self.command_socket, zmq.POLLIN)
-
-        self.data_socket = None # This will be configured by remote control
+        self.position_receiver = None # This will be configured by remote control
+        self.frame_start_receive_time = None
 
         self.last_timestamp = 0
         self.taskMgr.add(self.process_command_messages, "ReadZMQMessages", sort=1)
+        # The cameras are positioned in a separate task right before igLoop (sort 50), which culls
+        #   and draws the frame, so that we use the newest sample we can.
+        self.latch_ages = [] # (age of the frame start sample, age of the latched sample), in s, both when latched
+        self.latch_report_frames = display_config.get('LatchReportFrames', 600)
+        self.taskMgr.add(self.late_latch_cameras, "LateLatchCameras", sort=48)
+        # When views are drawn by several processes (see MultiView.py), they all use the position
+        #   and frame number latched by the first one. ActivateModel can be scheduled for a frame.
+        self.frame_barrier = None
+        self.camera_frame = 0
+        self.scheduled_activations = [] # (frame, ModelID)
+
+        # Per-frame telemetry (position used, when it was received, when the frame was drawn) is
+        #   published for Telemetry.py if TelemetryAddress is set. It's sent after igLoop.
+        self.telemetry = None
+        self.receive_time = float('nan')
+        telemetry_address = display_config.get('TelemetryAddress', None)
+        if telemetry_address:
+            from Telemetry import TelemetryPublisher
+            self.telemetry = TelemetryPublisher(telemetry_address)
+            self.taskMgr.add(self.publish_telemetry, "PublishTelemetry", sort=51)
 
         self.accept('escape', self.exit_fun)
 
         # -----------------------------------------
         # Instrumentation code
+        self.do_frame_synchronization = display_config.get('FrameSynchronization', self.do_frame_synchronization)
         if self.do_frame_synchronization:
             # Frame synchronization (if desired) is done with two squares in the bottom corners.
-            # One will flash per frame, and the other in a less periodic pattern. We write the most
-            #   recent position data and the square states to disk for post-hoc comparison with the
-            #   recorded data.
+            # One will flash per frame, and the other shows a pseudorandom code (see SyncCode.py).
+            #   We write the most recent position data and the square states to disk for post-hoc
+            #   comparison with the recorded data (see align_sync.py).
+            from ParametricShapes import makePlane
             sync_square_width = 0.05
             left_square = makePlane(-1 + sync_square_width/2, 0, -1 + sync_square_width/2, 
                 sync_square_width, sync_square_width, facing='front',color=[0, 0, 0])
@@ -208,197 +354,262 @@ class App(ShowBase):
             self.left_sync_square = render2d.attachNewNode(left_square_node)
             self.right_sync_square = render2d.attachNewNode(right_square_node)
 
+            from SyncCode import sync_code, sync_code_parameters
+            self.sync_code = sync_code(display_config.get('SyncCode', None))
             self.sync_state = 0
-            self.taskMgr.add(self.syncSquares, "FlashSyncSquares", sort=2) # execute after the process_command_messages function
+            self.taskMgr.add(self.syncSquares, "FlashSyncSquares", sort=49) # execute after late_latch_cameras, so we log what's drawn
             now = datetime.datetime.now()
-            filename = '{}{}.csv'.format('ExperimentLog', now.strftime("%Y-%m-%d_%H%M"))
-            self.sync_log_file = open(filename, 'w', newline='')
-            self.sync_log_writer = csv.writer(self.sync_log_file)
+            # Records are binary (see FrameLog.py, which also converts them to CSV) and written by
+            #   a background thread, so a slow disk can't hold up the frame.
+            filename = '{}{}'.format('ExperimentLog', now.strftime("%Y-%m-%d_%H%M"))
+            from FrameLog import FrameLogger
+            self.sync_log = FrameLogger(filename)
+            with open('{}_sync.json'.format(filename), 'w') as f: # (so align_sync.py knows which code was shown)
+                json.dump(sync_code_parameters(display_config.get('SyncCode', None)), f)
 
 
         base.setFrameRateMeter(True) # Display frame rate
 
+        # Once the first frame is drawn, report how long startup took and start deferred work
+        self.startup_report_file = display_config.get('StartupReportFile', None)
+        self.taskMgr.add(self.first_frame_drawn, "FirstFrameDrawn", sort=52)
+        startup_timer.mark('tasks')
+
 
     def remove_model(self):
         if self.maze_geometry_root:
-            self.maze_geometry_root.removeNode()
+            if self.current_model in self.preloaded_models.values():
+                self.maze_geometry_root.detachNode() # keep it around so it can be activated again
+            else:
+                self.maze_geometry_root.removeNode()
             self.maze_geometry_root = None
+            self.current_model = None
         if self.IP_address_text:
             self.IP_address_text.destroy()
             self.IP_address_text = None
     
-    def draw_model(self, maze_config):
-        if self.maze_geometry_root:
-            self.remove_model()
-        success = False
+    def draw_model(self, maze_config, reply_to=None):
+        # Start building the maze in the background. The current maze stays on screen until
+        #   the new one is ready, at which point check_model_loading() swaps it in (in one frame)
+        #   and replies to reply_to (if given).
+        self.pending_models.append((self.model_loader.submit(self.build_model, maze_config), reply_to))
+        self.model_status = 'ModelLoading'
+        self.model_status_fields = {}
+
+    def build_model(self, maze_config):
+        # NOTE: This runs on the model loader thread! It must not touch render. The only
+        #   state it keeps is latest_model (the most recently built maze), which it uses to
+        #   avoid rebuilding features that haven't changed.
+        builder_args = (self.trackVPos, self.roomSize, self.optimize_maze, self.tessellation_error)
         try:
-            self.init_track(maze_config)
+            model = self.cached_model(maze_config, builder_args)
+            if model is None:
+                model = update_maze(self.latest_model, maze_config, *builder_args)
+                if model is None:
+                    model = build_maze(maze_config, *builder_args)
+                if self.maze_cache:
+                    try:
+                        self.maze_cache.store_model(model, *builder_args)
+                    except Exception as e: # (the maze is fine - it just won't be cached)
+                        print('Failed to cache maze ({})'.format(e))
             success = True
         except Exception as e:
             print(e)
-            self.init_track({})
-
-        return success
-
-    def init_track(self, trackConfig):
-        trackFeatures = trackConfig.get('TrackFeatures', None)
-
-        self.trackLength = trackConfig.get('TrackLength', 240)
-        self.wallHeight = trackConfig.get('WallHeight', 20)
-        self.wallDistance = trackConfig.get('WallDistance', 24) # Ideally this is equal to the screen distances on the sides
-
-        testTexture = loader.loadTexture("textures/numbers.png")
-        checkerboard = loader.loadTexture("textures/checkerboard.png")
-        noise = loader.loadTexture("textures/whitenoise.png")
-
-        maze_root_node = GeomNode("maze_root_node")
-        self.maze_geometry_root = self.render.attachNewNode(maze_root_node)
-
-        room_wall_cylinder = makeCylinder(0, self.trackLength/2, -5*self.roomSize/2, self.roomSize, 10*self.roomSize, 
-                                          facing="inward", texHScaling=12, texVScaling=12, color=[1.0, 1.0, 1.0])
-
-        if trackConfig.get('EnableBackgroundTexture', True):
-            snode = GeomNode('room_walls')
-            snode.addGeom(room_wall_cylinder)
-            room_walls = self.maze_geometry_root.attachNewNode(snode)
-            room_walls.setTexture(noise)
-            # walls_node.setTwoSided(True)
-
-        # trackLength, trackWidth, wallDistance all could be parametric, but I think most likely these wouldn't need to change often
-        track_parent = self.maze_geometry_root.attachNewNode(GeomNode('MazeParent'))
-
-        # if self.printStatements:
-        #     print("i: -1",  "startPoint: ",  points[0]-100, "endPoint: ", 250)
-
-        if trackFeatures:
-            for featureName, feature in trackFeatures.items():
-                color = feature.get('Color', [0.5, 0.5, 0.5])
-                texScale = feature.get('TextureScaling', 1.0)
-                snode = GeomNode(featureName)
-                alpha = feature.get('Alpha', 1.0)
-
-                if feature.get('Type') == 'Wall':
-                    length = feature['Bounds'][1] - feature['Bounds'][0]
-                    center = (feature['Bounds'][1] + feature['Bounds'][0])/2
-                    x_offset = feature.get('XOffset', 0)
-
-                    if feature.get('XLocation', 'Both').lower() in ['right', 'both']:
-                        right = makePlane(self.wallDistance + x_offset, center, self.trackVPos + self.wallHeight/2, 
-                                                    length, self.wallHeight, facing="Left", color=color, alpha=alpha,
-                                                    texHScaling=length/self.wallHeight*texScale, texVScaling=texScale)
-                        snode.addGeom(right)
-                    if feature.get('XLocation', 'Both').lower() in ['left', 'both']:
-                        left = makePlane(-self.wallDistance - x_offset, center, self.trackVPos + self.wallHeight/2, 
-                                                    length, self.wallHeight, facing="Right", color=color, alpha=alpha,
-                                                    texHScaling=length/self.wallHeight*texScale, texVScaling=texScale)
-                    snode.addGeom(left)
-
-                elif feature.get('Type') == 'Plane':
-                    width = feature.get('Width')
-                    height = feature.get('Height')
-                    plane = makePlane(feature.get('XPos', 0), feature.get('YPos', 0), feature.get('ZPos', 0), 
-                                                    width, feature.get('Height'), facing=feature.get('Facing'),
-                                                    color=color, alpha=alpha,
-                                                    texHScaling=width/height*texScale, texVScaling=texScale)
-                    snode.addGeom(plane)
-
-                elif feature.get('Type') == 'WallCylinder':
-                    h = feature.get('Height',self.wallHeight*3)
-                    r = feature.get('Radius',5)
-
-                    if feature.get('XLocation', 'Both').lower() in ['left', 'both']:
-                        cylinder = makeCylinder(-self.wallDistance, feature.get('YPos'), 
-                                                            self.trackVPos, r, h, color=color, texHScaling=texScale, 
-                                                            texVScaling=texScale * (math.pi * 2 * r) / h, alpha=alpha)
-                        snode.addGeom(cylinder)
-                    
-                    if feature.get('XLocation', 'Both').lower() in ['right', 'both']:
-                        cylinder = makeCylinder(self.wallDistance, feature.get('YPos'), 
-                                                            self.trackVPos, r, h, color=color, texHScaling=texScale, 
-                                                            texVScaling=texScale * (math.pi * 2 * r) / h, alpha=alpha)
-                        snode.addGeom(cylinder)
-
-                elif feature.get('Type') == 'Cylinder':
-                    h = feature.get('Height',self.wallHeight*3)
-                    r = feature.get('Radius',5)
-                    cylinder = makeCylinder(feature.get('XPos'), feature.get('YPos'), 
-                                                        feature.get('ZPos', self.trackVPos), r, h, facing=feature.get('Facing','outward'),
-                                                        color=color, texHScaling=texScale, 
-                                                        texVScaling=texScale * (math.pi * 2 * r) / h,
-                                                        alpha=alpha)
-                    snode.addGeom(cylinder)
-
-                if feature.get('DuplicateForward', True):
-                    node = track_parent.attachNewNode(snode)
+            model = build_maze({}, *builder_args)
+            success = False
+        self.latest_model = model
+        return model, success
+
+    def cached_model(self, maze_config, builder_args):
+        # (model loader thread) A maze from the maze cache, or None. Cache errors count as a miss.
+        if not self.maze_cache:
+            return None
+        try:
+            return self.maze_cache.load_model(maze_config, *builder_args)
+        except Exception as e:
+            print('Failed to read maze cache ({})'.format(e))
+            return None
+
+    def check_model_loading(self):
+        # Swap in any models which have finished building. Requests complete in order, so if
+        #   several are done at once, only the newest is shown.
+        while self.pending_models and self.pending_models[0][0].done():
+            future, reply_to = self.pending_models.pop(0)
+            model, success = future.result()
+            if self.pending_models and self.pending_models[0][0].done():
+                model.root.removeNode() # superceded before it was ever displayed
+                self.send_reply(reply_to, 'LoadModel', 'ModelSuperseded')
+                continue
+            self.show_model(model)
+            status = 'ModelLoaded' if success else 'ModelFailure'
+            fields = {'NodesTouched': model.nodes_touched} if model.nodes_touched is not None else {}
+            if not self.pending_models:
+                self.model_status, self.model_status_fields = status, fields
+            self.send_reply(reply_to, 'LoadModel', status, **fields)
+
+    def preload_model(self, model_id, maze_config, reply_to=None):
+        # Build a maze in the background, but don't display it until ActivateModel. If a model
+        #   with this ID is still being built, it's replaced by this one (and its requester gets
+        #   "ModelSuperseded" once it's done).
+        self.evict_model(model_id)
+        if model_id in self.pending_preloads:
+            self.superseded_preloads.append((model_id,) + self.pending_preloads.pop(model_id))
+        self.pending_preloads[model_id] = (self.model_loader.submit(self.build_preload, maze_config), reply_to)
+
+    def build_preload(self, maze_config):
+        # (runs on the model loader thread) Also measures the model, so the frame loop doesn't have to
+        model, success = self.build_model(maze_config)
+        return model, success, model.memory_bytes
+
+    def check_preloading(self):
+        for model_id, future, reply_to in [p for p in self.superseded_preloads if p[1].done()]:
+            self.superseded_preloads.remove((model_id, future, reply_to))
+            future.result()[0].root.removeNode()
+            self.send_reply(reply_to, 'PreloadModel', 'ModelSuperseded', ModelID=model_id)
+        completed = False
+        for model_id, (future, reply_to) in list(self.pending_preloads.items()):
+            if future.done():
+                del self.pending_preloads[model_id]
+                model, success, memory_bytes = future.result()
+                if success:
+                    self.preloaded_models[model_id] = model
+                    self.preload_bytes[model_id] = memory_bytes
+                    completed = True
                 else:
-                    node = self.maze_geometry_root.attachNewNode(snode)
-
-                if alpha < 1.0:
-                    node.setTransparency(TransparencyAttrib.MAlpha)
-
-                if 'Texture' in feature:
-                    tex = loader.loadTexture(feature['Texture'])
-                    node.setTexture(tex)
-                    if 'RotateTexture' in feature:
-                        node.setTexRotate(TextureStage.getDefault(), feature['RotateTexture'])
-
-            # BIG TODO - add in sgments of default color featureless wall between the labeled sections.
-            #          - we can do this in the YAML file, but it seems cleaner to have it done automatically.
-            #          - need a function to (1) check that bounds never overlap, and (2) find residual
-            #            segment boundaries
-
-
-        else:
-            # Default walls - light gray. Height could be parametric. These will fill any unspecified gaps
-            snode = GeomNode('default_walls')
-            right = makePlane(self.wallDistance, self.trackLength/2, self.trackVPos + self.wallHeight/2, 
-                                            self.trackLength, self.wallHeight, facing="left", color=[0.5, 0.5, 0.5],
-                                            texHScaling=self.trackLength/self.wallHeight)
-            snode.addGeom(right)
-            left = makePlane(-self.wallDistance, self.trackLength/2, self.trackVPos + self.wallHeight/2, 
-                                            self.trackLength, self.wallHeight, facing="right", color=[0.5, 0.5, 0.5],
-                                            texHScaling=self.trackLength/self.wallHeight)
-            snode.addGeom(left)
-            walls = track_parent.attachNewNode(snode)
-
-            if not self.IP_address_text:
-                IP = None
-                if platform.system() == 'Linux':
-                    # Render IP address by default
-                    IP = check_output(['hostname', '-I']).decode("utf-8","ignore")
-                    while len(IP) < 7:
-                        IP = check_output(['hostname', '-I']).decode("utf-8","ignore")
-                elif platform.system() == 'Darwin':
-                    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s: 
-                        s.connect(('8.8.8.8', 80)) 
-                        IP = s.getsockname()[0]
-                self.IP_address_text = OnscreenText(text=IP, pos=(0, 0.75), scale=0.1, align=TextNode.ACenter, fg=[1, 0, 0, 1])
-
-
-        # Make a copy of the walls and floor at the end of the maze. This makes it look like it goes on further
-        node = GeomNode('track_copy')
-        maze_geometry_copy_parent = self.maze_geometry_root.attachNewNode(node)
-        second_maze = track_parent.copyTo(maze_geometry_copy_parent)
-        maze_geometry_copy_parent.setPos(0, self.trackLength, 0)
+                    model.root.removeNode()
+                    self.preload_failures.add(model_id)
+                self.send_reply(reply_to, 'PreloadModel', self.preload_status(model_id), ModelID=model_id)
+        # Stay within the memory budget, but always keep at least the newest preload
+        while completed and len(self.preloaded_models) > 1 and sum(self.preload_bytes.values()) > self.preload_budget_bytes:
+            model_id = next(iter(self.preloaded_models))
+            print('Preloaded model {} evicted (memory budget)'.format(model_id))
+            self.evict_model(model_id)
+
+    def evict_model(self, model_id):
+        self.preload_failures.discard(model_id)
+        self.preload_bytes.pop(model_id, None)
+        model = self.preloaded_models.pop(model_id, None)
+        if model is None:
+            return False
+        if model is not self.current_model: # (if it's being displayed, it goes when it's replaced)
+            model.root.removeNode()
+        return True
+
+    def activate_model(self, model_id, at_frame=None):
+        # Switch to a preloaded maze. This is just a reparent, so it takes effect on this frame
+        #   (or, if at_frame is given, on the first frame numbered at_frame or later).
+        model = self.preloaded_models.get(model_id, None)
+        if model is None:
+            return None
+        self.preloaded_models.move_to_end(model_id) # most recently used
+        if at_frame is not None and at_frame > self.camera_frame + 1:
+            self.scheduled_activations.append((at_frame, model_id))
+            return at_frame
+        if model is not self.current_model:
+            self.show_model(model)
+        frame = globalClock.getFrameCount()
+        print('Model {} activated on frame {} (position timestamp {}, posY {})'.format(
+            model_id, frame, self.last_timestamp, self.stream_posY))
+        return frame
+
+    def activate_scheduled_models(self):
+        for at_frame, model_id in [a for a in self.scheduled_activations if a[0] <= self.camera_frame]:
+            self.scheduled_activations.remove((at_frame, model_id))
+            model = self.preloaded_models.get(model_id, None) # (unless it was evicted since)
+            if model is not None and model is not self.current_model:
+                self.show_model(model)
+                print('Model {} activated on frame {} (position timestamp {}, posY {})'.format(
+                    model_id, self.camera_frame, self.last_timestamp, self.stream_posY))
+
+    def preload_status(self, model_id):
+        if model_id in self.pending_preloads:
+            return 'ModelLoading'
+        elif model_id in self.preloaded_models:
+            return 'ModelPreloaded'
+        elif model_id in self.preload_failures:
+            return 'ModelFailure'
+        return 'ModelNotFound'
+
+    def show_model(self, model):
+        self.remove_model()
+        self.current_model = model
+        self.trackLength = model.track_length
+        if self.predictor.extrapolates:
+            self.predictor.track_length = model.track_length
+        self.wallHeight = model.wall_height
+        self.wallDistance = model.wall_distance
+        self.maze_geometry_root = model.root
+        if model.pager:
+            model.pager.executor = self.model_loader # (from now on, features are built in the background)
+            model.pager.update(self.posY)
+        self.maze_geometry_root.reparentTo(self.render)
+        # Queue textures etc. for upload now rather than when they first come into view
+        self.maze_geometry_root.prepareScene(self.win.getGsg())
+        if self.printStatements and model.optimization_stats:
+            (nodes_before, geoms_before), (nodes_after, geoms_after) = model.optimization_stats
+            print('Maze optimized from {} GeomNodes/{} Geoms to {} GeomNodes/{} Geoms'.format(
+                nodes_before, geoms_before, nodes_after, geoms_after))
+        if self.printStatements and model.atlas_stats and model.atlas_stats['Atlases']:
+            stats = model.atlas_stats
+            print('{} textures packed into {} atlases ({} features, {} left with their own texture): {} -> {} textures bound'.format(
+                stats['Textures'], stats['Atlases'], stats['Features'], stats['Fallback'], *stats['DrawCalls']))
+
+        if not model.has_features:
+            self.show_ip_address()
+
+    def lookup_ip_address(self):
+        # (runs on the IPLookup thread - show_ip_address_when_known() puts it on screen)
+        self.ip_address = lookup_ip_address()
+
+    def show_ip_address_when_known(self, task):
+        if not self.ip_address:
+            return Task.cont
+        if not self.current_model.has_features:
+            self.show_ip_address()
+        return Task.done
+
+    def show_ip_address(self):
+        # Render IP address by default (once we know it)
+        if self.ip_address and not self.IP_address_text:
+            from direct.gui.OnscreenText import OnscreenText
+            self.IP_address_text = OnscreenText(text=self.ip_address, pos=(0, 0.75), scale=0.1,
+                                                align=TextNode.ACenter, fg=[1, 0, 0, 1])
+
+    def first_frame_drawn(self, task):
+        # Runs once, after igLoop has drawn the first frame
+        startup_timer.mark('first frame')
+        if self.printStatements:
+            startup_timer.print_report()
+        if self.startup_report_file:
+            startup_timer.export(self.startup_report_file)
+        if self.fast_start:
+            self.model_loader.submit(self.texture_manager.preload, 'textures')
+        return Task.done
 
+    def init_track(self, trackConfig):
+        # Synchronously build and display a maze (used at startup)
+        self.latest_model = build_maze(trackConfig, self.trackVPos, self.roomSize, self.optimize_maze,
+                                       self.tessellation_error)
+        self.show_model(self.latest_model)
         return self.maze_geometry_root
 
 
     def update_data_server(self, IP):
-        # Initialize (or Re-initialize) ZMQ connection to position data server
-        if self.data_socket:
-            self.poller.unregister(self.data_socket)
-            self.data_socket.close()
+        # Initialize (or Re-initialize) the connection to the position data server. A ZMQ stream
+        #   is received in a background thread so that the frame loop never waits on it. A
+        #   shared memory stream (shm://name, from the same machine) is read directly.
+        if self.position_receiver:
+            self.position_receiver.stop()
+            self.position_receiver = None
 
         success = False
         if IP:
-            context = zmq.Context()
-            self.data_socket = context.socket(zmq.SUB)
             try:
-                self.data_socket.connect(IP)
+                from PositionStream import make_position_receiver
+                self.predictor.reset()
+                self.position_receiver = make_position_receiver(IP, predictor=self.predictor)
+                self.position_receiver.start()
                 success = True
-                self.data_socket.setsockopt(zmq.SUBSCRIBE, b"")
-                self.poller.register(self.data_socket, zmq.POLLIN)
             except:
                 print('Failed to connect to IP {}'.format(IP))
         
@@ -408,103 +619,262 @@ class App(ShowBase):
 
     def exit_fun(self):
         print('Exit called')
+        if self.position_receiver:
+            self.position_receiver.stop()
+        self.model_loader.shutdown(wait=False, cancel_futures=True)
+        if self.telemetry:
+            self.telemetry.close()
         if self.do_frame_synchronization:
-            self.sync_log_file.close()
+            self.sync_log.close()
         sys.exit()
 
     def process_command_messages(self, task):
         """ process_command_messages(): receive ZMQ messages for data and configuration
 
-            There are two sockets on which we listen for messages. The data_socket corresponds
-            to a ZMQ PUB/SUB server which is streaming timestamp and position data. 
-            The command_socket corresponds to a ZMQ server we start above that operates in the 
-            DEALER/REP configuration.
-
-            Here's a list of valid messages sent to the control server socket. All
-            control messages are expected to be a pickled dictionary. Every control
-            message has a "Command" field, and potentially other fields depending
-            on the message. Here's a list of possible "Command"s:
-                "QueryVersion": Reply is "Version:XXX;", where XXX is the version string
-                "LoadModel": The maze YAML is taken from msg["MazeConfig"]. If this field
-                    is missing, the default model is loaded (also if no MazeConfig is
-                    given). If the maze is valid, the reply "ModelLoaded" is sent. Otherwise 
-                    "ModelFailure" is sent, and the default is loaded.
+            There are two sources of messages. The position_receiver is a background thread
+            subscribed to a ZMQ PUB/SUB server which is streaming timestamp and position data
+            (or a reader for a shared memory stream); we just take the newest sample it has
+            seen (this never blocks). The cameras are
+            positioned later in the frame, by late_latch_cameras(). The command_socket
+            corresponds to a ZMQ ROUTER server we start above. It is read without waiting so
+            that the frame is never stalled, and any number of clients can send commands at
+            once (see handle_command()).
+
+            Control messages use the versioned binary format described in CommandProtocol.py.
+            Every message carries a command code and a request ID, and every reply echoes
+            them, along with a "Status" and possibly other fields. Replies to long operations
+            (LoadModel, PreloadModel) are sent when they finish, so they can arrive after
+            replies to later requests. Here's a list of possible commands and their fields:
+                "QueryVersion": Status is "Version". Fields "Version" (the renderer version
+                    string) and "ProtocolVersion".
+                "LoadModel": The maze YAML is taken from msg["MazeConfig"]. Alternatively,
+                    msg["MazeHash"] (see maze_digest()) names a maze which was sent earlier;
+                    if we don't have it, the status is "ModelNotCached" and the controller
+                    should resend with the MazeConfig. If both fields are missing, the
+                    default model is loaded. The maze is built in the
+                    background (the current maze is displayed until the new one is ready).
+                    Once it's displayed, the status is "ModelLoaded", or "ModelFailure" if
+                    the maze was invalid (in which case the default is loaded). If only
+                    some features differed from the previous maze, just those are rebuilt,
+                    and "NodesTouched" gives the number of feature nodes that were rebuilt,
+                    retextured or removed. If a later LoadModel finished first, the status
+                    is "ModelSuperseded".
+                "QueryModelStatus": Status of the most recent LoadModel, "ModelLoading"
+                    while it is being built, otherwise as for LoadModel. If msg["ModelID"]
+                    is given, the status is instead that of the preloaded model:
+                    "ModelLoading", "ModelPreloaded", "ModelFailure", or "ModelNotFound".
+                "PreloadModel": Build the maze in msg["MazeConfig"] (or msg["MazeHash"], as
+                    for LoadModel) in the background without displaying it, and keep it
+                    under the name msg["ModelID"] (replacing any previous model with that ID). Once it's built, the status
+                    is "ModelPreloaded" (or "ModelFailure"). If another PreloadModel with the same ID
+                    arrives first, the status is "ModelSuperseded".
+                "ActivateModel": Display the preloaded model msg["ModelID"]. The switch
+                    happens within one frame, the status is "ModelActivated", and "Frame" is
+                    the frame number on which it took effect (this is also printed along with
+                    the most recent position timestamp). If msg["AtFrame"] is given, the
+                    switch is instead made on that frame, and "Frame" is AtFrame. If the
+                    model isn't ready, the status is as for QueryModelStatus.
+                "EvictModel": Forget the preloaded model msg["ModelID"]. Status is
+                    "ModelEvicted" or "ModelNotFound".
+                "QueryTextures": Status is "Textures". Fields "MemoryBytes" and "BudgetBytes",
+                    and "Textures", a list with the "Name", "Bytes" and "InUse" of each
+                    texture held in memory, least recently used first.
                 "UpdateDataServer": The address of the data server (IP/socket) is given in
                     msg["DataServerAddress"]. It's expected to be of the form
-                    "tcp://host:port". If we successfully subscribe, "DataServerUpdated"
-                    is sent. Otherwise "DataServerFailure".
-                "Exit": This shuts down the VR system. Reply is "Exiting".
+                    "tcp://host:port", or "shm://name" for a writer on this machine (see
+                    PositionStream.py). If we successfully subscribe, the status is
+                    "DataServerUpdated". Otherwise "DataServerFailure".
+                "Exit": This shuts down the VR system. Status is "Exiting".
+            A message that can't be decoded, or is missing a field the command needs (e.g.,
+            ModelID) or has one of the wrong type, gets the status "ProtocolError" (with
+            "Error"). The reply echoes the command, or is "Error" if that can't be read.
         """
-        posY = self.posY
-        msg_list = self.poller.poll(timeout=0.01)
-        while msg_list:
-            for sock, event in msg_list:
-                if sock == self.data_socket:
-                    msg = self.data_socket.recv()
-                    self.last_timestamp, posY = struct.unpack('<Ld',msg)
-                    if posY != self.posY:
-                        self.posY = posY
-                        # print(self.posY)
-                elif sock==self.command_socket:
-                    print('Got a command message')
-                    pickled_msg = self.command_socket.recv() # Command Socket Messages are pickled dictionaries
-                    msg = pickle.loads(pickled_msg)
-                    print("Message received: ", msg)
-                    if msg['Command'] == 'QueryVersion':
-                        self.command_socket.send("Version:{};".format(version).encode())
-                    elif msg['Command'] == 'LoadModel':
-                        success = self.draw_model(msg.get("MazeConfig", {}))
-                        if success:
-                            self.command_socket.send(b"ModelLoaded")
-                        else:
-                            self.command_socket.send(b"ModelFailure")
-                    elif msg['Command'] == 'UpdateDataServer':
-                        success = self.update_data_server(msg.get("DataServerAddress", None))
-                        if success:
-                            self.command_socket.send(b"DataServerUpdated")
-                        else:
-                            self.command_socket.send(b"DataServerFailure")
-                    elif msg['Command'] == 'Exit':
-                        self.command_socket.send(b"Exiting")
-                        self.exit_fun()
-                else:
-                    msg = sock.recv()
-                    print(msg)
-            msg_list = self.poller.poll(timeout=0) # it seems like the whole point of poller
-                                                   # should be to catch all of these, but...
+        if self.position_receiver:
+            sample = self.position_receiver.latest()
+            self.frame_start_receive_time = sample[2] if sample else None
+
+        self.check_model_loading()
+        self.check_preloading()
+
+        while True:
+            try:
+                frames = self.command_socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            # The last frame is the message. Everything before it is the ROUTER envelope
+            #   (client identity and delimiter), which we need to send a reply back.
+            self.handle_command(frames[:-1], frames[-1])
+
+        return Task.cont
 
+    def late_latch_cameras(self, task):
+        """ late_latch_cameras(): position the cameras as late as possible in the frame
 
+            This is the last task before the frame is culled and drawn, so any position sample
+            which arrived while the other tasks ran is still used. We record how old (time since
+            it was received) both this sample and the one available at the start of the frame
+            are at this point, and print a summary every LatchReportFrames frames.
+        """
+        if self.position_receiver:
+            sample = self.position_receiver.latest()
+            if sample:
+                now = time.perf_counter()
+                self.last_timestamp, self.stream_posY, self.receive_time = sample
+                self.posY = self.predictor.predict(now + self.prediction_horizon)
+                if self.frame_start_receive_time is not None:
+                    self.latch_ages.append((now - self.frame_start_receive_time, now - self.receive_time))
+                if self.latch_report_frames and len(self.latch_ages) >= self.latch_report_frames:
+                    self.report_latch_ages()
+
+        if self.frame_barrier:
+            # Wait for the other view processes, and use the first one's position and frame number
+            self.camera_frame, self.last_timestamp, self.stream_posY, self.posY, self.receive_time = self.frame_barrier.exchange(
+                globalClock.getFrameCount(), self.last_timestamp, self.stream_posY, self.posY, self.receive_time)
+        else:
+            self.camera_frame = globalClock.getFrameCount()
+        if self.scheduled_activations:
+            self.activate_scheduled_models()
+
+        if self.current_model.pager:
+            self.current_model.pager.update(self.posY) # (page features in/out around the camera)
         for c in self.cameras:
             c.setPos(self.posX, self.posY, self.posZ + self.cameraHeight)
+        self.camera_time = time.perf_counter()
 
         return Task.cont
 
+    def publish_telemetry(self, task):
+        # Runs after igLoop, so now is when this frame was drawn. (It hasn't been flipped yet - with
+        #   auto-flip off, that happens at the start of the next frame's igLoop.)
+        self.telemetry.publish(self.camera_frame, self.last_timestamp, self.stream_posY, self.posY, self.receive_time,
+                               self.camera_time, time.perf_counter())
+        return Task.cont
+
+    def report_latch_ages(self):
+        ages = np.array(self.latch_ages) * 1000
+        self.latch_ages = []
+        if self.printStatements:
+            print('Position age when drawn over {} frames: {:.2f} ms (max {:.2f}) with the sample from frame start, '
+                  '{:.2f} ms (max {:.2f}) late latched, {:.0f}% of frames got a newer sample'.format(
+                      len(ages), ages[:, 0].mean(), ages[:, 0].max(), ages[:, 1].mean(), ages[:, 1].max(),
+                      100 * np.mean(ages[:, 1] < ages[:, 0])))
+
+    def lookup_maze_config(self, msg):
+        # The maze for a LoadModel/PreloadModel message: msg["MazeConfig"] if it was sent (which
+        #   we then remember), otherwise the one we remember for msg["MazeHash"] (None if we don't
+        #   have it). With neither, it's the default maze.
+        if 'MazeConfig' in msg:
+            maze_config = msg['MazeConfig']
+            self.known_mazes[maze_digest(maze_config)] = maze_config
+            while len(self.known_mazes) > 64:
+                self.known_mazes.popitem(last=False)
+            return maze_config
+        if 'MazeHash' in msg:
+            maze_config = self.known_mazes.get(msg['MazeHash'], None)
+            if maze_config is not None:
+                self.known_mazes.move_to_end(msg['MazeHash'])
+            return maze_config
+        return {}
+
+    def send_reply(self, reply_to, command, status, **fields):
+        # reply_to is (envelope, request_id) as passed to handle_command(), or None
+        if reply_to is None:
+            return
+        envelope, request_id = reply_to
+        self.command_socket.send_multipart(envelope + [encode_reply(request_id, command, status, **fields)])
+
+    def handle_command(self, envelope, frame):
+        try:
+            request_id, command, msg = decode_message(frame)
+            check_request(command, msg) # (so a bad field can't raise an exception here, which would stop the renderer)
+        except ProtocolError as e:
+            print('Bad command message: {}'.format(e))
+            self.command_socket.send_multipart(envelope + [error_reply(frame, e)])
+            return
+        print("Message received: ", command, msg if command not in ('LoadModel', 'PreloadModel') else '')
+        reply_to = (envelope, request_id)
+
+        if command == 'QueryVersion':
+            self.send_reply(reply_to, command, 'Version', Version=version, ProtocolVersion=PROTOCOL_VERSION)
+        elif command == 'LoadModel':
+            maze_config = self.lookup_maze_config(msg)
+            if maze_config is None:
+                self.send_reply(reply_to, command, 'ModelNotCached', MazeHash=msg['MazeHash'])
+            else:
+                self.draw_model(maze_config, reply_to) # replies when the model is displayed
+        elif command == 'QueryModelStatus':
+            if 'ModelID' in msg:
+                self.send_reply(reply_to, command, self.preload_status(msg['ModelID']), ModelID=msg['ModelID'])
+            else:
+                self.send_reply(reply_to, command, self.model_status, **self.model_status_fields)
+        elif command == 'PreloadModel':
+            maze_config = self.lookup_maze_config(msg)
+            if maze_config is None:
+                self.send_reply(reply_to, command, 'ModelNotCached', ModelID=msg['ModelID'], MazeHash=msg['MazeHash'])
+            else:
+                self.preload_model(msg['ModelID'], maze_config, reply_to) # replies when it's built
+        elif command == 'ActivateModel':
+            frame_number = self.activate_model(msg['ModelID'], msg.get('AtFrame', None))
+            if frame_number is not None:
+                self.send_reply(reply_to, command, 'ModelActivated', ModelID=msg['ModelID'], Frame=frame_number)
+            else:
+                self.send_reply(reply_to, command, self.preload_status(msg['ModelID']), ModelID=msg['ModelID'])
+        elif command == 'EvictModel':
+            status = 'ModelEvicted' if self.evict_model(msg['ModelID']) else 'ModelNotFound'
+            self.send_reply(reply_to, command, status, ModelID=msg['ModelID'])
+        elif command == 'QueryTextures':
+            residency = self.texture_manager.residency()
+            self.send_reply(reply_to, command, 'Textures', MemoryBytes=sum(r[1] for r in residency),
+                            BudgetBytes=self.texture_manager.budget_bytes,
+                            Textures=[{'Name': name, 'Bytes': nbytes, 'InUse': in_use}
+                                        for name, nbytes, in_use in residency])
+        elif command == 'UpdateDataServer':
+            success = self.update_data_server(msg.get("DataServerAddress", None))
+            self.send_reply(reply_to, command, "DataServerUpdated" if success else "DataServerFailure")
+        elif command == 'Exit':
+            self.send_reply(reply_to, command, "Exiting")
+            self.exit_fun()
+
     def getPos(self):
         return self.posX, self.posY, self.posZ
 
     def setPos(self, x, y, z):
         self.posX = x
         self.posY = y
+        self.stream_posY = y
         self.posZ = z
 
     def syncSquares(self, task):
-        # TODO: update right square pattern with gold code: https://docs.scipy.org/doc/scipy/reference/generated/scipy.signal.max_len_seq.html
         self.sync_state += 1
         if (self.sync_state % 2) == 1:
             self.left_sync_square.setColor(1, 1, 1, 1) # white on odd
         else:
             self.left_sync_square.setColor(0, 0, 0, 1) # black on even
 
-        if (self.sync_state % 8) < 4:
-            self.right_sync_square.setColor(1, 1, 1, 1) # white on first 4
+        if self.sync_code[self.sync_state % len(self.sync_code)]:
+            self.right_sync_square.setColor(1, 1, 1, 1) # white on 1s of the sync code
         else:
-            self.right_sync_square.setColor(0, 0, 0, 1) # black on rest
+            self.right_sync_square.setColor(0, 0, 0, 1) # black on 0s
 
-        self.sync_log_writer.writerow([self.last_timestamp, self.posY, self.sync_state])
+        self.sync_log.log(self.camera_frame, self.last_timestamp, self.stream_posY, self.posY, self.sync_state,
+                          self.camera_time)
 
         return Task.cont
 
-app = App(display_config=display_config)
-# app = App(display_config=display_config, maze_config=maze_config)
+if __name__ == "__main__":
+    display_config = load_display_config()
+    startup_timer.mark('display config')
+    if display_config.get('ViewProcesses', None):
+        # Each view (or group of views) is drawn by its own process - see MultiView.py
+        from MultiView import ViewSupervisor
+        sys.exit(ViewSupervisor(display_config).run())
+    configure_window(display_config)
+
+    # maze_config_filename = "example-mazes/example_teleport.yaml"
+    # with open(maze_config_filename, "r") as stream:
+    #     maze_config = yaml.safe_load(stream)
+
+    app = App(display_config=display_config)
+    # app = App(display_config=display_config, maze_config=maze_config)
 
-app.run()
+    app.run()
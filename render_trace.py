@@ -0,0 +1,179 @@
+# Offline (faster than real time) rendering of what a rig displayed, for post-hoc analysis.
+#   Takes a maze YAML, a display config and a recorded position trace, renders a frame for
+#   every position offscreen (software rendering, so no GPU is needed), and writes the frames
+#   to a video (via ffmpeg) or to a compressed NumPy frame store. Encoding happens on a
+#   separate thread, so it overlaps with rendering.
+#
+#   python3 render_trace.py example-mazes/example1.yaml display_config.yaml ExperimentLog2021-06-01_1200 frames/
+#   python3 render_trace.py maze.yaml display_config.yaml trace.npy out.mp4 --fps 60 --track-length 240
+#
+#   The trace is a frame log (FrameLog.py - exactly the positions that were drawn, one per
+#   frame, including any prediction), or a (timestamp, position) trace (.npy or CSV). With --fps, the trace is resampled
+#   to that frame rate (using its timestamps); otherwise every sample becomes a frame.
+import os
+import sys
+import time
+import queue
+import shutil
+import zipfile
+import argparse
+import threading
+import subprocess
+import numpy as np
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+
+from panda3d.core import Texture, GraphicsOutput
+
+
+class NpzFrameStore:
+    """ NpzFrameStore: frames saved as compressed .npz chunks (frames_000000.npz, ...) in a directory
+
+        Each chunk holds "frames" (n x height x width x 3, uint8) and "positions", and can be read
+        with np.load(). Chunks are compressed in parallel (zlib releases the GIL) with a fast
+        compression level, since compression is much slower than rendering.
+    """
+    def __init__(self, directory, chunk_frames=60, n_workers=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.chunk_frames = chunk_frames
+        self.frames = []
+        self.positions = []
+        self.n_written = 0
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.compressor = ThreadPoolExecutor(max_workers=self.n_workers)
+        self.pending = []
+
+    def write(self, frame, position):
+        self.frames.append(frame)
+        self.positions.append(position)
+        if len(self.frames) == self.chunk_frames:
+            self.flush()
+
+    def flush(self):
+        if self.frames:
+            filename = os.path.join(self.directory, 'frames_{:06d}.npz'.format(self.n_written))
+            self.pending.append(self.compressor.submit(self.save_chunk, filename, self.frames, self.positions))
+            self.n_written += len(self.frames)
+            self.frames, self.positions = [], []
+            # Don't let more chunks pile up (in memory) than we can compress at once
+            while len(self.pending) > self.n_workers:
+                self.pending.pop(0).result()
+
+    def save_chunk(self, filename, frames, positions):
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+            for name, array in (('frames', np.stack(frames)), ('positions', np.array(positions))):
+                with archive.open(name + '.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, array)
+
+    def close(self):
+        self.flush()
+        for future in self.pending:
+            future.result()
+        self.compressor.shutdown()
+
+
+class VideoWriter:
+    """ VideoWriter: frames piped to ffmpeg as raw RGB """
+    def __init__(self, filename, width, height, fps):
+        if shutil.which('ffmpeg') is None:
+            raise RuntimeError('ffmpeg is needed to write {} (or give a directory to save frames as .npz)'.format(filename))
+        self.process = subprocess.Popen(['ffmpeg', '-loglevel', 'error', '-y', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                                         '-s', '{}x{}'.format(width, height), '-r', str(fps), '-i', '-',
+                                         '-pix_fmt', 'yuv420p', filename], stdin=subprocess.PIPE)
+
+    def write(self, frame, position):
+        self.process.stdin.write(frame.tobytes())
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def load_positions(path, fps=None, track_length=None, timestamp_units=1e-3):
+    # Returns the positions to render, one per frame
+    if path.endswith(('.npy', '.csv')):
+        from PositionPredictor import load_trace
+        timestamps, positions = load_trace(path)
+        if fps:
+            t = (timestamps - timestamps[0]) * timestamp_units
+            if track_length:
+                positions = np.unwrap(positions, period=track_length)
+            positions = np.interp(np.arange(0, t[-1], 1 / fps), t, positions)
+            if track_length:
+                positions = positions % track_length
+        return positions
+    from FrameLog import load_frame_log
+    return load_frame_log(path)['drawn_posY'] # (where the cameras were, not the stream sample - see FrameLog.py)
+
+
+def render_trace(app, positions, writer, report_every=1000):
+    # Render one frame per position, handing the framebuffer to writer (on another thread)
+    capture = Texture()
+    app.win.addRenderTexture(capture, GraphicsOutput.RTMCopyRam)
+    frames = queue.Queue(maxsize=16) # (bounded, so rendering can't run far ahead of encoding)
+
+    def encode():
+        while True:
+            item = frames.get()
+            if item is None:
+                break
+            writer.write(*item)
+        writer.close()
+
+    encoder = threading.Thread(target=encode, name='FrameEncoder')
+    encoder.start()
+    t_start = time.perf_counter()
+    render_time = 0
+    for n, pos in enumerate(positions):
+        t0 = time.perf_counter()
+        app.posY = float(pos)
+        app.taskMgr.step() # (cameras are placed at posY by late_latch_cameras())
+        image = capture.getRamImageAs('RGB')
+        frame = np.frombuffer(image, dtype=np.uint8).reshape(capture.getYSize(), capture.getXSize(), 3)[::-1]
+        render_time += time.perf_counter() - t0
+        frames.put((frame, pos))
+        if report_every and (n + 1) % report_every == 0:
+            print('{} / {} frames ({:.1f} fps)'.format(n + 1, len(positions), (n + 1) / (time.perf_counter() - t_start)))
+    frames.put(None)
+    encoder.join()
+    total_time = time.perf_counter() - t_start
+    return {'frames': len(positions), 'render_fps': len(positions) / render_time if render_time else 0,
+            'total_fps': len(positions) / total_time if total_time else 0, 'seconds': total_time}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Render a recorded position trace offscreen, to video or .npz frames')
+    parser.add_argument('maze', help='maze YAML file')
+    parser.add_argument('display_config', help='display config YAML file (views, window size, etc.)')
+    parser.add_argument('trace', help='frame log (.framelog or base name) or (timestamp, position) trace (.npy/.csv)')
+    parser.add_argument('output', help='video file (.mp4, .mkv, .avi - needs ffmpeg) or a directory for .npz frames')
+    parser.add_argument('--fps', type=float, default=None, help='resample a timestamped trace to this frame rate')
+    parser.add_argument('--timestamp-units', type=float, default=1e-3, help='seconds per trace timestamp tick')
+    parser.add_argument('--track-length', type=float, default=None, help='positions wrap at this value (default: from the maze)')
+    args = parser.parse_args()
+
+    import main
+    with open(args.maze, 'r') as stream:
+        maze_config = yaml.safe_load(stream)
+    display_config = main.load_display_config(args.display_config)
+    display_config.update({'CommandPort': '*', 'LatchReportFrames': 0}) # (any free port - nobody will connect)
+
+    track_length = args.track_length or maze_config.get('TrackLength', 240)
+    positions = load_positions(args.trace, args.fps, track_length, args.timestamp_units)
+
+    main.configure_headless()
+    main.configure_window(display_config, fullscreen=False)
+    main.App.printStatements = False
+    app = main.App(display_config=display_config, maze_config=maze_config)
+
+    width, height = app.win.getXSize(), app.win.getYSize()
+    if args.output.lower().endswith(('.mp4', '.mkv', '.avi', '.mov')):
+        writer = VideoWriter(args.output, width, height, args.fps or 60)
+    else:
+        writer = NpzFrameStore(args.output)
+
+    print('Rendering {} frames at {}x{}'.format(len(positions), width, height))
+    report = render_trace(app, positions, writer)
+    print('{frames} frames in {seconds:.1f} s: {total_fps:.1f} fps overall ({render_fps:.1f} fps rendering only)'.format(**report))
+    sys.exit(0)
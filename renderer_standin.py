@@ -0,0 +1,67 @@
+# Stand-in for one or more PyRenderMaze renderers, for trying out controllers (e.g.,
+#   configure_remotes.py) without any rigs. Each port acts as a separate rig: it speaks the
+#   command protocol, remembers the mazes it has been sent (so MazeHash requests work),
+#   and pretends that building a maze takes --delay seconds. Nothing is rendered.
+#
+#   python3 renderer_standin.py 9001 9002 9003
+#   python3 configure_remotes.py localhost:9001 localhost:9002 localhost:9003 --data-server tcp://localhost:8556
+import zmq
+import time
+import argparse
+
+from CommandProtocol import ProtocolError, decode_message, check_request, encode_reply, error_reply, maze_digest, PROTOCOL_VERSION
+
+parser = argparse.ArgumentParser(description='Stand-in PyRenderMaze renderers (command protocol only)')
+parser.add_argument('ports', nargs='+', type=int, help='command port for each stand-in rig')
+parser.add_argument('--delay', type=float, default=0.2, help='seconds to "build" a maze')
+args = parser.parse_args()
+
+context = zmq.Context()
+poller = zmq.Poller()
+rigs = {} # socket -> {'port':, 'known_mazes':, 'pending': [(time done, envelope, request_id)]}
+for port in args.ports:
+    socket = context.socket(zmq.ROUTER)
+    socket.bind('tcp://*:{}'.format(port))
+    poller.register(socket, zmq.POLLIN)
+    rigs[socket] = {'port': port, 'known_mazes': set(), 'pending': []}
+    print('Stand-in renderer listening on port {}'.format(port))
+
+
+def reply(socket, envelope, request_id, command, status, **fields):
+    socket.send_multipart(envelope + [encode_reply(request_id, command, status, **fields)])
+
+
+while True:
+    for socket, events in poller.poll(10):
+        rig = rigs[socket]
+        frames = socket.recv_multipart()
+        envelope = frames[:-1]
+        try:
+            request_id, command, msg = decode_message(frames[-1])
+            check_request(command, msg)
+        except ProtocolError as e:
+            socket.send_multipart(envelope + [error_reply(frames[-1], e)])
+            continue
+        print('{}: {} {}'.format(rig['port'], command, sorted(msg)))
+
+        if command == 'QueryVersion':
+            reply(socket, envelope, request_id, command, 'Version', Version='standin', ProtocolVersion=PROTOCOL_VERSION)
+        elif command == 'LoadModel':
+            if 'MazeConfig' in msg:
+                rig['known_mazes'].add(maze_digest(msg['MazeConfig']))
+            elif 'MazeHash' in msg and msg['MazeHash'] not in rig['known_mazes']:
+                reply(socket, envelope, request_id, command, 'ModelNotCached', MazeHash=msg['MazeHash'])
+                continue
+            rig['pending'].append((time.monotonic() + args.delay, envelope, request_id))
+        elif command == 'UpdateDataServer':
+            reply(socket, envelope, request_id, command, 'DataServerUpdated')
+        elif command == 'Exit':
+            reply(socket, envelope, request_id, command, 'Exiting')
+        else:
+            reply(socket, envelope, request_id, command, 'ModelNotFound') # (not emulated)
+
+    now = time.monotonic()
+    for socket, rig in rigs.items():
+        while rig['pending'] and rig['pending'][0][0] <= now:
+            _, envelope, request_id = rig['pending'].pop(0)
+            reply(socket, envelope, request_id, 'LoadModel', 'ModelLoaded')
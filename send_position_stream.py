@@ -6,14 +6,24 @@ import numpy as np
 
 import struct
 
+from PositionStream import SharedMemoryPositionWriter
+
+# python3 send_position_stream.py [port]       - publish on tcp://*:port (default 8556)
+# python3 send_position_stream.py shm://name   - write to shared memory, for a renderer on this machine
 port = "8556"
 if len(sys.argv) > 1:
     port =  sys.argv[1]
-    int(port)
+    if not port.startswith('shm://'):
+        int(port)
 
-context = zmq.Context()
-socket = context.socket(zmq.PUB)
-socket.bind("tcp://*:%s" % port)
+if port.startswith('shm://'):
+    writer = SharedMemoryPositionWriter(port)
+    send = writer.write
+else:
+    context = zmq.Context()
+    socket = context.socket(zmq.PUB)
+    socket.bind("tcp://*:%s" % port)
+    send = lambda timestamp, pos: socket.send(struct.pack('<Ld', timestamp, pos))
 
 data = np.load('ExampleData.npy')
 idx = 10000
@@ -22,7 +32,7 @@ k = 0
 
 while True:
     pos = (data[idx, 1] * np.pi * 20.2 / 8192) % 240
-    socket.send(struct.pack('<Ld', int(data[idx,0]), pos))
+    send(int(data[idx,0]), pos)
     idx = idx + 1
     if idx >= data.shape[0]:
         idx = 0